@@ -0,0 +1,187 @@
+__author__ = 'Stanislav Ushakov'
+
+import sys
+import json
+import math
+import time
+import random
+import argparse
+
+from expression import Expression
+from immune import FitnessFunction, VectorizedFitnessFunction, ExpressionMutator, ExpressionsImmuneSystem, \
+    ExpressionsImmuneSystemConfig, DataFileStorageHelper
+from exchanger import SimpleRandomExchanger
+from serializer import ExpressionSerializer
+
+
+#parameters of the benchmarks
+default_grid = {'population_sizes': [50, 200],
+                'heights': [3, 5],
+                'dataset_sizes': [100, 1000]}
+
+quick_grid = {'population_sizes': [20],
+              'heights': [3],
+              'dataset_sizes': [50]}
+
+variables = ['x', 'y']
+
+
+def _dataset(size, seed):
+    """
+    Returns values of the test function in size random points in the form
+    of FitnessFunction.
+    """
+    generator = random.Random(seed)
+    values = []
+    for i in range(0, size):
+        x = generator.uniform(-5, 5)
+        y = generator.uniform(-5, 5)
+        values.append(({'x': x, 'y': y}, x * x + x * y * math.sin(x * y)))
+    return values
+
+
+def _expressions(number, height, seed):
+    random.seed(seed)
+    return [Expression.generate_random(height, variables) for i in range(0, number)]
+
+
+def _immune_system(values, number, height, seed):
+    """
+    Returns immune system with the given number of lymphocytes of the given
+    height that has done the first step (it scores the initial lymphocytes).
+    Config file is not read, random state is seeded after the creation.
+    """
+    config = ExpressionsImmuneSystemConfig(filename=None)
+    config.number_of_lymphocytes = number
+    config.maximal_height = height
+    random.seed(seed)
+    exchanger = SimpleRandomExchanger(lambda: [])
+    immune_system = ExpressionsImmuneSystem(values, variables, exchanger, config)
+    #ExpressionsImmuneSystem reseeds random from the system
+    random.seed(seed)
+    immune_system.step()
+    return immune_system
+
+
+def measure(function, repeat=3, setup=None):
+    """
+    Returns the minimal time in seconds of repeat calls of the function.
+    setup - if given, it is called before every call (not measured) and
+    its result is passed to the function.
+    """
+    result = float('inf')
+    for i in range(0, repeat):
+        if setup is not None:
+            argument = setup()
+            start = time.perf_counter()
+            function(argument)
+        else:
+            start = time.perf_counter()
+            function()
+        result = min(result, time.perf_counter() - start)
+    return result
+
+
+def run(grid=None, seed=0, repeat=3):
+    """
+    Runs all benchmarks on the grid of population sizes, tree heights
+    and dataset sizes with the fixed seed.
+    Returns dict: benchmark name -> {'seconds': time of one run, 'params': ...}.
+    """
+    grid = grid if grid is not None else default_grid
+    results = {}
+
+    def add(name, params, seconds):
+        key = name + '[' + ','.join('{0}={1}'.format(k, params[k]) for k in sorted(params)) + ']'
+        results[key] = {'seconds': seconds, 'params': params}
+
+    for number in grid['population_sizes']:
+        for height in grid['heights']:
+            params = {'population': number, 'height': height}
+            random.seed(seed)
+            add('generate_random', params,
+                measure(lambda: [Expression.generate_random(height, variables) for i in range(0, number)], repeat))
+
+            expressions = _expressions(number, height, seed)
+            random.seed(seed)
+            add('mutation', params,
+                measure(lambda: [ExpressionMutator(e).mutation() for e in expressions], repeat))
+
+            def simplify(expressions):
+                for e in expressions:
+                    e.simplify()
+            add('simplify', params,
+                measure(simplify, repeat, setup=lambda: _expressions(number, height, seed)))
+
+            add('serialization', params,
+                measure(lambda: ExpressionSerializer.decode_batch(ExpressionSerializer.encode_batch(expressions)),
+                        repeat))
+
+            for size in grid['dataset_sizes']:
+                params = {'population': number, 'height': height, 'dataset': size}
+                values = _dataset(size, seed)
+                f = FitnessFunction(values)
+                #the tree walk of Node and the compiled expression
+                add('node_value_in_point', params, measure(lambda: [f(e.root) for e in expressions], repeat))
+                add('compiled_value_in_point', params, measure(lambda: [f(e) for e in expressions], repeat))
+                columns, exact = DataFileStorageHelper.values_to_columns(variables, values)
+                vectorized = VectorizedFitnessFunction(columns, exact)
+                add('value_in_columns', params, measure(lambda: [vectorized(e) for e in expressions], repeat))
+
+                #every repeat steps the new system, so the fitness cache is cold
+                immune_systems = []
+
+                def create_immune_system():
+                    immune_systems.append(_immune_system(values, number, height, seed))
+                    return immune_systems[-1]
+                add('step', params, measure(lambda immune_system: immune_system.step(), repeat,
+                                            setup=create_immune_system))
+                for immune_system in immune_systems:
+                    immune_system.close()
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Returns list of (name, baseline seconds, current seconds) of
+    the benchmarks that became slower than the baseline more than
+    by tolerance (0.2 - 20%). Benchmarks absent in the baseline are skipped.
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]['seconds']
+        new = results[name]['seconds']
+        if new > old * (1 + tolerance):
+            regressions.append((name, old, new))
+    return regressions
+
+
+#start as "python benchmark.py [--output results.json] [--baseline baseline.json]"
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the solver hot paths.')
+    parser.add_argument('--output', default='benchmark.json', help='file for the results (JSON)')
+    parser.add_argument('--baseline', help='results to compare with (JSON)')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown, 0.2 - 20%%')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help='small grid for the fast check')
+    arguments = parser.parse_args()
+
+    results = run(quick_grid if arguments.quick else default_grid, arguments.seed, arguments.repeat)
+    output = open(arguments.output, 'w')
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.close()
+    for name in sorted(results):
+        print('{0}: {1:.6f} s'.format(name, results[name]['seconds']))
+
+    if arguments.baseline is not None:
+        input = open(arguments.baseline)
+        baseline = json.load(input)
+        input.close()
+        regressions = compare(results, baseline, arguments.tolerance)
+        for (name, old, new) in regressions:
+            print('REGRESSION {0}: {1:.6f} s -> {2:.6f} s'.format(name, old, new))
+        if regressions:
+            sys.exit(1)
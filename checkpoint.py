@@ -0,0 +1,173 @@
+__author__ = 'Stanislav Ushakov'
+
+import os
+import json
+import struct
+from threading import Thread, Condition
+
+import numpy as np
+
+from serializer import ExpressionSerializer
+
+
+class Checkpoint:
+    """
+    State of the immune system that is enough to continue solving:
+    generation - number of the last finished step,
+    population - all lymphocytes (see Population),
+    fitness_values - NumPy array of their fitness values (NaN - not
+    calculated yet),
+    random_state - state of the random module (random.getstate()).
+    File format: header (magic, length of the metadata, number of fitness
+    values), metadata in JSON (generation and random state), fitness values
+    (float64) and the population encoded by ExpressionSerializer.
+    """
+
+    _magic = b'AISC'
+    _header = struct.Struct('<4sII')
+
+    def __init__(self, generation, population, fitness_values, random_state):
+        self.generation = generation
+        self.population = population
+        self.fitness_values = fitness_values
+        self.random_state = random_state
+
+    def to_bytes(self):
+        """
+        Returns the encoded checkpoint.
+        """
+        version, state, gauss_next = self.random_state
+        metadata = json.dumps({'generation': self.generation,
+                               'random_state': [version, list(state), gauss_next]}).encode('utf-8')
+        fitness_values = np.ascontiguousarray(self.fitness_values, dtype='<f8')
+        return b''.join([self._header.pack(self._magic, len(metadata), len(fitness_values)),
+                         metadata,
+                         fitness_values.tobytes(),
+                         ExpressionSerializer.encode_population(self.population)])
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Returns checkpoint restored from the bytes returned by to_bytes.
+        Raises ValueError if the data is not the checkpoint.
+        """
+        if len(data) < cls._header.size or not data.startswith(cls._magic):
+            raise ValueError('data is not a checkpoint')
+        magic, metadata_length, number = cls._header.unpack_from(data)
+        position = cls._header.size
+        metadata = json.loads(data[position:position + metadata_length].decode('utf-8'))
+        position += metadata_length
+        fitness_values = np.frombuffer(data, dtype='<f8', count=number, offset=position).astype(np.float64)
+        position += fitness_values.nbytes
+        population = ExpressionSerializer.decode_population(data[position:])
+        version, state, gauss_next = metadata['random_state']
+        return Checkpoint(metadata['generation'], population, fitness_values,
+                          (version, tuple(state), gauss_next))
+
+    def save(self, filename):
+        """
+        Writes the checkpoint to the file atomically: to the temporary file
+        first, then it replaces the old file. So the file always contains
+        the whole checkpoint.
+        """
+        Checkpoint.write_atomically(filename, self.to_bytes())
+
+    @classmethod
+    def write_atomically(cls, filename, data):
+        temporary = filename + '.tmp'
+        output = open(temporary, 'wb')
+        try:
+            output.write(data)
+            output.flush()
+            os.fsync(output.fileno())
+        finally:
+            output.close()
+        os.replace(temporary, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Returns checkpoint read from the file.
+        """
+        input = open(filename, 'rb')
+        data = input.read()
+        input.close()
+        return cls.from_bytes(data)
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints to the file in the background thread, so the caller
+    doesn't wait for the disk. Checkpoint is encoded in the thread too, so
+    the caller must not change its arrays after write (see
+    ExpressionsImmuneSystem.get_checkpoint). If the previous one isn't
+    written yet, only the newest is written.
+    If writing fails, the error is raised by the next flush or close and
+    the next checkpoints are still written.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._pending = None
+        self._writing = False
+        self._closed = False
+        self._error = None
+        self._condition = Condition()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, checkpoint):
+        """
+        Schedules writing of the checkpoint.
+        """
+        with self._condition:
+            self._pending = checkpoint
+            self._condition.notify_all()
+
+    def flush(self):
+        """
+        Waits until all scheduled checkpoints are written. Raises the error
+        of the failed writing if there was any since the previous flush.
+        """
+        with self._condition:
+            while self._pending is not None or self._writing:
+                self._condition.wait()
+            error = self._error
+            self._error = None
+        if error is not None:
+            raise error
+
+    def close(self):
+        """
+        Writes the scheduled checkpoint and stops the thread. Raises
+        the error of the failed writing as flush does.
+        """
+        try:
+            self.flush()
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                checkpoint = self._pending
+                self._pending = None
+                self._writing = True
+            error = None
+            try:
+                Checkpoint.write_atomically(self.filename, checkpoint.to_bytes())
+            except Exception as e:
+                error = e
+            with self._condition:
+                if error is not None:
+                    self._error = error
+                self._writing = False
+                self._condition.notify_all()
@@ -1,9 +1,104 @@
 __author__ = 'Stanislav Ushakov'
 
+import sys
 from threading import Thread, Lock
-from SocketServer import BaseRequestHandler, TCPServer
+from socketserver import BaseRequestHandler, TCPServer, ThreadingMixIn
 import socket
-import pickle
+import struct
+import asyncio
+
+from serializer import ExpressionSerializer
+from migration import MigrationInbox
+from instrumentation import NullInstrumentation
+
+
+#every message is prefixed with its length
+_message_header = struct.Struct('!Q')
+
+#messages with the larger length in the header are rejected and
+#the connection is closed - the header is broken or the peer is not a node
+_max_message_size = 1 << 28
+
+#size of the socket send and receive buffers
+_socket_buffer_size = 1 << 20
+
+#source and generation of the sent lymphocytes
+_migrants_header = struct.Struct('<qq')
+
+
+def encode_migrants(source, generation, lymphocytes):
+    """
+    Returns bytes of the lymphocytes tagged with their source and generation.
+    """
+    return _migrants_header.pack(source, generation) + ExpressionSerializer.encode_batch(lymphocytes)
+
+
+def decode_migrants(data):
+    """
+    Returns tuple (source, generation, lymphocytes) restored from the bytes
+    returned by encode_migrants.
+    """
+    source, generation = _migrants_header.unpack_from(data)
+    return source, generation, ExpressionSerializer.decode_batch(data[_migrants_header.size:])
+
+
+def send_message(sock, payload):
+    """
+    Sends payload (bytes) to the socket as one length-prefixed message.
+    """
+    sock.sendall(_message_header.pack(len(payload)) + payload)
+
+
+def _receive_exactly(sock, size):
+    """
+    Returns exactly size bytes received from the socket or None if
+    the connection is closed before.
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if not n:
+            return None
+        received += n
+    return buffer
+
+
+def _get_message_size(header):
+    """
+    Returns payload size from the message header. Raises ValueError if it
+    is larger than _max_message_size.
+    """
+    size = _message_header.unpack(header)[0]
+    if size > _max_message_size:
+        raise ValueError('message of {0} bytes is too large'.format(size))
+    return size
+
+
+def receive_message(sock):
+    """
+    Returns payload of the next message received from the socket or None
+    if the connection is closed. Raises ValueError if the message is too
+    large, the connection must be closed then.
+    """
+    header = _receive_exactly(sock, _message_header.size)
+    if header is None:
+        return None
+    payload = _receive_exactly(sock, _get_message_size(header))
+    if payload is None:
+        return None
+    return bytes(payload)
+
+
+def _configure_socket(sock):
+    """
+    Sets large buffers and disables Nagle's algorithm - messages are
+    sent at once.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _socket_buffer_size)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _socket_buffer_size)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
 
 class SimpleRandomExchanger:
@@ -36,18 +131,24 @@ class LocalhostNodesManager:
     This class simply returns ports on current machine.
     """
 
-    def __init__(self, node_number, all_nodes):
+    def __init__(self, node_number, all_nodes, topology=None):
         """
         Initializes manager with the number of the current node and number of
         all nodes.
+        topology - object that defines which nodes this node exchanges with
+        (see migration module), by default - with all other nodes.
         """
         self.self_host = 'localhost'
         self.base_port = 5000
         self.self_port = self.base_port + node_number
-        self.other_nodes = [(self.self_host, p)
-                            for p in range(self.base_port + 1, self.base_port + all_nodes + 1)
-                            if p != self.self_port]
-        self.other_nodes_len = all_nodes - 1
+        if topology is None:
+            self.other_nodes = [(self.self_host, p)
+                                for p in range(self.base_port + 1, self.base_port + all_nodes + 1)
+                                if p != self.self_port]
+        else:
+            self.other_nodes = [(self.self_host, self.base_port + n)
+                                for n in topology.neighbours(node_number, all_nodes)]
+        self.other_nodes_len = len(self.other_nodes)
         self.current_node = 0
 
     def get_self_address(self):
@@ -69,15 +170,101 @@ class LocalhostNodesManager:
 class TCPHandler(BaseRequestHandler):
     """
     The RequestHandler class for this node.
+    The connection is kept open, so the other node may request
+    lymphocytes many times using the same connection.
     """
 
     def handle(self):
         """
-        Main method - receive dummy data and send currently stored lymphocytes -
-        first pickle them.
+        Main method - for every received request message send currently
+        stored lymphocytes - first encode them (see ExpressionSerializer).
+        """
+        _configure_socket(self.request)
+        #the connection is closed by the server after handle
+        try:
+            while receive_message(self.request) is not None:
+                send_message(self.request, ExpressionSerializer.encode_batch(self.server.lymphocytes_getter()))
+        except ValueError as e:
+            print('Request from {0} is dropped: {1}'.format(self.client_address, e), file=sys.stderr)
+        except socket.error:
+            pass
+
+
+class ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    """
+    TCP server that handles every connection in its own thread - connections
+    are long-lived, so they can't be handled one after another.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ConnectionPool:
+    """
+    This class keeps open connections to the other nodes, so one
+    connection is used for many exchanges.
+    """
+
+    def __init__(self, timeout=None):
+        """
+        Initializes empty pool. timeout - timeout in seconds for socket
+        operations (None - blocking sockets).
+        """
+        self.timeout = timeout
+        self.connections = {}
+        self.lock = Lock()
+
+    def request(self, address, payload=b''):
+        """
+        Sends request message to the node with the given address (host, port)
+        and returns its response. If the stored connection is broken,
+        it is opened again once. Raises socket.error (OSError) if the node
+        is not available or its response is too large.
+        The connection is taken from the pool while it is used, so
+        concurrent requests to the same node don't mix their messages.
+        """
+        for attempt in range(0, 2):
+            sock = self._take_connection(address)
+            try:
+                send_message(sock, payload)
+                response = receive_message(sock)
+            except socket.error:
+                sock.close()
+                if attempt:
+                    raise
+                continue
+            except ValueError:
+                sock.close()
+                raise socket.error('response of {0} is too large'.format(address))
+            if response is not None:
+                self._return_connection(address, sock)
+                return response
+            sock.close()
+        raise socket.error('connection to {0} is closed'.format(address))
+
+    def close(self):
+        """
+        Closes all connections.
         """
-        self.request.recv(1024)
-        self.request.sendall(pickle.dumps(self.server.lymphocytes_getter()))
+        with self.lock:
+            for sock in self.connections.values():
+                sock.close()
+            self.connections = {}
+
+    def _take_connection(self, address):
+        with self.lock:
+            sock = self.connections.pop(address, None)
+        if sock is None:
+            sock = socket.create_connection(address, self.timeout)
+            _configure_socket(sock)
+        return sock
+
+    def _return_connection(self, address, sock):
+        with self.lock:
+            if address not in self.connections:
+                self.connections[address] = sock
+                return
+        sock.close()
 
 
 class ServerThread(Thread):
@@ -100,7 +287,7 @@ class ServerThread(Thread):
         """
         Main thread method. Open socket and waiting for connections.
         """
-        server = TCPServer((self.host, self.port), TCPHandler)
+        server = ThreadingTCPServer((self.host, self.port), TCPHandler)
         server.lymphocytes_getter = self.lymphocytes_getter
 
         #runs forever - so make this thread daemon
@@ -112,39 +299,32 @@ class GetterThread(Thread):
     This Thread class is used for getting lymphocytes from another node.
     """
 
-    def __init__(self, node_address, lymphocytes_setter):
+    def __init__(self, node_address, lymphocytes_setter, connection_pool):
         """
-        Initializes thread with the address of node being requested and
-        method that will store received lymphocytes.
+        Initializes thread with the address of node being requested,
+        method that will store received lymphocytes and pool of
+        connections to the other nodes.
         """
         Thread.__init__(self)
         self.address = node_address
         self.lymphocytes_setter = lymphocytes_setter
+        self.connection_pool = connection_pool
 
     def run(self):
         """
-        Main thread method. Creates socket, receives data, unpickle it
-        and call setter function.
+        Main thread method. Requests lymphocytes using the pooled
+        connection, decode them and call setter function.
         """
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect(self.address)
-
-            #send dummy data
-            sock.sendall(bytes("Give me", "utf-8"))
-            received = sock.recv(1024)
-            while True:
-                data = sock.recv(1024)
-                if not data: break
-                received += data
-            lymphocytes = pickle.loads(received)
+            lymphocytes = ExpressionSerializer.decode_batch(self.connection_pool.request(self.address))
             self.lymphocytes_setter(lymphocytes)
-        except ConnectionRefusedError:
+        except socket.error:
             #Don't bother. May be it's better to add more logic to determine
             #permanent connection errors.
             pass
-        finally:
-            sock.close()
+        except (ValueError, struct.error) as e:
+            #the response is broken, the next one may be correct
+            print('Lymphocytes from {0} are dropped: {1}'.format(self.address, e), file=sys.stderr)
 
 
 class PeerToPeerExchanger:
@@ -162,6 +342,7 @@ class PeerToPeerExchanger:
         self.lock_to_exchange = Lock()
         self.lock_to_return = Lock()
         self.nodes_manager = nodes_manager
+        self.connection_pool = ConnectionPool()
 
         #start server thread
         self.server_thread = ServerThread(self.nodes_manager.get_self_address()[0],
@@ -222,5 +403,199 @@ class PeerToPeerExchanger:
         Starts thread that is getting lymphocytes from another node.
         """
         getter_thread = GetterThread(self.nodes_manager.get_next_node_address(),
-                                     self._set_lymphocytes_to_return)
-        getter_thread.start()
\ No newline at end of file
+                                     self._set_lymphocytes_to_return,
+                                     self.connection_pool)
+        getter_thread.start()
+
+
+async def _async_send_message(writer, payload):
+    """
+    Sends payload (bytes) to the stream as one length-prefixed message.
+    """
+    writer.write(_message_header.pack(len(payload)) + payload)
+    await writer.drain()
+
+
+async def _async_receive_message(reader):
+    """
+    Returns payload of the next message received from the stream or None
+    if the connection is closed. Raises ValueError if the message is too
+    large.
+    """
+    try:
+        header = await reader.readexactly(_message_header.size)
+        return await reader.readexactly(_get_message_size(header))
+    except asyncio.IncompleteReadError:
+        return None
+
+
+class AsyncPeerToPeerExchanger:
+    """
+    The same exchanger as PeerToPeerExchanger, but all network operations
+    are done by the single asyncio event loop running in the background
+    thread: it serves all connected nodes and fetches lymphocytes from
+    several nodes at once. Connections to the other nodes are kept open.
+    Methods set_lymphocytes_to_exchange and get_lymphocytes never wait
+    for the network.
+    Received lymphocytes are also stored to the inbox (see MigrationInbox)
+    tagged with the port of the source node and its generation, they are
+    returned by get_migrants.
+    """
+
+    def __init__(self, nodes_manager, nodes_per_exchange=1, timeout=5.0, inbox_size=16,
+                 instrumentation=None):
+        """
+        Initializes exchanger with the nodes manager (see LocalhostNodesManager),
+        number of nodes which lymphocytes are requested at once and timeout in
+        seconds for the exchange with one node - slow or dead node is skipped.
+        inbox_size - maximal number of stored messages in the inbox.
+        instrumentation - if given (see Instrumentation), bytes_sent,
+        bytes_received and failed_fetches are counted.
+        """
+        self.instrumentation = instrumentation if instrumentation is not None else NullInstrumentation()
+        self.nodes_manager = nodes_manager
+        self.nodes_per_exchange = nodes_per_exchange
+        self.timeout = timeout
+        self.to_exchange = []
+        self.generation = 0
+        self.to_return = []
+        self.inbox = MigrationInbox(inbox_size)
+        #(reader, writer) for every node address
+        self.connections = {}
+        #writers of the connections from the other nodes
+        self.clients = set()
+
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = Thread(target=self.loop.run_forever)
+        self.loop_thread.daemon = True
+        self.loop_thread.start()
+
+        host, port = self.nodes_manager.get_self_address()
+        self.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle, host, port), self.loop).result()
+        #real address, e.g. if port 0 was given
+        self.address = self.server.sockets[0].getsockname()[:2]
+
+        #future of the currently running fetch
+        self.fetching = None
+        self._receive_lymphocytes()
+
+    def set_lymphocytes_to_exchange(self, lymphocytes, generation=None):
+        """
+        Set the lymphocytes using for exchange - these lymphocytes will
+        be given to the other node when requested.
+        generation - current generation of this node, if it is given,
+        receiving of the new lymphocytes is started too (see get_migrants).
+        """
+        self.to_exchange = lymphocytes
+        if generation is not None:
+            self.generation = generation
+            self._receive_lymphocytes()
+
+    def get_lymphocytes(self):
+        """
+        Returns lymphocytes received from the other nodes by the previous
+        fetch and starts to receive the new ones (if the previous fetch is
+        finished).
+        """
+        lymphocytes = self.to_return[:]
+        self._receive_lymphocytes()
+        return lymphocytes
+
+    def get_migrants(self, generation, max_staleness):
+        """
+        Returns lymphocytes stored to the inbox since the previous call
+        (see MigrationInbox.drain), never waits.
+        """
+        return self.inbox.drain(generation, max_staleness)
+
+    def close(self):
+        """
+        Stops the server, closes all connections and the event loop.
+        """
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+
+    def _receive_lymphocytes(self):
+        if self.fetching is not None and not self.fetching.done():
+            return
+        count = min(self.nodes_per_exchange, self.nodes_manager.other_nodes_len)
+        addresses = []
+        for i in range(0, count):
+            address = self.nodes_manager.get_next_node_address()
+            if address not in addresses:
+                addresses.append(address)
+        self.fetching = asyncio.run_coroutine_threadsafe(self._fetch_all(addresses), self.loop)
+
+    async def _fetch_all(self, addresses):
+        """
+        Requests lymphocytes from all given nodes at once, lymphocytes of
+        the nodes that answered in time are stored to be returned.
+        """
+        results = await asyncio.gather(*[self._fetch(address) for address in addresses])
+        lymphocytes = []
+        for result in results:
+            if result is not None:
+                self.inbox.put(*result)
+                lymphocytes += result[2]
+        if lymphocytes:
+            self.to_return = lymphocytes
+
+    async def _fetch(self, address):
+        """
+        Returns (source, generation, lymphocytes) of the node with the given
+        address or None if it doesn't answer in time.
+        """
+        try:
+            return await asyncio.wait_for(self._request(address), self.timeout)
+        except (OSError, asyncio.TimeoutError, ValueError, struct.error):
+            self.instrumentation.count('failed_fetches')
+            #the connection may be in the wrong state - open it next time
+            connection = self.connections.pop(address, None)
+            if connection is not None:
+                connection[1].close()
+            return None
+
+    async def _request(self, address):
+        if address not in self.connections:
+            self.connections[address] = await asyncio.open_connection(*address)
+        reader, writer = self.connections[address]
+        await _async_send_message(writer, b'')
+        payload = await _async_receive_message(reader)
+        if payload is None:
+            raise ConnectionResetError('connection to {0} is closed'.format(address))
+        self.instrumentation.count('bytes_received', len(payload))
+        return decode_migrants(payload)
+
+    async def _handle(self, reader, writer):
+        """
+        Serves one connection of the other node: for every request message
+        sends currently stored lymphocytes tagged with the port of this node
+        and its generation.
+        """
+        self.clients.add(writer)
+        try:
+            while await _async_receive_message(reader) is not None:
+                payload = encode_migrants(self.address[1], self.generation, self.to_exchange[:])
+                self.instrumentation.count('bytes_sent', len(payload))
+                await _async_send_message(writer, payload)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    async def _close(self):
+        #the running fetch and connection handlers must be finished before
+        #the loop is stopped
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.server.close()
+        for writer in list(self.clients) + [writer for (reader, writer) in self.connections.values()]:
+            writer.close()
+        self.connections = {}
+        await self.server.wait_closed()
@@ -2,6 +2,9 @@ __author__ = 'Stanislav Ushakov'
 
 import random
 import math
+from array import array
+
+import numpy as np
 
 
 class NotSupportedOperationError(Exception): pass
@@ -14,12 +17,17 @@ class Operation:
     Operations.{OPERATION} must be used instead.
     is_unary - True, if operation is unary
     action - function that returns result of this operation (1 or 2 arguments)
+    vector_action - the same as action, but works with NumPy arrays
     string_representation - for printing expressions
+    code - opcode of the operation in the compiled expression
     """
 
-    def __init__(self, operation_type, action, string_representation=''):
+    def __init__(self, operation_type, action, string_representation='',
+                 vector_action=None, code=None):
         self._operation_type = operation_type
+        self.code = code
         self.action = action
+        self.vector_action = vector_action if vector_action is not None else action
         self.string_representation = string_representation
 
     def is_number(self):
@@ -72,7 +80,9 @@ class Operation:
 
     def _init_from_operation(self, operation):
         self._operation_type = operation._operation_type
+        self.code = operation.code
         self.action = operation.action
+        self.vector_action = operation.vector_action
         if hasattr(operation, 'string_representation'):
             self.string_representation = operation.string_representation
 
@@ -87,27 +97,38 @@ class Operations:
     _binary_operation = 3
 
     NUMBER = Operation(operation_type=_number,
-                       action=(lambda x: x))
+                       action=(lambda x: x),
+                       code=0)
     IDENTITY = Operation(operation_type=_variable,
-                         action=(lambda x: x))
+                         action=(lambda x: x),
+                         code=1)
     PLUS = Operation(operation_type=_binary_operation,
                      action=(lambda x, y: x + y),
-                     string_representation='+')
+                     string_representation='+',
+                     code=2)
     MINUS = Operation(operation_type=_binary_operation,
                       action=(lambda x, y: x - y),
-                      string_representation='-')
+                      string_representation='-',
+                      code=3)
     MULTIPLICATION = Operation(operation_type=_binary_operation,
                                action=(lambda x, y: x * y),
-                               string_representation='*')
+                               string_representation='*',
+                               code=4)
     DIVISION = Operation(operation_type=_binary_operation,
                          action=(lambda x, y: x / y if y != 0 else x / 0.000001),
-                         string_representation='/')
+                         string_representation='/',
+                         vector_action=(lambda x, y: x / np.where(y != 0, y, 0.000001)),
+                         code=5)
     SIN = Operation(operation_type=_unary_operation,
                     action=(lambda x: math.sin(x)),
-                    string_representation='sin')
+                    string_representation='sin',
+                    vector_action=np.sin,
+                    code=6)
     COS = Operation(operation_type=_unary_operation,
                     action=(lambda x: math.cos(x)),
-                    string_representation='cos')
+                    string_representation='cos',
+                    vector_action=np.cos,
+                    code=7)
 
     @classmethod
     def get_unary_operations(cls):
@@ -124,6 +145,15 @@ class Operations:
         """
         return [Operations.PLUS, Operations.MINUS, Operations.MULTIPLICATION, Operations.DIVISION]
 
+    @classmethod
+    def get_all_operations(cls):
+        """
+        Returns list of all operations ordered by their codes,
+        so Operations.get_all_operations()[operation.code] is operation.
+        """
+        return [Operations.NUMBER, Operations.IDENTITY] + \
+               Operations.get_binary_operations() + Operations.get_unary_operations()
+
 
 class Node:
     """
@@ -132,6 +162,10 @@ class Node:
     operation - Operation object.
     value - contains number if operation = NUMBER or variable name if
     operation = IDENTITY
+    Height and size of the tree are cached in every node. They are
+    calculated when the node is created, so after changing children of
+    the existing node update_metadata must be called for it and for all
+    its ancestors (from the bottom to the top).
     """
 
     def __init__(self, operation, left=None, right=None, value=None):
@@ -148,6 +182,17 @@ class Node:
         self.left = left
         self.right = right
         self.value = value
+        self.update_metadata()
+
+    def update_metadata(self):
+        """
+        Recalculates cached height and size of the tree which root is the
+        current node. Metadata of the children must be up to date.
+        """
+        left_height, left_size = (self.left._height, self.left._size) if self.left is not None else (0, 0)
+        right_height, right_size = (self.right._height, self.right._size) if self.right is not None else (0, 0)
+        self._height = max(left_height, right_height) + 1
+        self._size = left_size + right_size + 1
 
     def value_in_point(self, values):
         """
@@ -167,17 +212,36 @@ class Node:
         return self.operation.action(self.left.value_in_point(values),
                                      self.right.value_in_point(values))
 
+    def value_in_columns(self, columns):
+        """
+        Return values in the current node, calculated for all points at once.
+        columns - dictionary containing NumPy array of values for all needed
+        variables, e.g. {'x': array([1, 2]), 'y': array([2, 3])}
+        Numbers are returned as is, so the result may be a scalar - it is
+        broadcast by NumPy when combined with arrays.
+        """
+        if self.is_number():
+            return self.value
+        if self.is_variable():
+            return columns[self.value]
+
+        if self.is_unary():
+            return self.operation.vector_action(self.left.value_in_columns(columns))
+
+        return self.operation.vector_action(self.left.value_in_columns(columns),
+                                            self.right.value_in_columns(columns))
+
     def height(self):
         """
         Returns height of the tree which root is the current node.
         """
-        if self.is_number() or self.is_variable():
-            return 1
-        if self.is_unary():
-            return self.left.height() if self.left is not None else 0 + 1
+        return self._height
 
-        return max(self.left.height() if self.left is not None else 0,
-                   self.right.height() if self.right is not None else 0) + 1
+    def size(self):
+        """
+        Returns number of nodes in the tree which root is the current node.
+        """
+        return self._size
 
     def is_number(self):
         """
@@ -211,6 +275,11 @@ class Node:
         Return True only if the current node or at least one
         of its subtrees was modified during the simplification.
         """
+        result = self._simplify(accuracy)
+        self.update_metadata()
+        return result
+
+    def _simplify(self, accuracy):
         #TODO: add more rules
 
         #leave only 3 digits after decimal point
@@ -281,6 +350,70 @@ class Node:
         self.value = node.value
         self.left = node.left
         self.right = node.right
+        self.update_metadata()
+
+    def add_paths_by_kind(self, paths, prefix=()):
+        """
+        Appends paths to all nodes of the tree which root is the current node
+        to the paths dictionary: kind of the operation -> list of paths.
+        Path is a tuple of 'left' and 'right' from the root of the whole
+        tree, prefix - path to the current node.
+        """
+        paths[self.operation._operation_type].append(prefix)
+        if self.left is not None:
+            self.left.add_paths_by_kind(paths, prefix + ('left',))
+        if self.right is not None:
+            self.right.add_paths_by_kind(paths, prefix + ('right',))
+
+    def copy(self):
+        """
+        Returns copy of the tree which root is the current node.
+        All nodes are copied, operations are shared.
+        """
+        return Node(self.operation,
+                    left=self.left.copy() if self.left is not None else None,
+                    right=self.right.copy() if self.right is not None else None,
+                    value=self.value)
+
+    def structural_key(self):
+        """
+        Returns hashable representation of the tree which root is the
+        current node. Two trees have equal keys only if they have the same
+        structure, the same operations and the same values in the leaves.
+        """
+        if self.is_number():
+            return Operations._number, self.value
+        if self.is_variable():
+            return Operations._variable, self.value
+
+        if self.is_unary():
+            return self.operation.string_representation, self.left.structural_key()
+
+        return (self.operation.string_representation,
+                self.left.structural_key(),
+                self.right.structural_key())
+
+    def compile_to(self, codes, args, variables):
+        """
+        Appends the tree which root is the current node to the codes and args
+        in postfix order. See CompiledExpression.
+        variables - list of variable names, names not found in it are
+        appended to it.
+        """
+        if self.left is not None:
+            self.left.compile_to(codes, args, variables)
+        if self.right is not None:
+            self.right.compile_to(codes, args, variables)
+
+        codes.append(self.operation.code)
+        if self.is_number():
+            args.append(self.value)
+        elif self.is_variable():
+            if self.value not in variables:
+                variables.append(self.value)
+            args.append(variables.index(self.value))
+        else:
+            args.append(0)
 
     def __str__(self):
         """
@@ -331,6 +464,7 @@ class Node:
         This method is being called while unpickling.
         """
         self.value = state[self._value_dict_key]
+        self.left = self.right = None
         self.operation = Operation(None, None)
         self.operation.__setstate__(state[self._operation_dict_key])
         if self._left_node_dict_key in state:
@@ -339,12 +473,321 @@ class Node:
         if self._right_node_dict_key in state:
             self.right = Node(Operations.NUMBER)
             self.right.__setstate__(state[self._right_node_dict_key])
+        self.update_metadata()
+
+
+class CompiledExpression:
+    """
+    This class represents expression tree compiled to the flat postfix form.
+    codes - array of operation codes (see Operation.code),
+    args - array of the same length: value for the number, index in
+    variables for the variable and 0 for all other operations,
+    variables - list of variable names.
+    Compiled expression is evaluated by the simple stack machine.
+    For the evaluation codes are decoded once into the list of steps.
+    """
+
+    #kinds of the decoded program steps
+    _push_number = 0
+    _push_variable = 1
+    _apply_unary = 2
+    _apply_binary = 3
+
+    def __init__(self, codes, args, variables):
+        """
+        Initializes compiled expression with the given codes,
+        arguments and variable names.
+        """
+        self.codes = codes
+        self.args = args
+        self.variables = variables
+        self._scalar_program = None
+        self._vector_program = None
+
+    @classmethod
+    def from_node(cls, root, variables):
+        """
+        Compiles the tree with the given root.
+        """
+        codes = array('b')
+        args = array('d')
+        variables = list(variables)
+        root.compile_to(codes, args, variables)
+        return CompiledExpression(codes, args, variables)
+
+    def value_in_point(self, values):
+        """
+        Returns value calculated for given values of variables,
+        e.g. {'x': 1, 'y': 2}
+        """
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        for (kind, item) in self._get_program(vectorized=False):
+            if kind == CompiledExpression._push_number:
+                push(item)
+            elif kind == CompiledExpression._push_variable:
+                push(values[item])
+            elif kind == CompiledExpression._apply_unary:
+                stack[-1] = item(stack[-1])
+            else:
+                right = pop()
+                stack[-1] = item(stack[-1], right)
+        return stack[0]
+
+    def value_in_columns(self, columns):
+        """
+        Returns values calculated for all points given as columns of
+        variables values. See Node.value_in_columns.
+        """
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        for (kind, item) in self._get_program(vectorized=True):
+            if kind == CompiledExpression._push_number:
+                push(item)
+            elif kind == CompiledExpression._push_variable:
+                push(columns[item])
+            elif kind == CompiledExpression._apply_unary:
+                stack[-1] = item(stack[-1])
+            else:
+                right = pop()
+                stack[-1] = item(stack[-1], right)
+        return stack[0]
+
+    def numbers(self):
+        """
+        Returns indices of the number nodes in codes (NumPy array).
+        """
+        return np.flatnonzero(np.asarray(self.codes, dtype=np.int8) == Operations.NUMBER.code)
+
+    def with_numbers(self, numbers):
+        """
+        Returns new compiled expression of the same structure, but with
+        the given values of the number nodes (in order of numbers()).
+        """
+        args = np.array(self.args, dtype=np.float64)
+        args[self.numbers()] = numbers
+        return CompiledExpression(np.array(self.codes, dtype=np.int8), args, self.variables)
+
+    def jacobian_in_columns(self, columns):
+        """
+        Returns values calculated for all points (see value_in_columns) and
+        the matrix of their derivatives by the numbers of the expression
+        (see numbers): row for every point, column for every number node.
+        Derivatives are calculated together with values in one pass (forward
+        mode). The guarded denominator of the division is a constant
+        where the divisor is 0.
+        """
+        count = len(self.numbers())
+        zero = np.zeros((count, 1))
+        stack = []
+        number = 0
+        #every stack item is (value, derivatives): derivatives have a row for
+        #every number, they are broadcast with values
+        for (code, arg) in zip(np.asarray(self.codes).tolist(), np.asarray(self.args).tolist()):
+            if code == Operations.NUMBER.code:
+                derivative = np.zeros((count, 1))
+                derivative[number] = 1
+                number += 1
+                stack.append((arg, derivative))
+            elif code == Operations.IDENTITY.code:
+                stack.append((columns[self.variables[int(arg)]], zero))
+            elif code == Operations.SIN.code:
+                (value, derivative) = stack[-1]
+                stack[-1] = (np.sin(value), np.cos(value) * derivative)
+            elif code == Operations.COS.code:
+                (value, derivative) = stack[-1]
+                stack[-1] = (np.cos(value), -np.sin(value) * derivative)
+            else:
+                (right, right_derivative) = stack.pop()
+                (left, left_derivative) = stack[-1]
+                if code == Operations.PLUS.code:
+                    stack[-1] = (left + right, left_derivative + right_derivative)
+                elif code == Operations.MINUS.code:
+                    stack[-1] = (left - right, left_derivative - right_derivative)
+                elif code == Operations.MULTIPLICATION.code:
+                    stack[-1] = (left * right, left_derivative * right + left * right_derivative)
+                else:
+                    denominator = np.where(right != 0, right, 0.000001)
+                    right_derivative = right_derivative * (right != 0)
+                    stack[-1] = (left / denominator,
+                                 left_derivative / denominator -
+                                 left * right_derivative / (denominator * denominator))
+        (value, derivative) = stack[0]
+        size = np.broadcast(value, *columns.values()).shape if columns else np.shape(value)
+        value = np.broadcast_to(value, size)
+        return value, np.broadcast_to(derivative, (count,) + size).reshape(count, -1).T
+
+    def gradient_in_columns(self, columns, adjoint=None):
+        """
+        Returns values calculated for all points (see value_in_columns) and
+        the gradient of the target by the numbers of the expression (NumPy
+        array in order of numbers). The target is a sum over all points of
+        a function of the values: adjoint receives values and returns
+        derivatives of the target by them (for every point), by default
+        the target is the sum of values.
+        Values are calculated forward, then derivatives are propagated back
+        from the root (reverse mode), so the cost doesn't depend on
+        the number of numbers.
+        """
+        codes = np.asarray(self.codes).tolist()
+        args = np.asarray(self.args).tolist()
+        values = [None] * len(codes)
+        children = [None] * len(codes)
+        stack = []
+        for (k, (code, arg)) in enumerate(zip(codes, args)):
+            if code == Operations.NUMBER.code:
+                values[k] = arg
+                stack.append(k)
+                continue
+            if code == Operations.IDENTITY.code:
+                values[k] = columns[self.variables[int(arg)]]
+                stack.append(k)
+                continue
+            if code == Operations.SIN.code:
+                values[k] = np.sin(values[stack[-1]])
+                children[k] = (stack[-1], None)
+            elif code == Operations.COS.code:
+                values[k] = np.cos(values[stack[-1]])
+                children[k] = (stack[-1], None)
+            else:
+                right = stack.pop()
+                (left_value, right_value) = (values[stack[-1]], values[right])
+                if code == Operations.PLUS.code:
+                    values[k] = left_value + right_value
+                elif code == Operations.MINUS.code:
+                    values[k] = left_value - right_value
+                elif code == Operations.MULTIPLICATION.code:
+                    values[k] = left_value * right_value
+                else:
+                    values[k] = left_value / np.where(right_value != 0, right_value, 0.000001)
+                children[k] = (stack[-1], right)
+            stack[-1] = k
+
+        size = np.broadcast(values[-1], *columns.values()).shape if columns else np.shape(values[-1])
+        value = np.broadcast_to(values[-1], size)
+        adjoints = [0] * len(codes)
+        adjoints[-1] = adjoint(value) if adjoint is not None else np.ones(size)
+        gradient = []
+        for k in range(len(codes) - 1, -1, -1):
+            code = codes[k]
+            a = adjoints[k]
+            if code == Operations.NUMBER.code:
+                gradient.append(np.sum(a))
+                continue
+            if children[k] is None:
+                continue
+            (left, right) = children[k]
+            if code == Operations.SIN.code:
+                adjoints[left] = adjoints[left] + a * np.cos(values[left])
+            elif code == Operations.COS.code:
+                adjoints[left] = adjoints[left] - a * np.sin(values[left])
+            elif code == Operations.PLUS.code:
+                adjoints[left] = adjoints[left] + a
+                adjoints[right] = adjoints[right] + a
+            elif code == Operations.MINUS.code:
+                adjoints[left] = adjoints[left] + a
+                adjoints[right] = adjoints[right] - a
+            elif code == Operations.MULTIPLICATION.code:
+                adjoints[left] = adjoints[left] + a * values[right]
+                adjoints[right] = adjoints[right] + a * values[left]
+            else:
+                #the guarded denominator is a constant where the divisor is 0
+                denominator = np.where(values[right] != 0, values[right], 0.000001)
+                adjoints[left] = adjoints[left] + a / denominator
+                adjoints[right] = adjoints[right] - \
+                    a * values[left] / (denominator * denominator) * (values[right] != 0)
+        #numbers were visited from the last one
+        return value, np.array(gradient[::-1], dtype=np.float64)
+
+    def _get_program(self, vectorized):
+        """
+        Returns codes decoded into the list of (kind, item) pairs, where item
+        is a number, a variable name or an action to apply.
+        The list is created once for every kind of evaluation.
+        """
+        program = self._vector_program if vectorized else self._scalar_program
+        if program is not None:
+            return program
+
+        operations = Operations.get_all_operations()
+        program = []
+        for (code, arg) in zip(self.codes.tolist(), self.args.tolist()):
+            operation = operations[code]
+            action = operation.vector_action if vectorized else operation.action
+            if operation.is_number():
+                program.append((CompiledExpression._push_number, arg))
+            elif operation.is_variable():
+                program.append((CompiledExpression._push_variable, self.variables[int(arg)]))
+            elif operation.is_unary():
+                program.append((CompiledExpression._apply_unary, action))
+            else:
+                program.append((CompiledExpression._apply_binary, action))
+
+        if vectorized:
+            self._vector_program = program
+        else:
+            self._scalar_program = program
+        return program
+
+    def to_node(self):
+        """
+        Restores the expression tree and returns its root.
+        """
+        operations = Operations.get_all_operations()
+        stack = []
+        for (code, arg) in zip(self.codes.tolist(), self.args.tolist()):
+            operation = operations[code]
+            if operation.is_number():
+                stack.append(Node(Operations.NUMBER, value=arg))
+            elif operation.is_variable():
+                stack.append(Node(Operations.IDENTITY, value=self.variables[int(arg)]))
+            elif operation.is_unary():
+                stack[-1] = Node(operation, left=stack[-1])
+            else:
+                right = stack.pop()
+                stack[-1] = Node(operation, left=stack[-1], right=right)
+        return stack[0]
+
+    def compile(self):
+        """
+        Compiled expression may be used everywhere instead of Expression
+        for evaluation, so it returns itself.
+        """
+        return self
+
+    def structural_key(self):
+        """
+        Returns hashable representation of the compiled expression,
+        see Node.structural_key.
+        """
+        return bytes(self.codes), bytes(self.args), tuple(self.variables)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getstate__(self):
+        """
+        Decoded programs contain actions, so they are not pickled.
+        """
+        return {'codes': self.codes, 'args': self.args, 'variables': self.variables}
+
+    def __setstate__(self, state):
+        """
+        This method is being called while unpickling.
+        """
+        self.__init__(state['codes'], state['args'], state['variables'])
 
 
 class Expression:
     """
     This class is used for representing expression tree.
     Root of the tree is stored in root field.
+    Expression is evaluated in its compiled form, which is created once
+    and must be invalidated (see invalidate) after any change of the tree.
+    Paths to the nodes of every kind are also stored, so a node for
+    the mutation is selected without traversing the tree.
     """
 
     @classmethod
@@ -368,92 +811,166 @@ class Expression:
             return random.choice(Operations.get_unary_operations() +
                                  Operations.get_binary_operations())
 
+    #methods of the random trees generation
+    FULL = 'full'
+    GROW = 'grow'
+    RAMPED_HALF_AND_HALF = 'ramped'
+
+    #possibility of the leaf before the maximal height for GROW method
+    _grow_leaf_possibility = 0.3
+
+    @classmethod
+    def generate_leaf(cls, variables):
+        """
+        Returns randomly generated leaf - number or variable
+        from variables list with equal possibilities.
+        """
+        if random.random() > 0.5:
+            return Node(Operations.NUMBER, value=Expression.generate_number())
+        return Node(Operations.IDENTITY, value=random.choice(variables))
+
     @classmethod
-    def generate_random(cls, max_height, variables):
+    def generate_random(cls, max_height, variables, method=FULL):
         """
         Generates random expression tree which height is not more than given
         max_height value with variable names from variables list.
+        method - FULL: all leaves are at the maximal height,
+        GROW: leaves may appear at any height.
+        The root is always binary operation (if max_height > 1).
+        The time is linear in the size of the generated tree.
         """
-        root = Node(Expression.generate_operator(only_binary=True))
-        current = [root]
-        while len(current) > 0:
-            node = current.pop(0)
-            if node.is_number():
-                node.value = Expression.generate_number()
-                continue
+        grow = method == Expression.GROW
 
-            if node.is_variable():
-                node.value = random.choice(variables)
-                continue
+        def generate_node(height):
+            #height - height of the subtree that may be placed here
+            if height <= 1:
+                return Expression.generate_leaf(variables)
+            if grow and height < max_height and random.random() < Expression._grow_leaf_possibility:
+                return Expression.generate_leaf(variables)
 
-            if node.is_unary():
-                node.left = Node(Expression.generate_operator())
-                if root.height() > max_height:
-                    node.left = None
-                else:
-                    current.append(node.left)
-
-            if node.is_binary():
-                node.left = Node(Expression.generate_operator())
-                node.right = Node(Expression.generate_operator())
-                if root.height() > max_height:
-                    node.left = None
-                    node.right = None
-                else:
-                    current.append(node.left)
-                    current.append(node.right)
-
-        #turn all leaves into numbers or variables
-        leaves = []
-
-        def traverse_tree(node):
-            if node.is_number() or node.is_variable():
-                return
-            if node.is_unary():
-                if node.left is None:
-                    leaves.append(node)
-                else:
-                    traverse_tree(node.left)
-            if node.is_binary():
-                if node.left is None:
-                    leaves.append(node)
-                else:
-                    traverse_tree(node.left)
-                if node.right is not None:
-                    traverse_tree(node.right)
+            operation = Expression.generate_operator(only_binary=(height == max_height))
+            if operation.is_unary():
+                return Node(operation, left=generate_node(height - 1))
+            return Node(operation,
+                        left=generate_node(height - 1),
+                        right=generate_node(height - 1))
 
-        traverse_tree(root)
+        return Expression(root=generate_node(max_height), variables=variables)
 
-        for node in leaves:
-            if random.random() > 0.5:
-                node.operation = Operations.NUMBER
-                node.value = Expression.generate_number()
-            else:
-                node.operation = Operations.IDENTITY
-                node.value = random.choice(variables)
+    @classmethod
+    def generate_random_batch(cls, number, max_height, variables, method=RAMPED_HALF_AND_HALF):
+        """
+        Generates list of number random expression trees.
+        method - FULL or GROW (see generate_random) or RAMPED_HALF_AND_HALF:
+        maximal heights of the trees are evenly distributed in
+        [2, max_height] and for every height half of the trees are
+        generated by FULL method and the other half - by GROW method.
+        """
+        if method != Expression.RAMPED_HALF_AND_HALF:
+            return [Expression.generate_random(max_height, variables, method)
+                    for i in range(0, number)]
 
-        return Expression(root=root, variables=variables)
+        heights = list(range(2, max_height + 1)) or [max_height]
+        methods = [Expression.FULL, Expression.GROW]
+        return [Expression.generate_random(heights[(i // 2) % len(heights)], variables, methods[i % 2])
+                for i in range(0, number)]
 
-    def __init__(self, root, variables):
+    def __init__(self, root, variables, paths_by_kind=None):
         """
         Initializes expression tree with the given root and a list
         of possible variables.
+        paths_by_kind - already known paths to the nodes (see
+        get_paths_by_kind), if None - they are found when needed.
         """
         self.root = root
         self.variables = variables
+        self._compiled = None
+        self._paths_by_kind = paths_by_kind
+
+    def get_paths_by_kind(self):
+        """
+        Returns dictionary: kind of the operation (Operations._number,
+        Operations._variable, Operations._unary_operation or
+        Operations._binary_operation) -> list of paths to all nodes of
+        this kind. See Node.add_paths_by_kind.
+        Paths are in preorder, which is their sorted order ('left' < 'right').
+        The result must not be changed, it may be shared with other
+        expressions.
+        """
+        if self._paths_by_kind is None:
+            self._paths_by_kind = {Operations._number: [],
+                                   Operations._variable: [],
+                                   Operations._unary_operation: [],
+                                   Operations._binary_operation: []}
+            self.root.add_paths_by_kind(self._paths_by_kind)
+        return self._paths_by_kind
+
+    @classmethod
+    def from_compiled(cls, compiled, variables):
+        """
+        Restores expression from its compiled form.
+        """
+        expression = Expression(root=compiled.to_node(), variables=variables)
+        expression._compiled = compiled
+        return expression
+
+    def compile(self):
+        """
+        Returns compiled form of the expression (CompiledExpression).
+        It is created only once - until invalidate is called.
+        """
+        if self._compiled is None:
+            self._compiled = CompiledExpression.from_node(self.root, self.variables)
+        return self._compiled
+
+    def invalidate(self):
+        """
+        Must be called after the tree was changed. Drops compiled form
+        and paths to the nodes.
+        """
+        self._compiled = None
+        self._paths_by_kind = None
 
     def value_in_point(self, values):
         """
         Returns value calculated for given values of variables.
         """
-        return self.root.value_in_point(values)
+        return self.compile().value_in_point(values)
+
+    def value_in_columns(self, columns):
+        """
+        Returns values calculated for all points given as columns of
+        variables values. See Node.value_in_columns.
+        """
+        return self.compile().value_in_columns(columns)
+
+    def gradient_in_columns(self, columns, adjoint=None):
+        """
+        Returns values and the gradient by the numbers of the expression.
+        See CompiledExpression.gradient_in_columns.
+        """
+        return self.compile().gradient_in_columns(columns, adjoint)
 
     def simplify(self):
         """
         Simplifies entire expression tree.
         While we have changes in the tree - call simplify.
+        Subtrees may be shared with other expressions (see ExpressionMutator),
+        so the tree is copied before the simplification.
         """
+        self.root = self.root.copy()
         while self.root.simplify(): pass
+        #paths are found again only if needed, it's not slower than
+        #the copying and the simplification of the whole tree
+        self.invalidate()
+
+    def structural_key(self):
+        """
+        Returns hashable representation of the expression tree.
+        It is built from the compiled form, so it is the same as for
+        CompiledExpression. See Node.structural_key.
+        """
+        return self.compile().structural_key()
 
     def __str__(self):
         """
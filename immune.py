@@ -2,10 +2,21 @@ __author__ = 'Stanislav Ushakov'
 
 import math
 import random
-import copy
 import json
+import time
+import struct
+import bisect
+from collections import OrderedDict
+from multiprocessing import Pool, shared_memory
 
-from expression import Expression, Operations
+import numpy as np
+
+from expression import Expression, Operations, Node, CompiledExpression
+from population import Population
+from instrumentation import NullInstrumentation
+from checkpoint import Checkpoint, CheckpointWriter
+from migration import TopEmigrantsSelection, RandomEmigrantsSelection, DiversityEmigrantsSelection, \
+    ReplaceWorstPolicy, ReplaceRandomPolicy
 
 
 def FitnessFunction(exact_values):
@@ -33,9 +44,516 @@ def FitnessFunction(exact_values):
         return math.sqrt(sum)
     return expression_value#lambda (expression):expression_value(expression, exact_values)
 
+
+def VectorizedFitnessFunction(columns, exact):
+    """
+    The same fitness function as FitnessFunction, but the expression is
+    evaluated once for the whole dataset using NumPy.
+
+        Initializes function with the columns of variables values and
+        the array of exact values of the needed function, as returned by
+        DataFileStorageHelper.values_to_columns:
+        ({'x': array([1, 2]), 'y': array([1, 2])}, array([0.125, 0.250]))
+    """
+
+    def expression_value(expression):
+        """
+        Returns value of the fitness function for given
+        expression. The less the value - the closer expression to
+        the unknown function.
+        NaN (e.g. inf - inf somewhere in the tree) is treated as the worst
+        possible value.
+        """
+        with np.errstate(all='ignore'):
+            difference = expression.value_in_columns(columns) - exact
+            result = math.sqrt(np.sum(difference * difference))
+        if math.isnan(result):
+            return float('inf')
+        return result
+    return expression_value
+
+
+class StreamingFitnessFunction:
+    """
+    The same fitness function as FitnessFunction, but the dataset isn't
+    stored in memory: it is read from the data file (see
+    DataFileStorageHelper) by chunks of chunk_size points on every
+    evaluation. So it's better to evaluate many expressions at once
+    by the values method - then the file is read only once for all of them.
+    """
+
+    def __init__(self, filename, chunk_size):
+        self.filename = filename
+        self.chunk_size = chunk_size
+
+    def __call__(self, expression):
+        """
+        Returns value of the fitness function for given expression.
+        """
+        return self.values([expression])[0]
+
+    def values(self, expressions):
+        """
+        Returns list of fitness values of the given expressions.
+        Squared errors are accumulated chunk by chunk for all expressions.
+        """
+        compiled = [e.compile() for e in expressions]
+        sums = np.zeros(len(compiled))
+        with np.errstate(all='ignore'):
+            for (columns, exact) in DataFileStorageHelper.iterate_chunks(self.filename, self.chunk_size):
+                for (i, c) in enumerate(compiled):
+                    difference = c.value_in_columns(columns) - exact
+                    sums[i] += np.sum(difference * difference)
+            result = np.sqrt(sums)
+        result[np.isnan(result)] = np.inf
+        return result.tolist()
+
+
+class ProgressiveFitnessFunction:
+    """
+    The same fitness function as VectorizedFitnessFunction, but expressions
+    may be scored progressively: on the first first_subset_size points, then
+    on 4 times more points and so on up to the whole dataset. The sum of
+    squared errors only grows, so the expression is rejected as soon as its
+    partial value exceeds the given threshold - its full value can't be
+    less than the threshold anyway.
+    racing_fraction - if less than 1, only this part of the best expressions
+    (by the value on the first subset) is scored further, all others are
+    rejected. Unlike the threshold this is a heuristic: a rejected
+    expression may be better on the whole dataset.
+    """
+
+    def __init__(self, columns, exact, first_subset_size=256, racing_fraction=1.0):
+        """
+        columns and exact are the same as for VectorizedFitnessFunction.
+        """
+        self.columns = columns
+        self.exact = exact
+        self.racing_fraction = racing_fraction
+        #ends of the subsets
+        self.bounds = []
+        bound = max(first_subset_size, 1)
+        while bound < len(exact):
+            self.bounds.append(bound)
+            bound *= 4
+        self.bounds.append(len(exact))
+
+    def __call__(self, expression):
+        """
+        Returns value of the fitness function for given expression
+        (on the whole dataset).
+        """
+        return self.values([expression])[0]
+
+    def values(self, expressions, threshold=None):
+        """
+        Returns list of fitness values of the given expressions.
+        If threshold is given, expressions rejected because their partial
+        value is greater than it (or not promoted by racing) get inf value.
+        Otherwise all expressions are scored on the whole dataset.
+        """
+        compiled = [e.compile() for e in expressions]
+        sums = np.zeros(len(compiled))
+        active = list(range(0, len(compiled)))
+        start = 0
+        with np.errstate(all='ignore'):
+            for end in self.bounds:
+                columns = dict((var, column[start:end]) for (var, column) in self.columns.items())
+                exact = self.exact[start:end]
+                for i in active:
+                    difference = compiled[i].value_in_columns(columns) - exact
+                    sums[i] += np.sum(difference * difference)
+                sums[np.isnan(sums)] = np.inf
+                start = end
+                if threshold is None or end == len(self.exact):
+                    continue
+                #the threshold is compared with the square root of the sum,
+                #small tolerance is for the different order of summation
+                limit = (threshold * (1 + 1e-9)) ** 2
+                active = [i for i in active if sums[i] <= limit]
+                if end == self.bounds[0] and self.racing_fraction < 1 and active:
+                    promoted = int(math.ceil(self.racing_fraction * len(active)))
+                    active = sorted(active, key=lambda i: sums[i])[:promoted]
+            result = np.sqrt(sums)
+        if threshold is not None:
+            rejected = np.ones(len(compiled), dtype=bool)
+            rejected[active] = False
+            result[rejected] = np.inf
+        return result.tolist()
+
+
+def create_shared_dataset(columns, exact, variables):
+    """
+    Places the dataset in columns form (see
+    DataFileStorageHelper.values_to_columns) to the new shared memory block:
+    one row for every variable and the last row for the exact values.
+    Returns tuple (memory, shape), the memory must be closed and unlinked
+    by the caller.
+    """
+    shape = (len(variables) + 1, len(exact))
+    memory = shared_memory.SharedMemory(create=True, size=max(1, shape[0] * shape[1] * 8))
+    data = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+    for (i, var) in enumerate(variables):
+        data[i] = columns[var]
+    data[-1] = exact
+    return memory, shape
+
+
+def attach_shared_dataset(memory_name, shape, variables):
+    """
+    Attaches the dataset placed to the shared memory by create_shared_dataset.
+    Returns tuple (memory, columns, exact), columns and exact are views of
+    the shared memory.
+    """
+    memory = shared_memory.SharedMemory(name=memory_name)
+    data = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+    columns = {}
+    for (i, var) in enumerate(variables):
+        columns[var] = data[i]
+    return memory, columns, data[-1]
+
+
+class ConstantOptimizer:
+    """
+    This class fits all numbers of the expression at once by
+    the Levenberg-Marquardt method: it minimizes the same sum of squared
+    errors as VectorizedFitnessFunction. Derivatives by the numbers are
+    calculated by CompiledExpression.jacobian_in_columns.
+    evaluations - number of evaluations of expressions on the whole dataset.
+    """
+
+    def __init__(self, columns, exact, number_of_iterations=10, damping=0.001):
+        """
+        Initializes optimizer with the dataset in columns form (see
+        DataFileStorageHelper.values_to_columns), maximal number of
+        iterations and initial damping.
+        """
+        self.columns = columns
+        self.exact = np.asarray(exact, dtype=np.float64)
+        self.number_of_iterations = number_of_iterations
+        self.damping = damping
+        self.evaluations = 0
+
+    def optimize(self, expression, fitness=None):
+        """
+        Returns tuple (compiled expression with fitted numbers, its fitness
+        value). If numbers can't be improved, the compiled form of the given
+        expression and its fitness value are returned.
+        fitness - fitness value of the expression if it is known.
+        """
+        compiled = expression.compile()
+        numbers = np.asarray(compiled.args, dtype=np.float64)[compiled.numbers()]
+        if fitness is None:
+            fitness = self._fitness(compiled)
+        if not len(numbers) or not math.isfinite(fitness):
+            return compiled, fitness
+
+        damping = self.damping
+        jacobian = None
+        for i in range(0, self.number_of_iterations):
+            with np.errstate(all='ignore'):
+                if jacobian is None:
+                    values, jacobian = compiled.jacobian_in_columns(self.columns)
+                    self.evaluations += 1
+                    jacobian = np.broadcast_to(jacobian, (len(self.exact), len(numbers)))
+                    residual = self.exact - values
+                    if not np.all(np.isfinite(jacobian)) or not np.all(np.isfinite(residual)):
+                        break
+                    normal = jacobian.T.dot(jacobian)
+                    gradient = jacobian.T.dot(residual)
+                try:
+                    step = np.linalg.solve(normal + damping * (np.diag(np.diag(normal)) + np.eye(len(numbers))),
+                                           gradient)
+                except np.linalg.LinAlgError:
+                    break
+            candidate = compiled.with_numbers(numbers + step)
+            candidate_fitness = self._fitness(candidate)
+            if candidate_fitness < fitness:
+                compiled, numbers, fitness = candidate, numbers + step, candidate_fitness
+                damping /= 10
+                jacobian = None
+            else:
+                damping *= 10
+        return compiled, fitness
+
+    def gradient(self, expression):
+        """
+        Returns tuple (fitness value of the expression, NumPy array of its
+        derivatives by the numbers of the expression - in order of
+        CompiledExpression.numbers). Values and all derivatives are
+        calculated by one pass through the dataset (see
+        CompiledExpression.gradient_in_columns).
+        """
+        self.evaluations += 1
+        result = {}
+
+        def adjoint(values):
+            #d sqrt(sum(d * d)) / d values = d / sqrt(sum(d * d))
+            difference = values - self.exact
+            result['fitness'] = math.sqrt(np.sum(difference * difference))
+            if result['fitness'] == 0:
+                return np.zeros_like(difference)
+            return difference / result['fitness']
+
+        with np.errstate(all='ignore'):
+            (values, gradient) = expression.compile().gradient_in_columns(self.columns, adjoint)
+        if math.isnan(result['fitness']):
+            return float('inf'), gradient
+        return result['fitness'], gradient
+
+    def _fitness(self, compiled):
+        self.evaluations += 1
+        with np.errstate(all='ignore'):
+            difference = compiled.value_in_columns(self.columns) - self.exact
+            result = math.sqrt(np.sum(difference * difference))
+        if math.isnan(result):
+            return float('inf')
+        return result
+
+
+#dataset of the worker process of ParallelFitnessEvaluator
+_worker_memory = None
+_worker_fitness_function = None
+
+
+def _init_worker(memory_name, shape, variables):
+    """
+    Initializes worker process of ParallelFitnessEvaluator - attaches
+    the dataset placed to the shared memory.
+    """
+    global _worker_memory, _worker_fitness_function
+    _worker_memory, columns, exact = attach_shared_dataset(memory_name, shape, variables)
+    _worker_fitness_function = VectorizedFitnessFunction(columns, exact)
+
+
+def _evaluate_in_worker(encoded_expression):
+    """
+    Returns fitness value of the expression encoded as
+    (codes, args, variables) of its compiled form.
+    """
+    return _worker_fitness_function(CompiledExpression(*encoded_expression))
+
+
+class ParallelFitnessEvaluator:
+    """
+    This class is used for calculating fitness values of many expressions
+    in the pool of worker processes.
+    The dataset is placed to the shared memory once, so only compiled
+    expressions are sent to the workers and fitness values are sent back.
+    """
+
+    def __init__(self, columns, exact, variables, number_of_workers):
+        """
+        Initializes evaluator with the dataset in columns form (see
+        DataFileStorageHelper.values_to_columns) and starts the workers.
+        """
+        self.number_of_workers = number_of_workers
+        self._memory, shape = create_shared_dataset(columns, exact, variables)
+        self._pool = Pool(number_of_workers,
+                          initializer=_init_worker,
+                          initargs=(self._memory.name, shape, list(variables)))
+
+    def __call__(self, expressions):
+        """
+        Returns list of fitness values of the given expressions.
+        """
+        encoded = []
+        for e in expressions:
+            compiled = e.compile()
+            encoded.append((compiled.codes, compiled.args, compiled.variables))
+        chunk_size = len(encoded) // (self.number_of_workers * 4) + 1
+        return self._pool.map(_evaluate_in_worker, encoded, chunk_size)
+
+    def close(self):
+        """
+        Stops the workers and frees the shared memory.
+        """
+        self._pool.terminate()
+        self._pool.join()
+        self._memory.close()
+        self._memory.unlink()
+
+
+class FitnessCache:
+    """
+    This class is used for storing already calculated fitness values.
+    Values are stored by the structural key of the expression, so
+    the equal trees are calculated only once. When cache is full, the least
+    recently used value is removed.
+    hits and misses - number of found and not found values respectively.
+    """
+
+    def __init__(self, fitness_function, max_size, batch_fitness_function=None):
+        """
+        Initializes cache with the fitness function which values are
+        stored and maximal number of stored values.
+        batch_fitness_function - optional function that returns list of
+        values for list of expressions, used by values method.
+        """
+        self.fitness_function = fitness_function
+        self.batch_fitness_function = batch_fitness_function
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+
+    def __call__(self, expression):
+        """
+        Returns value of the fitness function for given expression.
+        Calculates it only if there is no stored value.
+        """
+        key = expression.structural_key()
+        if key in self._values:
+            self.hits += 1
+            self._values.move_to_end(key)
+            return self._values[key]
+
+        self.misses += 1
+        value = self.fitness_function(expression)
+        self._store(key, value)
+        return value
+
+    def values(self, expressions, threshold=None):
+        """
+        Returns list of fitness values for the list of expressions.
+        All not stored values are calculated at once by the batch fitness
+        function (if it is given).
+        threshold - if given, it is passed to the batch fitness function
+        (see ProgressiveFitnessFunction), then inf values mean rejected
+        expressions and they aren't stored.
+        """
+        keys = [e.structural_key() for e in expressions]
+        result = [None] * len(expressions)
+        missed = OrderedDict()
+        for (i, key) in enumerate(keys):
+            if key in self._values:
+                self.hits += 1
+                self._values.move_to_end(key)
+                result[i] = self._values[key]
+            elif key in missed:
+                self.hits += 1
+            else:
+                self.misses += 1
+                missed[key] = expressions[i]
+
+        if threshold is not None:
+            calculated = self.batch_fitness_function(list(missed.values()), threshold)
+        elif self.batch_fitness_function is not None:
+            calculated = self.batch_fitness_function(list(missed.values()))
+        else:
+            calculated = [self.fitness_function(e) for e in missed.values()]
+        calculated = dict(zip(missed.keys(), calculated))
+        for (key, value) in calculated.items():
+            if threshold is None or value != float('inf'):
+                self._store(key, value)
+
+        for (i, key) in enumerate(keys):
+            if result[i] is None:
+                result[i] = calculated[key]
+        return result
+
+    def _store(self, key, value):
+        if self.max_size > 0:
+            self._values[key] = value
+            if len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+
+    def __len__(self):
+        return len(self._values)
+
+    def hit_rate(self):
+        """
+        Returns part of the requests that were found in cache.
+        """
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    def clear(self):
+        """
+        Removes all stored values. Counters are not reset.
+        """
+        self._values.clear()
+
+
+class Deduplicator:
+    """
+    This class finds duplicates among lymphocytes before their evaluation.
+    Lymphocyte is a duplicate if another lymphocyte has the same structure
+    (see Expression.structural_key) or the same fingerprint - values in
+    the small fixed set of probe points rounded to decimals digits. So
+    algebraically equal trees (e.g. x + x and 2 * x) are found too.
+    Fingerprints with NaN or inf values are not compared.
+    Fingerprints are stored by structural keys, at most max_size of them.
+    """
+
+    def __init__(self, probe_columns, decimals=6, max_size=10000):
+        self.probe_columns = probe_columns
+        self.decimals = decimals
+        self.max_size = max_size
+        self._fingerprints = {}
+
+    @classmethod
+    def probe(cls, columns, size):
+        """
+        Returns columns of size points evenly spread over the dataset
+        given in columns form (see DataFileStorageHelper.values_to_columns).
+        """
+        length = len(next(iter(columns.values()))) if columns else 0
+        indices = np.unique(np.linspace(0, max(length - 1, 0), min(size, length)).astype(np.int64))
+        return dict((var, np.asarray(column)[indices]) for (var, column) in columns.items())
+
+    def fingerprint(self, expression):
+        """
+        Returns hashable fingerprint of the expression or None if it has
+        NaN or inf values in the probe points.
+        """
+        key = expression.structural_key()
+        if key in self._fingerprints:
+            return self._fingerprints[key]
+        with np.errstate(all='ignore'):
+            values = expression.value_in_columns(self.probe_columns)
+        size = len(next(iter(self.probe_columns.values()))) if self.probe_columns else 1
+        values = np.broadcast_to(np.asarray(values, dtype=np.float64), (size,))
+        if np.all(np.isfinite(values)):
+            #+ 0.0 makes -0.0 equal to 0.0
+            fingerprint = (np.round(values, self.decimals) + 0.0).tobytes()
+        else:
+            fingerprint = None
+        if len(self._fingerprints) >= self.max_size:
+            self._fingerprints = {}
+        self._fingerprints[key] = fingerprint
+        return fingerprint
+
+    def duplicates(self, expressions, candidates):
+        """
+        Returns indices of candidates (indices in expressions) that are
+        duplicates of other expressions: of the not candidates or of
+        the previous candidates.
+        """
+        candidates = set(int(i) for i in candidates)
+        order = [i for i in range(len(expressions)) if i not in candidates] + sorted(candidates)
+        keys = set()
+        fingerprints = set()
+        result = []
+        for i in order:
+            key = expressions[i].structural_key()
+            fingerprint = self.fingerprint(expressions[i])
+            if i in candidates and (key in keys or fingerprint in fingerprints):
+                result.append(i)
+                continue
+            keys.add(key)
+            if fingerprint is not None:
+                fingerprints.add(fingerprint)
+        return np.array(result, dtype=np.int64)
+
+
 class ExpressionMutator:
     """
     This class encapsulates all logic for mutating selected lymphocytes.
+    Mutations are copy-on-write: only the nodes on the path from the root
+    to the changed node are copied, all other subtrees are shared between
+    the original expression and the mutated one. So nodes of the
+    expression trees must not be changed in place.
     """
 
     def __init__(self, expression):
@@ -44,7 +562,7 @@ class ExpressionMutator:
         NOTE: expression itself won't be changed. Instead of its
         changing, the new expression will be returned.
         """
-        self.expression = copy.deepcopy(expression)
+        self.expression = expression
         self.mutations = [
             self.number_mutation,
             self.variable_mutation,
@@ -57,6 +575,7 @@ class ExpressionMutator:
         Returns the mutated version of the expression.
         All mutations are of equal possibilities.
         May be change.
+        If there is nothing to mutate, the expression itself is returned.
         """
         mutation = random.choice(self.mutations)
         mutation()
@@ -67,10 +586,10 @@ class ExpressionMutator:
         USed for mutate number nodes. Adds or subtracts random number from
         the value or
         """
-        numbers = self._get_all_nodes_by_filter(lambda n: n.is_number())
+        numbers = self.expression.get_paths_by_kind()[Operations._number]
         if not numbers: return
 
-        selected_node = random.choice(numbers)
+        selected_node = self._copy_path(random.choice(numbers))[-1]
         if random.random() < 0.45:
             selected_node.value += random.random()
         elif random.random() < 0.9:
@@ -83,30 +602,30 @@ class ExpressionMutator:
         Changes one randomly selected variable to another, also
         randomly selected.
         """
-        variables = self._get_all_nodes_by_filter(lambda n: n.is_variable())
+        variables = self.expression.get_paths_by_kind()[Operations._variable]
         if not variables: return
 
-        selected_var = random.choice(variables)
+        selected_var = self._copy_path(random.choice(variables))[-1]
         selected_var.value = random.choice(self.expression.variables)
 
     def unary_mutation(self):
         """
         Changes one unary operation to another
         """
-        unary_operations = self._get_all_nodes_by_filter(lambda n: n.is_unary())
+        unary_operations = self.expression.get_paths_by_kind()[Operations._unary_operation]
         if not unary_operations: return
 
-        selected_unary = random.choice(unary_operations)
+        selected_unary = self._copy_path(random.choice(unary_operations))[-1]
         selected_unary.operation = random.choice(Operations.get_unary_operations())
 
     def binary_mutation(self):
         """
         Changes one binary operations to another
         """
-        binary_operations = self._get_all_nodes_by_filter(lambda n: n.is_binary())
+        binary_operations = self.expression.get_paths_by_kind()[Operations._binary_operation]
         if not binary_operations: return
 
-        selected_binary = random.choice(binary_operations)
+        selected_binary = self._copy_path(random.choice(binary_operations))[-1]
         selected_binary.operation = random.choice(Operations.get_binary_operations())
 
     def subtree_mutation(self):
@@ -114,35 +633,108 @@ class ExpressionMutator:
         Changes one randomly selected node to the randomly generated subtree.
         The height of the tree isn't changed.
         """
-        nodes = self._get_all_nodes_by_filter(lambda n: n.height() > 1 and
-                                                        n != self.expression.root)
-        if not nodes: return
+        #all unary and binary operations except the root
+        paths = self.expression.get_paths_by_kind()
+        unary_operations = paths[Operations._unary_operation]
+        binary_operations = paths[Operations._binary_operation]
+        number_of_operations = len(unary_operations) + len(binary_operations)
+        if number_of_operations <= 1: return
 
-        selected_node = random.choice(nodes)
-        max_height = self.expression.root.height() - selected_node.height()
+        path = ()
+        while not path:
+            i = random.randrange(number_of_operations)
+            path = unary_operations[i] if i < len(unary_operations) else \
+                binary_operations[i - len(unary_operations)]
+
+        max_height = self.expression.root.height() - len(path)
+        copied_nodes = self._copy_path(path)
+        selected_node = copied_nodes[-1]
         new_subtree = Expression.generate_random(max_height, self.expression.variables)
         selected_node.operation = new_subtree.root.operation
         selected_node.value = new_subtree.root.value
         selected_node.left = new_subtree.root.left
         selected_node.right = new_subtree.root.right
+        for node in reversed(copied_nodes):
+            node.update_metadata()
+
+        #replace paths of the old subtree by the paths of the new one: paths
+        #are sorted, so the old ones are found by the binary search
+        subtree_paths = dict((kind, []) for kind in paths)
+        selected_node.add_paths_by_kind(subtree_paths, path)
+        end = path + ('~',)
+        new_paths = {}
+        for (kind, kind_paths) in paths.items():
+            start = bisect.bisect_left(kind_paths, path)
+            stop = bisect.bisect_left(kind_paths, end, start)
+            new_paths[kind] = kind_paths[:start] + subtree_paths[kind] + kind_paths[stop:]
+        self.expression = Expression(root=self.expression.root,
+                                     variables=self.expression.variables,
+                                     paths_by_kind=new_paths)
 
-    def _get_all_nodes_by_filter(self, filter_func):
+    def _copy_path(self, path):
         """
-        Used for selecting all nodes satisfying the given filter.
+        Replaces expression by the new one, where all nodes on the given path
+        are copied and all other subtrees are shared with the old expression.
+        Returns list of the copied nodes from the root to the last node of
+        the path - they may be changed.
+        path - sequence of 'left' and 'right' from the root.
+        The new expression has the same paths to the nodes as the old one.
         """
-        nodes = []
+        nodes = [self._copy_node(self.expression.root)]
+        for direction in path:
+            child = self._copy_node(getattr(nodes[-1], direction))
+            setattr(nodes[-1], direction, child)
+            nodes.append(child)
+        self.expression = Expression(root=nodes[0],
+                                     variables=self.expression.variables,
+                                     paths_by_kind=self.expression.get_paths_by_kind())
+        return nodes
 
-        def traverse_tree(node):
-            if filter_func(node):
-                nodes.append(node)
-            if node.left is not None:
-                traverse_tree(node.left)
-            if node.right is not None:
-                traverse_tree(node.right)
+    def _copy_node(self, node):
+        return Node(node.operation, left=node.left, right=node.right, value=node.value)
 
-        traverse_tree(self.expression.root)
 
-        return nodes
+class TruncationSelection:
+    """
+    Selects the given number of the best lymphocytes.
+    Only partial sorting (numpy.argpartition) is used, so the selected
+    lymphocytes are not ordered.
+    """
+
+    def select(self, fitness_values, number):
+        """
+        Returns indices of the selected lymphocytes.
+        fitness_values - NumPy array of the lymphocytes fitness values.
+        """
+        if number >= len(fitness_values):
+            return np.arange(len(fitness_values))
+        return np.argpartition(fitness_values, number - 1)[:number]
+
+
+class TournamentSelection:
+    """
+    Selects lymphocytes by tournaments: every time the best of
+    tournament_size randomly chosen lymphocytes is selected. The best
+    lymphocyte of the system is always selected first, so it isn't lost.
+    The same lymphocyte may be selected several times.
+    """
+
+    def __init__(self, tournament_size):
+        self.tournament_size = tournament_size
+
+    def select(self, fitness_values, number):
+        """
+        Returns indices of the selected lymphocytes.
+        fitness_values - NumPy array of the lymphocytes fitness values.
+        """
+        if number <= 0 or not len(fitness_values):
+            return np.arange(0)
+        candidates = np.array([random.randrange(len(fitness_values))
+                               for i in range(0, (number - 1) * self.tournament_size)],
+                              dtype=np.int64).reshape(number - 1, self.tournament_size)
+        winners = candidates[np.arange(len(candidates)),
+                             np.argmin(fitness_values[candidates], axis=1)]
+        return np.concatenate([[np.argmin(fitness_values)], winners])
 
 
 class ExpressionsImmuneSystemConfig:
@@ -159,27 +751,128 @@ class ExpressionsImmuneSystemConfig:
     _number_of_iterations_default = 100
     _number_of_iterations_to_exchange_default = 25
     _maximal_height_default = 4
+    _vectorized_evaluation_default = True
+    _fitness_cache_size_default = 10000
+    _number_of_workers_default = 1
+    _compact_population_default = False
+    _initialization_method_default = Expression.FULL
+    _selection_default = 'truncation'
+    _tournament_size_default = 3
+    _chunk_size_default = 65536
+    _progressive_evaluation_default = False
+    _first_subset_size_default = 256
+    _racing_fraction_default = 1.0
+    _topology_default = 'fully_connected'
+    _nodes_per_exchange_default = 3
+    _number_of_migrants_default = 0
+    _emigrants_selection_default = 'top'
+    _immigrants_replacement_default = 'worst'
+    _asynchronous_migration_default = False
+    _max_staleness_default = 50
+    _checkpoint_interval_default = 0
+    _checkpoint_filename_default = 'checkpoint.bin'
+    _constant_optimization_default = 0
+    _constant_optimization_iterations_default = 10
+    _deduplication_default = False
+    _probe_size_default = 16
 
-    def __init__(self):
+    def __init__(self, filename=_filename):
         """
         Initializes config object with values retrieved from config file.
+        filename - None to use only default values.
         """
-        try:
-            file = open(ExpressionsImmuneSystemConfig._filename)
-            config = json.load(file)
-            file.close()
-        except IOError:
-            config = None
+        config = None
+        if filename is not None:
+            try:
+                file = open(filename)
+                config = json.load(file)
+                file.close()
+            except IOError:
+                pass
         if config is None:
             self.number_of_lymphocytes = ExpressionsImmuneSystemConfig._number_of_lymphocytes_default
             self.number_of_iterations = ExpressionsImmuneSystemConfig._number_of_iterations_default
             self.number_of_iterations_to_exchange = ExpressionsImmuneSystemConfig._number_of_iterations_to_exchange_default
             self.maximal_height = ExpressionsImmuneSystemConfig._maximal_height_default
+            self.vectorized_evaluation = ExpressionsImmuneSystemConfig._vectorized_evaluation_default
+            self.fitness_cache_size = ExpressionsImmuneSystemConfig._fitness_cache_size_default
+            self.number_of_workers = ExpressionsImmuneSystemConfig._number_of_workers_default
+            self.compact_population = ExpressionsImmuneSystemConfig._compact_population_default
+            self.initialization_method = ExpressionsImmuneSystemConfig._initialization_method_default
+            self.selection = ExpressionsImmuneSystemConfig._selection_default
+            self.tournament_size = ExpressionsImmuneSystemConfig._tournament_size_default
+            self.chunk_size = ExpressionsImmuneSystemConfig._chunk_size_default
+            self.progressive_evaluation = ExpressionsImmuneSystemConfig._progressive_evaluation_default
+            self.first_subset_size = ExpressionsImmuneSystemConfig._first_subset_size_default
+            self.racing_fraction = ExpressionsImmuneSystemConfig._racing_fraction_default
+            self.topology = ExpressionsImmuneSystemConfig._topology_default
+            self.nodes_per_exchange = ExpressionsImmuneSystemConfig._nodes_per_exchange_default
+            self.number_of_migrants = ExpressionsImmuneSystemConfig._number_of_migrants_default
+            self.emigrants_selection = ExpressionsImmuneSystemConfig._emigrants_selection_default
+            self.immigrants_replacement = ExpressionsImmuneSystemConfig._immigrants_replacement_default
+            self.asynchronous_migration = ExpressionsImmuneSystemConfig._asynchronous_migration_default
+            self.max_staleness = ExpressionsImmuneSystemConfig._max_staleness_default
+            self.checkpoint_interval = ExpressionsImmuneSystemConfig._checkpoint_interval_default
+            self.checkpoint_filename = ExpressionsImmuneSystemConfig._checkpoint_filename_default
+            self.constant_optimization = ExpressionsImmuneSystemConfig._constant_optimization_default
+            self.constant_optimization_iterations = \
+                ExpressionsImmuneSystemConfig._constant_optimization_iterations_default
+            self.deduplication = ExpressionsImmuneSystemConfig._deduplication_default
+            self.probe_size = ExpressionsImmuneSystemConfig._probe_size_default
         else:
             self.number_of_lymphocytes = config['number_of_lymphocytes']
             self.number_of_iterations = config['number_of_iterations']
             self.number_of_iterations_to_exchange = config['number_of_iterations_to_exchange']
             self.maximal_height = config['maximal_height']
+            self.vectorized_evaluation = config.get(
+                'vectorized_evaluation', ExpressionsImmuneSystemConfig._vectorized_evaluation_default)
+            self.fitness_cache_size = config.get(
+                'fitness_cache_size', ExpressionsImmuneSystemConfig._fitness_cache_size_default)
+            self.number_of_workers = config.get(
+                'number_of_workers', ExpressionsImmuneSystemConfig._number_of_workers_default)
+            self.compact_population = config.get(
+                'compact_population', ExpressionsImmuneSystemConfig._compact_population_default)
+            self.initialization_method = config.get(
+                'initialization_method', ExpressionsImmuneSystemConfig._initialization_method_default)
+            self.selection = config.get(
+                'selection', ExpressionsImmuneSystemConfig._selection_default)
+            self.tournament_size = config.get(
+                'tournament_size', ExpressionsImmuneSystemConfig._tournament_size_default)
+            self.chunk_size = config.get(
+                'chunk_size', ExpressionsImmuneSystemConfig._chunk_size_default)
+            self.progressive_evaluation = config.get(
+                'progressive_evaluation', ExpressionsImmuneSystemConfig._progressive_evaluation_default)
+            self.first_subset_size = config.get(
+                'first_subset_size', ExpressionsImmuneSystemConfig._first_subset_size_default)
+            self.racing_fraction = config.get(
+                'racing_fraction', ExpressionsImmuneSystemConfig._racing_fraction_default)
+            self.topology = config.get(
+                'topology', ExpressionsImmuneSystemConfig._topology_default)
+            self.nodes_per_exchange = config.get(
+                'nodes_per_exchange', ExpressionsImmuneSystemConfig._nodes_per_exchange_default)
+            self.number_of_migrants = config.get(
+                'number_of_migrants', ExpressionsImmuneSystemConfig._number_of_migrants_default)
+            self.emigrants_selection = config.get(
+                'emigrants_selection', ExpressionsImmuneSystemConfig._emigrants_selection_default)
+            self.immigrants_replacement = config.get(
+                'immigrants_replacement', ExpressionsImmuneSystemConfig._immigrants_replacement_default)
+            self.asynchronous_migration = config.get(
+                'asynchronous_migration', ExpressionsImmuneSystemConfig._asynchronous_migration_default)
+            self.max_staleness = config.get(
+                'max_staleness', ExpressionsImmuneSystemConfig._max_staleness_default)
+            self.checkpoint_interval = config.get(
+                'checkpoint_interval', ExpressionsImmuneSystemConfig._checkpoint_interval_default)
+            self.checkpoint_filename = config.get(
+                'checkpoint_filename', ExpressionsImmuneSystemConfig._checkpoint_filename_default)
+            self.constant_optimization = config.get(
+                'constant_optimization', ExpressionsImmuneSystemConfig._constant_optimization_default)
+            self.constant_optimization_iterations = config.get(
+                'constant_optimization_iterations',
+                ExpressionsImmuneSystemConfig._constant_optimization_iterations_default)
+            self.deduplication = config.get(
+                'deduplication', ExpressionsImmuneSystemConfig._deduplication_default)
+            self.probe_size = config.get(
+                'probe_size', ExpressionsImmuneSystemConfig._probe_size_default)
 
     def save(self):
         """
@@ -189,7 +882,31 @@ class ExpressionsImmuneSystemConfig:
         config = {'number_of_lymphocytes': self.number_of_lymphocytes,
                   'number_of_iterations': self.number_of_iterations,
                   'number_of_iterations_to_exchange': self.number_of_iterations_to_exchange,
-                  'maximal_height': self.maximal_height}
+                  'maximal_height': self.maximal_height,
+                  'vectorized_evaluation': self.vectorized_evaluation,
+                  'fitness_cache_size': self.fitness_cache_size,
+                  'number_of_workers': self.number_of_workers,
+                  'compact_population': self.compact_population,
+                  'initialization_method': self.initialization_method,
+                  'selection': self.selection,
+                  'tournament_size': self.tournament_size,
+                  'chunk_size': self.chunk_size,
+                  'progressive_evaluation': self.progressive_evaluation,
+                  'first_subset_size': self.first_subset_size,
+                  'racing_fraction': self.racing_fraction,
+                  'topology': self.topology,
+                  'nodes_per_exchange': self.nodes_per_exchange,
+                  'number_of_migrants': self.number_of_migrants,
+                  'emigrants_selection': self.emigrants_selection,
+                  'immigrants_replacement': self.immigrants_replacement,
+                  'asynchronous_migration': self.asynchronous_migration,
+                  'max_staleness': self.max_staleness,
+                  'checkpoint_interval': self.checkpoint_interval,
+                  'checkpoint_filename': self.checkpoint_filename,
+                  'constant_optimization': self.constant_optimization,
+                  'constant_optimization_iterations': self.constant_optimization_iterations,
+                  'deduplication': self.deduplication,
+                  'probe_size': self.probe_size}
         json.dump(config, file)
         file.close()
 
@@ -201,30 +918,171 @@ class ExpressionsImmuneSystem:
     On each step the best lymphocytes are selected for the mutation.
     """
 
-    def __init__(self, exact_values, variables, exchanger, config):
+    def __init__(self, exact_values, variables, exchanger, config, dataset=None, data_filename=None,
+                 instrumentation=None, checkpoint=None):
         """
         Initializes the immune system with the exact_values, list of variables,
         exchanger object and config object.
+        dataset - tuple (columns, exact) (see DataFileStorageHelper), may be
+        passed instead of exact_values, e.g. when it is loaded from the
+        binary file. Then the vectorized evaluation is always used.
+        data_filename - name of the data file (text or binary), may be passed
+        instead of exact_values for datasets that don't fit in memory: it is
+        read by chunks of config.chunk_size points on every evaluation
+        (see StreamingFitnessFunction).
         lymphocytes - list that stores current value of the whole system.
+        fitness_cache - stores fitness values of already seen lymphocytes,
+        its hits and misses show how often values are reused.
+        If config.number_of_workers > 1, lymphocytes are scored by the pool
+        of worker processes, call close when the system isn't needed anymore.
+        If config.compact_population is True, all lymphocytes are stored in
+        population object (see Population) and lymphocytes list contains
+        compiled views of its trees.
+        fitness_values - NumPy array of the lymphocytes fitness values
+        (NaN - not calculated yet).
+        config.selection - 'truncation' (see TruncationSelection) or
+        'tournament' (see TournamentSelection).
+        If config.progressive_evaluation is True (and the dataset is in memory
+        of this process), new lymphocytes are scored by
+        ProgressiveFitnessFunction: the ones that are worse than the worst
+        survivor are rejected early and get inf fitness value. It is ignored
+        if config.number_of_workers > 1 (workers score the whole dataset).
+        Lymphocytes are rejected only by truncation selection, tournament
+        may select any of them, so all values are exact then.
+        If config.number_of_migrants > 0, only this number of lymphocytes
+        is given to the exchanger (config.emigrants_selection - 'top',
+        'random' or 'diversity', see migration module) and received
+        lymphocytes replace the existing ones (config.immigrants_replacement -
+        'worst' or 'random'). Otherwise all lymphocytes are exchanged and
+        the best of both populations are kept. config.topology is used by
+        the nodes manager (see migration.create_topology) and
+        config.nodes_per_exchange - by the exchanger that requests
+        lymphocytes from several nodes at once (see AsyncPeerToPeerExchanger).
+        If config.asynchronous_migration is True and the exchanger has
+        get_migrants method (see AsyncPeerToPeerExchanger), the exchanging
+        step only gives lymphocytes to the exchanger and the usual step is
+        done. Received lymphocytes are taken after every step if there are
+        any, lymphocytes sent more than config.max_staleness generations ago
+        are ignored.
+        generation - number of the current step.
+        instrumentation - if given (see Instrumentation), time of the phases
+        (scoring, selection, mutation, exchange, simplify) and number of
+        evaluations are measured and observers are notified after every
+        generation of solve.
+        If config.checkpoint_interval > 0, the checkpoint (see Checkpoint) is
+        written to config.checkpoint_filename in the background after every
+        config.checkpoint_interval generations of solve.
+        checkpoint - if given, lymphocytes, their fitness values and random
+        state are restored from it and solve continues from the next
+        generation.
+        If config.constant_optimization > 0, numbers of this number of the
+        best lymphocytes are fitted by ConstantOptimizer on every step (only
+        if the dataset is in memory). Every lymphocyte is fitted only once
+        (keys of config.fitness_cache_size last fitted ones are stored).
+        If config.deduplication is True, new lymphocytes that are duplicates
+        of the other ones (see Deduplicator, config.probe_size - number of
+        the probe points) get inf fitness value without evaluation, so they
+        are dropped by the next selection.
         """
         self.exact_values = exact_values
         self.variables = variables
-        self.fitness_function = FitnessFunction(exact_values)
         self.exchanger = exchanger
+        self.generation = 0
+        self.instrumentation = instrumentation if instrumentation is not None else NullInstrumentation()
 
         #config
         self.config = config
 
-        self.lymphocytes = []
-        for i in range(0, self.config.number_of_lymphocytes):
-            self.lymphocytes.append(Expression.generate_random(
-                self.config.maximal_height,
-                variables))
+        self.parallel_evaluator = None
+        self.progressive_fitness_function = None
+        batch_fitness_function = None
+        if data_filename is not None:
+            self.fitness_function = StreamingFitnessFunction(data_filename, self.config.chunk_size)
+            batch_fitness_function = self.fitness_function.values
+        elif dataset is not None or self.config.vectorized_evaluation or self.config.number_of_workers > 1:
+            if dataset is None:
+                dataset = DataFileStorageHelper.values_to_columns(variables, exact_values)
+            columns, exact = dataset
+            self.fitness_function = VectorizedFitnessFunction(columns, exact)
+            if self.config.number_of_workers > 1:
+                self.parallel_evaluator = ParallelFitnessEvaluator(columns, exact, variables,
+                                                                   self.config.number_of_workers)
+                batch_fitness_function = self.parallel_evaluator
+            elif self.config.progressive_evaluation:
+                self.progressive_fitness_function = ProgressiveFitnessFunction(
+                    columns, exact, self.config.first_subset_size, self.config.racing_fraction)
+                batch_fitness_function = self.progressive_fitness_function.values
+        else:
+            self.fitness_function = FitnessFunction(exact_values)
+        self.fitness_cache = FitnessCache(self.fitness_function, self.config.fitness_cache_size,
+                                          batch_fitness_function)
+
+        self.constant_optimizer = None
+        #structural keys of fitted lymphocytes, the least recently used are removed
+        self._optimized_keys = OrderedDict()
+        if self.config.constant_optimization > 0 and data_filename is None:
+            if dataset is None:
+                dataset = DataFileStorageHelper.values_to_columns(variables, exact_values)
+            self.constant_optimizer = ConstantOptimizer(dataset[0], dataset[1],
+                                                        self.config.constant_optimization_iterations)
+
+        self.deduplicator = None
+        if self.config.deduplication:
+            if data_filename is not None:
+                probe_columns = next(DataFileStorageHelper.iterate_chunks(data_filename, self.config.probe_size))[0]
+            elif dataset is not None:
+                probe_columns = Deduplicator.probe(dataset[0], self.config.probe_size)
+            else:
+                probe_columns = Deduplicator.probe(
+                    DataFileStorageHelper.values_to_columns(variables, exact_values)[0], self.config.probe_size)
+            self.deduplicator = Deduplicator(probe_columns, max_size=self.config.fitness_cache_size)
+
+        self.first_generation = 0
+        self.population = None
+        if checkpoint is not None:
+            if self.config.compact_population:
+                self.population = checkpoint.population
+                self.lymphocytes = self.population.trees()
+            else:
+                self.lymphocytes = checkpoint.population.to_expressions()
+            self.fitness_values = np.array(checkpoint.fitness_values, dtype=np.float64)
+            self.first_generation = checkpoint.generation + 1
+        else:
+            self.lymphocytes = Expression.generate_random_batch(self.config.number_of_lymphocytes,
+                                                                self.config.maximal_height,
+                                                                variables,
+                                                                self.config.initialization_method)
+            if self.config.compact_population:
+                self.population = Population.from_expressions(self.lymphocytes, variables)
+                self.lymphocytes = self.population.trees()
+            self.fitness_values = np.full(len(self.lymphocytes), np.nan)
+
+        self.checkpoint_writer = None
+        if self.config.checkpoint_interval > 0:
+            self.checkpoint_writer = CheckpointWriter(self.config.checkpoint_filename)
+
+        if self.config.selection == 'tournament':
+            self.selection = TournamentSelection(self.config.tournament_size)
+        else:
+            self.selection = TruncationSelection()
+
+        if self.config.emigrants_selection == 'random':
+            self.emigrants_selection = RandomEmigrantsSelection()
+        elif self.config.emigrants_selection == 'diversity':
+            self.emigrants_selection = DiversityEmigrantsSelection()
+        else:
+            self.emigrants_selection = TopEmigrantsSelection()
+        if self.config.immigrants_replacement == 'random':
+            self.immigrants_replacement = ReplaceRandomPolicy()
+        else:
+            self.immigrants_replacement = ReplaceWorstPolicy()
 
         #Initialize Exchanger with the first generated lymphocytes
-        self.exchanger.set_lymphocytes_to_exchange(self.lymphocytes[:])
+        self.exchanger.set_lymphocytes_to_exchange(self._get_lymphocytes_to_exchange())
 
         random.seed()
+        if checkpoint is not None:
+            random.setstate(checkpoint.random_state)
 
     def solve(self, accuracy=0.001):
         """
@@ -234,75 +1092,330 @@ class ExpressionsImmuneSystem:
 
         def return_best():
             best = self.best()
-            best.simplify()
+            with self.instrumentation.timer('simplify'):
+                best.simplify()
             return best
 
-        for i in range(0, self.config.number_of_iterations):
+        asynchronous = self._is_migration_asynchronous()
+        for i in range(self.first_generation, self.config.number_of_iterations):
+            if self.instrumentation.enabled:
+                started = time.perf_counter()
+                evaluations = self.instrumentation.get_count('evaluations')
+                scoring = self.instrumentation.get_time('scoring')
+            self.generation = i
             #if we reach exchanging step
             if i != 0 and i % self.config.number_of_iterations_to_exchange == 0:
                 self.exchanging_step()
             else:
                 self.step()
-            best = self.best()
-            if self.fitness_function(best) <= accuracy:
+            if asynchronous:
+                self.receive_migrants()
+            best_fitness = self.best_fitness()
+            if self.instrumentation.enabled:
+                self._report_generation(time.perf_counter() - started,
+                                        self.instrumentation.get_count('evaluations') - evaluations,
+                                        self.instrumentation.get_time('scoring') - scoring)
+            if (self.checkpoint_writer is not None and
+                    (i + 1) % self.config.checkpoint_interval == 0):
+                self.checkpoint_writer.write(self.get_checkpoint())
+            if best_fitness <= accuracy:
                 return return_best()
 
         return return_best()
 
+    def get_checkpoint(self):
+        """
+        Returns checkpoint of the current state (see Checkpoint).
+        It's a snapshot: arrays are copied (values of the population are
+        changed in place by the constant optimization), so it can be encoded
+        later in the background (see CheckpointWriter).
+        """
+        if self.population is not None:
+            population = Population(self.population.codes.copy(), self.population.values.copy(),
+                                    self.population.left.copy(), self.population.offsets.copy(),
+                                    list(self.population.variables))
+        else:
+            population = Population.from_expressions(self.lymphocytes, list(self.variables))
+        return Checkpoint(self.generation, population, self._get_fitness_values().copy(), random.getstate())
+
     def step(self):
         """
         Represents the step of the solution finding.
         The half of the lymphocytes are mutated. The new system
         consists of this half and their mutated 'children'.
         """
-        sorted_lymphocytes = self._get_sorted_lymphocytes_index_and_value()
-        best = []
-        for (i, e) in sorted_lymphocytes[:self.config.number_of_lymphocytes // 2]:
-            best.append(self.lymphocytes[i])
-        mutated = [ExpressionMutator(e).mutation() for e in best]
-        self.lymphocytes = best + mutated
+        fitness_values = self._get_fitness_values()
+        with self.instrumentation.timer('selection'):
+            self._keep(self.selection.select(fitness_values, self.config.number_of_lymphocytes // 2))
+        if self.constant_optimizer is not None:
+            with self.instrumentation.timer('constant_optimization'):
+                self._optimize_constants()
+        with self.instrumentation.timer('mutation'):
+            self._add_mutated()
 
     def exchanging_step(self):
         """
         Represents the step when we're getting lymphocytes from the other node.
         Take some lymphocytes from the exchanger and merge them with current available.
         Also set new lymphocytes to exchange (exactly - copy of them)
+        If the migration is asynchronous, lymphocytes are only given to
+        the exchanger and the usual step is done.
         """
-        self.exchanger.set_lymphocytes_to_exchange(self.lymphocytes[:])
-        others = self.exchanger.get_lymphocytes()
-        self.lymphocytes = self.lymphocytes + others
+        if self._is_migration_asynchronous():
+            emigrants = self._get_lymphocytes_to_exchange()
+            with self.instrumentation.timer('exchange'):
+                self.exchanger.set_lymphocytes_to_exchange(emigrants, self.generation)
+            self.step()
+            return
 
-        #get only best - as many as we need
-        sorted_lymphocytes = self._get_sorted_lymphocytes_index_and_value()
-        best = []
-        for (i, e) in sorted_lymphocytes[:self.config.number_of_lymphocytes]:
-            best.append(self.lymphocytes[i])
+        emigrants = self._get_lymphocytes_to_exchange()
+        with self.instrumentation.timer('exchange'):
+            self.exchanger.set_lymphocytes_to_exchange(emigrants)
+            others = self.exchanger.get_lymphocytes()
+        self._accept_migrants(others)
+
+    def receive_migrants(self):
+        """
+        Adds lymphocytes received by the exchanger since the previous call
+        (if there are any and they are not stale). Never waits.
+        """
+        with self.instrumentation.timer('exchange'):
+            migrants = self.exchanger.get_migrants(self.generation, self.config.max_staleness)
+        if migrants:
+            self._accept_migrants(migrants)
+
+    def _is_migration_asynchronous(self):
+        return self.config.asynchronous_migration and hasattr(self.exchanger, 'get_migrants')
+
+    def _accept_migrants(self, others):
+        """
+        Adds lymphocytes received from the other nodes: they replace
+        the existing ones or the best of all lymphocytes are kept
+        (see config.number_of_migrants).
+        """
+        if self.config.number_of_migrants > 0:
+            others = others[:self.config.number_of_migrants]
+            replaced = self.immigrants_replacement.select(self._get_fitness_values(), len(others))
+            self._keep(np.setdiff1d(np.arange(len(self.lymphocytes)), replaced))
+            self._add(others)
+            return
 
-        self.lymphocytes = best
+        self._add(others)
+
+        #get only best - as many as we need
+        self._keep(self.selection.select(self._get_fitness_values(),
+                                         self.config.number_of_lymphocytes))
 
     def best(self):
         """
         Returns the best lymphocyte in the system.
         """
-        return self.lymphocytes[self._get_sorted_lymphocytes_index_and_value()[0][0]]
+        i = int(np.argmin(self._get_fitness_values()))
+        if self.population is not None:
+            return self.population.expression(i)
+        return self.lymphocytes[i]
 
-    def _get_sorted_lymphocytes_index_and_value(self):
+    def best_fitness(self):
         """
-        Returns list of lymphocytes and their numbers in the original system
-        in sorted order.
+        Returns fitness value of the best lymphocyte in the system.
         """
-        fitness_values = []
-        for (i, e) in enumerate(self.lymphocytes):
-            fitness_values.append((i, self.fitness_function(e)))
-        return sorted(fitness_values, key=lambda item: item[1])
+        return float(np.min(self._get_fitness_values()))
+
+    def set_lymphocytes(self, expressions):
+        """
+        Replaces all lymphocytes by the given expressions, their fitness
+        values are calculated when needed.
+        """
+        self.fitness_values = np.full(len(expressions), np.nan)
+        if self.population is not None:
+            self.population = Population.from_expressions(expressions, self.population.variables)
+            self.lymphocytes = self.population.trees()
+        else:
+            self.lymphocytes = list(expressions)
+
+    def _keep(self, indices):
+        """
+        Leaves in the system only lymphocytes with the given indices.
+        """
+        self.fitness_values = self._get_fitness_values()[indices]
+        if self.population is not None:
+            self.population = self.population.select(indices)
+            self.lymphocytes = self.population.trees()
+        else:
+            self.lymphocytes = [self.lymphocytes[i] for i in indices]
+
+    def _add_mutated(self):
+        """
+        Adds mutated 'child' of every lymphocyte to the system.
+        """
+        self.fitness_values = np.concatenate([self.fitness_values, np.full(len(self.lymphocytes), np.nan)])
+        if self.population is not None:
+            self.population = self.population.concatenate(self.population.mutated())
+            self.lymphocytes = self.population.trees()
+        else:
+            self.lymphocytes = self.lymphocytes + [ExpressionMutator(e).mutation()
+                                                   for e in self.lymphocytes]
+
+    def _add(self, expressions):
+        """
+        Adds given expressions to the system.
+        """
+        self.fitness_values = np.concatenate([self.fitness_values, np.full(len(expressions), np.nan)])
+        if self.population is not None:
+            self.population = self.population.concatenate(
+                Population.from_expressions(expressions, self.population.variables))
+            self.lymphocytes = self.population.trees()
+        else:
+            self.lymphocytes = self.lymphocytes + expressions
+
+    def _optimize_constants(self):
+        """
+        Fits numbers of the best lymphocytes (see config.constant_optimization),
+        lymphocytes are replaced only if their fitness values are improved.
+        """
+        evaluations = self.constant_optimizer.evaluations
+        fitness_values = self._get_fitness_values()
+        number = min(self.config.constant_optimization, len(fitness_values))
+        if number <= 0:
+            return
+        #only the best are sorted (by value, then by index as the stable sort)
+        best = np.argpartition(fitness_values, number - 1)[:number]
+        best = best[np.lexsort((best, fitness_values[best]))]
+        changed = False
+        for i in best.tolist():
+            key = self.lymphocytes[i].structural_key()
+            if key in self._optimized_keys:
+                self._optimized_keys.move_to_end(key)
+                continue
+            (compiled, fitness) = self.constant_optimizer.optimize(self.lymphocytes[i], fitness_values[i])
+            self._optimized_keys[compiled.structural_key()] = True
+            self._optimized_keys.move_to_end(compiled.structural_key())
+            while len(self._optimized_keys) > self.config.fitness_cache_size:
+                self._optimized_keys.popitem(last=False)
+            if fitness >= fitness_values[i]:
+                continue
+            fitness_values[i] = fitness
+            changed = True
+            if self.population is not None:
+                #the structure isn't changed, so only numbers are replaced
+                numbers = compiled.numbers()
+                self.population.values[self.population.offsets[i] + numbers] = np.asarray(compiled.args)[numbers]
+            else:
+                self.lymphocytes[i] = Expression.from_compiled(compiled, self.lymphocytes[i].variables)
+        if changed and self.population is not None:
+            self.lymphocytes = self.population.trees()
+        self.instrumentation.count('evaluations', self.constant_optimizer.evaluations - evaluations)
+
+    def _get_lymphocytes_to_exchange(self):
+        """
+        Returns lymphocytes to be given to the other nodes: all of them
+        or only selected migrants (see config.number_of_migrants).
+        """
+        if self.config.number_of_migrants <= 0:
+            return self._get_expressions()
+        indices = self.emigrants_selection.select(self.lymphocytes, self._get_fitness_values(),
+                                                  self.config.number_of_migrants)
+        if self.population is not None:
+            return [self.population.expression(i) for i in indices]
+        return [self.lymphocytes[i] for i in indices]
+
+    def _get_expressions(self):
+        """
+        Returns copy of the lymphocytes list as expressions.
+        """
+        if self.population is not None:
+            return self.population.to_expressions()
+        return self.lymphocytes[:]
+
+    def _get_fitness_values(self):
+        """
+        Returns fitness values of all lymphocytes, calculates only unknown
+        values.
+        """
+        unknown = np.flatnonzero(np.isnan(self.fitness_values))
+        if len(unknown) and self.deduplicator is not None:
+            with self.instrumentation.timer('deduplication'):
+                duplicates = self.deduplicator.duplicates(self.lymphocytes, unknown)
+            self.instrumentation.count('duplicates', len(duplicates))
+            self.fitness_values[duplicates] = np.inf
+            unknown = np.setdiff1d(unknown, duplicates)
+        if len(unknown):
+            misses = self.fitness_cache.misses
+            with self.instrumentation.timer('scoring'):
+                values = np.array(self.fitness_cache.values([self.lymphocytes[i] for i in unknown],
+                                                            self._get_rejection_threshold()),
+                                  dtype=np.float64)
+            self.instrumentation.count('evaluations', self.fitness_cache.misses - misses)
+            values[np.isnan(values)] = np.inf
+            self.fitness_values[unknown] = values
+        return self.fitness_values
+
+    def _report_generation(self, seconds, evaluations, scoring_seconds):
+        """
+        Notifies observers of the instrumentation about the finished generation.
+        """
+        fitness_values = self._get_fitness_values()
+        record = {'generation': self.generation,
+                  'seconds': seconds,
+                  'best': float(np.min(fitness_values)),
+                  'median': float(np.median(fitness_values)),
+                  'evaluations': evaluations,
+                  'evaluations_per_second': evaluations / scoring_seconds if scoring_seconds > 0 else 0.0,
+                  'cache_hit_rate': self.fitness_cache.hit_rate()}
+        record.update(self.instrumentation.snapshot())
+        self.instrumentation.generation(record)
+
+    def _get_rejection_threshold(self):
+        """
+        Returns threshold for the progressive evaluation of unknown fitness
+        values or None if they must be calculated exactly.
+        The threshold is the worst known finite value: when there are at
+        least as many such values as the selection keeps, new lymphocytes
+        that are worse than all of them are never selected. Infinite values
+        (rejected lymphocytes and duplicates, see Deduplicator) are skipped.
+        Only truncation selection never selects the worse lymphocytes, so
+        None is returned for the other ones.
+        """
+        if self.progressive_fitness_function is None or not isinstance(self.selection, TruncationSelection):
+            return None
+        known = self.fitness_values[np.isfinite(self.fitness_values)]
+        if not len(known) or len(known) < self.config.number_of_lymphocytes // 2:
+            return None
+        return float(np.max(known))
+
+    def close(self):
+        """
+        Stops worker processes if they were started and waits until
+        the last checkpoint is written. Raises the error of the checkpoint
+        writing if it failed (see CheckpointWriter).
+        """
+        try:
+            if self.checkpoint_writer is not None:
+                writer, self.checkpoint_writer = self.checkpoint_writer, None
+                writer.close()
+        finally:
+            if self.parallel_evaluator is not None:
+                self.parallel_evaluator.close()
+                self.parallel_evaluator = None
 
 
 class DataFileStorageHelper:
     """
     This helper class is used for storing exact function values in file and
     retrieving them.
+    Two formats are supported: the text one (save_to_file, load_from_file)
+    and the binary columnar one (save_to_binary_file,
+    load_columns_from_binary_file):
+    header - magic bytes, number of variables (uint32), number of points
+    (uint64) and variable names (uint16 length + UTF-8 bytes), padded to
+    8 bytes, then float64 columns - one for every variable and the last one
+    for function values.
     """
 
+    _binary_magic = b'AISD'
+    _binary_header = struct.Struct('<4sIQ')
+    _binary_name_length = struct.Struct('<H')
+
     @classmethod
     def save_to_file(cls, filename, variables, function, points_number,
                      min_point=-5.0, max_point=5.0):
@@ -348,4 +1461,142 @@ class DataFileStorageHelper:
             for i in range(0, len(variables)):
                 arg_dict[variables[i]] = float(arg[i])
             values.append((arg_dict, float(f)))
-        return variables, values
\ No newline at end of file
+        return variables, values
+
+    @classmethod
+    def load_columns_from_file(cls, filename):
+        """
+        Loads values of the function from file in the column form.
+        Returns tuple (variables, columns, exact), see values_to_columns.
+        """
+        variables, values = cls.load_from_file(filename)
+        columns, exact = cls.values_to_columns(variables, values)
+        return variables, columns, exact
+
+    @classmethod
+    def values_to_columns(cls, variables, values):
+        """
+        Converts values in the form [({'x': 0, 'y': 0}, 0), ...] to the
+        tuple (columns, exact), where
+        columns - dictionary of NumPy arrays, one array per variable,
+        exact - NumPy array of the function values.
+        """
+        columns = {}
+        for var in variables:
+            columns[var] = np.array([arg[var] for (arg, f) in values], dtype=np.float64)
+        exact = np.array([f for (arg, f) in values], dtype=np.float64)
+        return columns, exact
+
+    @classmethod
+    def save_to_binary_file(cls, filename, variables, function, points_number,
+                            min_point=-5.0, max_point=5.0):
+        """
+        Saves values of the function in randomly generated points to
+        the binary columnar file. Points are generated by random module
+        in the same order as by save_to_file, so both files contain the same
+        points for the same seed.
+        """
+        points = np.array([[random.random() for arg in variables] for i in range(0, points_number)],
+                          dtype=np.float64).reshape(points_number, len(variables))
+        columns = {}
+        for (j, arg) in enumerate(variables):
+            columns[arg] = points[:, j] * (max_point - min_point) + min_point
+        exact = np.array([function(*[columns[arg][i] for arg in variables])
+                          for i in range(0, points_number)], dtype=np.float64)
+        cls.save_columns_to_binary_file(filename, variables, columns, exact)
+
+    @classmethod
+    def save_columns_to_binary_file(cls, filename, variables, columns, exact):
+        """
+        Saves values of the function in the column form (see values_to_columns)
+        to the binary columnar file.
+        """
+        header = cls._binary_header.pack(cls._binary_magic, len(variables), len(exact))
+        for var in variables:
+            name = var.encode('utf-8')
+            header += cls._binary_name_length.pack(len(name)) + name
+        header += b'\0' * (-len(header) % 8)
+
+        output = open(filename, 'wb')
+        output.write(header)
+        for var in variables:
+            output.write(np.ascontiguousarray(columns[var], dtype='<f8').tobytes())
+        output.write(np.ascontiguousarray(exact, dtype='<f8').tobytes())
+        output.close()
+
+    @classmethod
+    def load_columns_from_binary_file(cls, filename):
+        """
+        Loads values of the function from the binary columnar file.
+        File isn't read - it is memory-mapped, so the columns are views of
+        the file data.
+        Returns tuple (variables, columns, exact), see values_to_columns.
+        """
+        input = open(filename, 'rb')
+        header = input.read(cls._binary_header.size)
+        if len(header) < cls._binary_header.size or not header.startswith(cls._binary_magic):
+            input.close()
+            raise ValueError('{0} is not a binary data file'.format(filename))
+        magic, variables_number, points_number = cls._binary_header.unpack(header)
+        variables = []
+        for i in range(0, variables_number):
+            (length,) = cls._binary_name_length.unpack(input.read(cls._binary_name_length.size))
+            variables.append(input.read(length).decode('utf-8'))
+        offset = input.tell()
+        offset += -offset % 8
+        input.close()
+
+        data = np.memmap(filename, dtype='<f8', mode='r', offset=offset,
+                         shape=(variables_number + 1, points_number))
+        columns = {}
+        for (i, var) in enumerate(variables):
+            columns[var] = data[i]
+        return variables, columns, data[-1]
+
+    @classmethod
+    def is_binary_file(cls, filename):
+        """
+        Returns True only if the file is the binary columnar data file.
+        """
+        input = open(filename, 'rb')
+        magic = input.read(len(cls._binary_magic))
+        input.close()
+        return magic == cls._binary_magic
+
+    @classmethod
+    def iterate_chunks(cls, filename, chunk_size):
+        """
+        Yields values of the function from the text or binary file by
+        chunks of chunk_size points in the form (columns, exact), see
+        values_to_columns. Only one chunk is kept in memory.
+        """
+        if cls.is_binary_file(filename):
+            variables, columns, exact = cls.load_columns_from_binary_file(filename)
+            for start in range(0, len(exact), chunk_size):
+                chunk_columns = {}
+                for var in variables:
+                    chunk_columns[var] = columns[var][start:start + chunk_size]
+                yield chunk_columns, exact[start:start + chunk_size]
+            return
+
+        input = open(filename)
+        variables = input.readline().split()
+        rows = []
+        try:
+            for s in input:
+                rows.append([float(v) for v in s.split()])
+                if len(rows) == chunk_size:
+                    yield cls._rows_to_columns(variables, rows)
+                    rows = []
+            if rows:
+                yield cls._rows_to_columns(variables, rows)
+        finally:
+            input.close()
+
+    @classmethod
+    def _rows_to_columns(cls, variables, rows):
+        data = np.array(rows, dtype=np.float64)
+        columns = {}
+        for (i, var) in enumerate(variables):
+            columns[var] = data[:, i]
+        return columns, data[:, -1]
\ No newline at end of file
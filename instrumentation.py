@@ -0,0 +1,141 @@
+__author__ = 'Stanislav Ushakov'
+
+import json
+import time
+from threading import Lock
+
+
+class _Timer:
+    """
+    Context manager that adds the time of its block to the timer of
+    the instrumentation.
+    """
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.instrumentation.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Instrumentation:
+    """
+    This class collects timers (total seconds and number of calls) and
+    counters of the solver phases and notifies observers about every
+    finished generation.
+    Observer is a function that receives the generation record - dict with
+    the generation metrics (see ExpressionsImmuneSystem.solve), e.g.
+    JsonLinesObserver. Methods are thread-safe, so counters may be
+    increased by the background threads of the exchanger.
+    """
+
+    enabled = True
+
+    def __init__(self, observers=None):
+        self.timers = {}
+        self.counters = {}
+        self.observers = list(observers) if observers is not None else []
+        self.lock = Lock()
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+    def timer(self, name):
+        """
+        Returns context manager that measures time of its block:
+        with instrumentation.timer('mutation'): ...
+        """
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            total, calls = self.timers.get(name, (0.0, 0))
+            self.timers[name] = (total + seconds, calls + 1)
+
+    def count(self, name, value=1):
+        """
+        Increases the counter by value.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get_time(self, name):
+        """
+        Returns total seconds of the timer.
+        """
+        return self.timers.get(name, (0.0, 0))[0]
+
+    def get_count(self, name):
+        return self.counters.get(name, 0)
+
+    def snapshot(self):
+        """
+        Returns dict with copies of all timers and counters.
+        """
+        with self.lock:
+            return {'timers': dict((name, {'seconds': total, 'calls': calls})
+                                   for (name, (total, calls)) in self.timers.items()),
+                    'counters': dict(self.counters)}
+
+    def generation(self, record):
+        """
+        Notifies observers about the finished generation.
+        """
+        for observer in self.observers:
+            observer(record)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+
+class NullInstrumentation:
+    """
+    Instrumentation that does nothing - used when instrumentation is
+    disabled, so the overhead is only the call of the empty method.
+    """
+
+    enabled = False
+    _timer = _NullTimer()
+
+    def add_observer(self, observer):
+        pass
+
+    def timer(self, name):
+        return NullInstrumentation._timer
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def generation(self, record):
+        pass
+
+
+class JsonLinesObserver:
+    """
+    Observer that writes every generation record to the file as one line
+    of JSON.
+    """
+
+    def __init__(self, filename):
+        self.output = open(filename, 'a')
+
+    def __call__(self, record):
+        self.output.write(json.dumps(record) + '\n')
+        self.output.flush()
+
+    def close(self):
+        self.output.close()
@@ -0,0 +1,195 @@
+__author__ = 'Stanislav Ushakov'
+
+import os
+import copy
+import random
+import queue
+from multiprocessing import Process, Queue
+
+from immune import ExpressionsImmuneSystem, create_shared_dataset, attach_shared_dataset
+from migration import create_topology, MigrationInbox
+from serializer import ExpressionSerializer
+from exchanger import encode_migrants, decode_migrants
+from instrumentation import NullInstrumentation
+
+
+class QueueExchanger:
+    """
+    Exchanger for the islands running on the same machine (see IslandsRunner).
+    Lymphocytes to exchange are sent at once to the inboxes (multiprocessing
+    queues) of the neighbour islands, received lymphocytes are taken from
+    the inbox of this island. Lymphocytes are sent in the compact form
+    (see ExpressionSerializer) tagged with the number of this island and
+    its generation. Nothing waits: if the inbox of the neighbour is full,
+    lymphocytes are not sent to it.
+    """
+
+    def __init__(self, inbox, neighbours_inboxes, source=0, inbox_size=16, instrumentation=None):
+        """
+        Initializes exchanger with the inbox of this island, the list of
+        inboxes of the islands it sends lymphocytes to and the number of
+        this island.
+        inbox_size - maximal number of stored messages (see get_migrants).
+        instrumentation - if given (see Instrumentation), bytes_sent and
+        bytes_received are counted.
+        """
+        self.instrumentation = instrumentation if instrumentation is not None else NullInstrumentation()
+        self.inbox = inbox
+        self.neighbours_inboxes = neighbours_inboxes
+        self.source = source
+        self.migrants = MigrationInbox(inbox_size)
+
+    def set_lymphocytes_to_exchange(self, lymphocytes, generation=0):
+        """
+        Sends the lymphocytes to the neighbour islands.
+        """
+        payload = encode_migrants(self.source, generation, lymphocytes)
+        for inbox in self.neighbours_inboxes:
+            try:
+                inbox.put_nowait(payload)
+                self.instrumentation.count('bytes_sent', len(payload))
+            except queue.Full:
+                pass
+
+    def get_lymphocytes(self):
+        """
+        Returns all lymphocytes received since the previous call
+        (may be empty list).
+        """
+        lymphocytes = []
+        for (source, generation, received) in self._receive():
+            lymphocytes += received
+        return lymphocytes
+
+    def get_migrants(self, generation, max_staleness):
+        """
+        Returns lymphocytes received since the previous call, only the newest
+        and not stale ones (see MigrationInbox.drain).
+        """
+        for message in self._receive():
+            self.migrants.put(*message)
+        return self.migrants.drain(generation, max_staleness)
+
+    def _receive(self):
+        messages = []
+        while True:
+            try:
+                payload = self.inbox.get_nowait()
+            except queue.Empty:
+                return messages
+            self.instrumentation.count('bytes_received', len(payload))
+            messages.append(decode_migrants(payload))
+
+
+def _run_island(number, memory_name, shape, variables, config, inbox, neighbours_inboxes,
+                results, accuracy, seed):
+    """
+    Main function of the island process: solves the task and puts
+    (number, encoded best lymphocyte, its fitness) to the results queue.
+    """
+    random.seed(None if seed is None else seed + number)
+    #neighbours may finish earlier and not receive everything, don't wait for them
+    for neighbour_inbox in neighbours_inboxes:
+        neighbour_inbox.cancel_join_thread()
+    #memory is kept open until the process is finished
+    memory, columns, exact = attach_shared_dataset(memory_name, shape, variables)
+    immune_system = ExpressionsImmuneSystem(exact_values=None,
+                                            variables=variables,
+                                            exchanger=QueueExchanger(inbox, neighbours_inboxes, number),
+                                            config=config,
+                                            dataset=(columns, exact))
+    best = immune_system.solve(accuracy)
+    fitness = immune_system.fitness_function(best)
+    immune_system.close()
+    results.put((number, ExpressionSerializer.encode(best), fitness))
+
+
+class IslandsRunner:
+    """
+    Runs several immune systems (islands) in the worker processes of this
+    machine. Islands exchange lymphocytes through multiprocessing queues
+    according to the topology (see migration module), no sockets are used.
+    The dataset is placed to the shared memory once and used by all islands.
+    Every island writes its checkpoints (see config.checkpoint_interval) to
+    its own file, see get_checkpoint_filename.
+    """
+
+    def __init__(self, columns, exact, variables, config, number_of_islands,
+                 topology=None, inbox_size=4):
+        """
+        Initializes runner with the dataset in columns form (see
+        DataFileStorageHelper.values_to_columns), list of variables,
+        config of every island (see ExpressionsImmuneSystemConfig) and
+        number of islands.
+        topology - by default it is created by config.topology.
+        inbox_size - maximal number of not received messages of one island.
+        """
+        self.columns = columns
+        self.exact = exact
+        self.variables = variables
+        self.config = config
+        self.number_of_islands = number_of_islands
+        self.topology = topology if topology is not None else create_topology(config.topology)
+        self.inbox_size = inbox_size
+
+    @classmethod
+    def get_checkpoint_filename(cls, filename, number):
+        """
+        Returns name of the checkpoint file of the island with the given
+        number (from 1): 'checkpoint.bin' -> 'checkpoint_1.bin'.
+        """
+        (root, extension) = os.path.splitext(filename)
+        return '{0}_{1}{2}'.format(root, number, extension)
+
+    def _get_island_config(self, number):
+        config = copy.copy(self.config)
+        config.checkpoint_filename = IslandsRunner.get_checkpoint_filename(self.config.checkpoint_filename, number)
+        return config
+
+    def run(self, accuracy=0.001, seed=None):
+        """
+        Runs all islands until they are finished.
+        Returns list of (best expression, fitness) for every island
+        (ordered by island number).
+        seed - if given, island i generates its first lymphocytes with
+        random seed seed + i.
+        """
+        memory, shape = create_shared_dataset(self.columns, self.exact, self.variables)
+        inboxes = [Queue(self.inbox_size) for i in range(0, self.number_of_islands)]
+        results = Queue()
+        processes = []
+        try:
+            for i in range(0, self.number_of_islands):
+                #islands are numbered from 1 as the nodes
+                neighbours = [inboxes[n - 1] for n in self.topology.neighbours(i + 1, self.number_of_islands)]
+                process = Process(target=_run_island,
+                                  args=(i, memory.name, shape, list(self.variables), self._get_island_config(i + 1),
+                                        inboxes[i], neighbours, results, accuracy, seed))
+                process.start()
+                processes.append(process)
+
+            received = {}
+            while len(received) < self.number_of_islands:
+                try:
+                    (number, encoded, fitness) = results.get(timeout=0.5)
+                except queue.Empty:
+                    if all(not p.is_alive() for p in processes) and results.empty():
+                        raise RuntimeError('island processes are stopped without results')
+                    continue
+                received[number] = (ExpressionSerializer.decode(encoded), fitness)
+            for p in processes:
+                p.join()
+            return [received[i] for i in range(0, self.number_of_islands)]
+        finally:
+            for p in processes:
+                if p.is_alive():
+                    p.terminate()
+            memory.close()
+            memory.unlink()
+
+    @classmethod
+    def best(cls, results):
+        """
+        Returns (best expression, fitness) of the results returned by run.
+        """
+        return min(results, key=lambda result: result[1])
@@ -1,32 +1,149 @@
 __author__ = 'Stanislav Ushakov'
 
+import os
 import sys
+import json
 import time
-from subprocess import Popen
+from queue import Queue
+from subprocess import Popen, PIPE
+from threading import Thread
+
+
+class NodeResult:
+    """
+    Result of one node: its best expression (string), fitness value,
+    running time in seconds (of the last start) and number of restarts.
+    best and fitness are None if the node failed.
+    """
+
+    def __init__(self, number, best, fitness, seconds, restarts):
+        self.number = number
+        self.best = best
+        self.fitness = fitness
+        self.seconds = seconds
+        self.restarts = restarts
+
+
+class NodesSupervisor:
+    """
+    This class starts the node processes and waits for them.
+    Every process is waited by its own thread that reports the exit to
+    the supervisor queue, so nothing is polled. The failed node is started
+    again (at most max_restarts times), then it is dropped. node_main.py is
+    restarted with 'resume' argument if the node has written a checkpoint,
+    so it continues from the last checkpoint.
+    The result of the node is the last line of its output: JSON object
+    with 'best' and 'fitness' keys (see node_main.py).
+    """
+
+    def __init__(self, number_of_nodes, command=None, max_restarts=1, restart_command=None):
+        """
+        Initializes supervisor with number of nodes.
+        command - function that returns command (list of arguments) for
+        the node with the given number (from 1), by default - node_main.py.
+        restart_command - the same function for the failed node, by default -
+        command (node_main.py with 'resume' for the default command).
+        """
+        self.number_of_nodes = number_of_nodes
+        self.command = command if command is not None else self._node_main_command
+        if restart_command is not None:
+            self.restart_command = restart_command
+        elif command is not None:
+            self.restart_command = command
+        else:
+            self.restart_command = self._node_main_restart_command
+        self.max_restarts = max_restarts
+        self.results = {}
+        self._events = Queue()
+        self._restarts = {}
+
+    def _node_main_command(self, number):
+        return [sys.executable, 'node_main.py', str(number), str(self.number_of_nodes)]
+
+    def _node_main_restart_command(self, number):
+        #the same file name as in node_main.py
+        if os.path.exists('checkpoint_{0}.bin'.format(number)):
+            return self._node_main_command(number) + ['resume']
+        return self._node_main_command(number)
+
+    def run(self):
+        """
+        Starts all nodes and waits until every node is finished or dropped.
+        Returns list of NodeResult ordered by node number.
+        """
+        for number in range(1, self.number_of_nodes + 1):
+            self._restarts[number] = 0
+            self._start(number, self.command)
+        running = self.number_of_nodes
+        while running:
+            (number, returncode, output, seconds) = self._events.get()
+            result = self._parse_result(output) if returncode == 0 else None
+            if result is None and self._restarts[number] < self.max_restarts:
+                print('Node {0} failed, restarting...'.format(number))
+                self._restarts[number] += 1
+                self._start(number, self.restart_command)
+                continue
+            if result is None:
+                print('Node {0} failed, dropped'.format(number))
+                result = (None, None)
+            self.results[number] = NodeResult(number, result[0], result[1], seconds, self._restarts[number])
+            running -= 1
+        return [self.results[number] for number in sorted(self.results)]
+
+    def _start(self, number, command):
+        print('Starting {0}...'.format(number))
+        started = time.time()
+        process = Popen(command(number), stdout=PIPE, universal_newlines=True)
+        waiter = Thread(target=self._wait, args=(number, process, started))
+        waiter.daemon = True
+        waiter.start()
+
+    def _wait(self, number, process, started):
+        output, errors = process.communicate()
+        self._events.put((number, process.returncode, output, time.time() - started))
+
+    @classmethod
+    def _parse_result(cls, output):
+        """
+        Returns (best, fitness) from the last line of the node output or
+        None if there is no result.
+        """
+        lines = output.strip().splitlines()
+        if not lines:
+            return None
+        try:
+            result = json.loads(lines[-1])
+            return result['best'], float(result['fitness'])
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    @classmethod
+    def best(cls, results):
+        """
+        Returns the NodeResult with the best fitness or None if all nodes failed.
+        """
+        succeeded = [r for r in results if r.fitness is not None]
+        if not succeeded:
+            return None
+        return min(succeeded, key=lambda r: r.fitness)
+
+    @classmethod
+    def report(cls, results):
+        """
+        Prints time and result of every node and the best result.
+        """
+        for r in results:
+            if r.fitness is None:
+                print('Node {0}: failed after {1} restarts'.format(r.number, r.restarts))
+            else:
+                print('Node {0}: {1:.2f} seconds, fitness {2}: {3}'.format(r.number, r.seconds,
+                                                                          r.fitness, r.best))
+        best = cls.best(results)
+        if best is not None:
+            print('Best (node {0}), fitness {1}: {2}'.format(best.number, best.fitness, best.best))
+
 
 #start as local_server.py number_of_nodes
 if __name__ == '__main__':
     nodes = int(sys.argv[1])
-
-    def done(p):
-        return p.poll() is not None
-
-    def success(p):
-        return p.returncode == 0
-
-    processes = []
-    for i in range(0, nodes):
-        print('Starting {0}...'.format(i))
-        processes.append(Popen('python node_main.py ' + str(i + 1) + ' ' + str(nodes)))
-    while True:
-        for p in processes:
-            if done(p):
-                if success(p):
-                    processes.remove(p)
-                else:
-                    print('Error')
-
-        if not processes:
-            break
-        else:
-            time.sleep(0.05)
+    NodesSupervisor.report(NodesSupervisor(nodes).run())
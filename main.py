@@ -25,8 +25,8 @@ if __name__ == "__main__":
 
     f = FitnessFunction(values)
     exchanger = SimpleRandomExchanger(
-        lambda: [Expression.generate_random(max_height=max_height, variables=variables)
-                 for i in range(0, number_of_lymphocytes // 2)])
+        lambda: Expression.generate_random_batch(number_of_lymphocytes // 2, max_height, variables,
+                                                 Expression.FULL))
 
     config = ExpressionsImmuneSystemConfig()
 
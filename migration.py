@@ -0,0 +1,243 @@
+__author__ = 'Stanislav Ushakov'
+
+import math
+import random
+from collections import deque
+from threading import Lock
+
+import numpy as np
+
+
+class RingTopology:
+    """
+    Every node sends lymphocytes to the next one, the last node - to
+    the first one.
+    Nodes are numbered from 1 to all_nodes (as in LocalhostNodesManager).
+    """
+
+    def neighbours(self, node, all_nodes):
+        """
+        Returns list of numbers of the nodes that the given node
+        exchanges with.
+        """
+        if all_nodes < 2:
+            return []
+        return [node % all_nodes + 1]
+
+
+class TorusTopology:
+    """
+    Nodes are placed row by row in the grid of the given width, every node
+    exchanges with its left, right, upper and lower neighbours. The grid
+    is wrapped around at its borders: rows - by their length (the last row
+    may be shorter), columns - by their height, so the graph is symmetric.
+    """
+
+    def __init__(self, width=None):
+        """
+        width - number of nodes in a row, by default the grid is
+        (nearly) square.
+        """
+        self.width = width
+
+    def neighbours(self, node, all_nodes):
+        width = self.width or max(int(math.sqrt(all_nodes)), 1)
+        i = node - 1
+        row, column = i // width, i % width
+        row_start = row * width
+        row_length = min(width, all_nodes - row_start)
+        column_height = (all_nodes - column + width - 1) // width
+        result = [row_start + (column + 1) % row_length,
+                  row_start + (column - 1) % row_length,
+                  (row + 1) % column_height * width + column,
+                  (row - 1) % column_height * width + column]
+        return sorted(set(n + 1 for n in result if n != i))
+
+
+class RandomRegularTopology:
+    """
+    Every node exchanges with degree randomly chosen nodes and every node
+    is chosen by the same number of nodes: the graph is the union of degree
+    random cycles over all nodes. The graph depends only on the seed, so
+    all nodes build the same one.
+    """
+
+    def __init__(self, degree=2, seed=0):
+        self.degree = degree
+        self.seed = seed
+
+    def neighbours(self, node, all_nodes):
+        generator = random.Random(self.seed)
+        result = []
+        for i in range(0, self.degree):
+            cycle = list(range(1, all_nodes + 1))
+            generator.shuffle(cycle)
+            next_node = cycle[(cycle.index(node) + 1) % all_nodes]
+            if next_node != node and next_node not in result:
+                result.append(next_node)
+        return result
+
+
+class FullyConnectedTopology:
+    """
+    Every node exchanges with all other nodes.
+    """
+
+    def neighbours(self, node, all_nodes):
+        return [n for n in range(1, all_nodes + 1) if n != node]
+
+
+class StarTopology:
+    """
+    The hub node exchanges with all other nodes, all other nodes - only
+    with the hub.
+    """
+
+    def __init__(self, hub=1):
+        self.hub = hub
+
+    def neighbours(self, node, all_nodes):
+        if node == self.hub:
+            return [n for n in range(1, all_nodes + 1) if n != node]
+        return [self.hub]
+
+
+def create_topology(name):
+    """
+    Returns topology object by its name: 'ring', 'torus', 'random_regular',
+    'fully_connected' or 'star'. Parameters of the topologies are default.
+    """
+    topologies = {'ring': RingTopology,
+                  'torus': TorusTopology,
+                  'random_regular': RandomRegularTopology,
+                  'fully_connected': FullyConnectedTopology,
+                  'star': StarTopology}
+    if name not in topologies:
+        raise ValueError('unknown topology: {0}'.format(name))
+    return topologies[name]()
+
+
+class TopEmigrantsSelection:
+    """
+    Selects the best lymphocytes to be sent to the other nodes.
+    """
+
+    def select(self, expressions, fitness_values, number):
+        """
+        Returns indices of the selected lymphocytes (the best first).
+        fitness_values - NumPy array of the lymphocytes fitness values.
+        """
+        return np.argsort(fitness_values, kind='stable')[:number]
+
+
+class RandomEmigrantsSelection:
+    """
+    Selects random lymphocytes to be sent to the other nodes.
+    """
+
+    def select(self, expressions, fitness_values, number):
+        return np.array(random.sample(range(len(fitness_values)), min(number, len(fitness_values))),
+                        dtype=np.int64)
+
+
+class DiversityEmigrantsSelection:
+    """
+    Selects the best lymphocytes to be sent to the other nodes, but only
+    different ones: lymphocytes of the same structure or of the same
+    fitness value as already selected are skipped.
+    """
+
+    def select(self, expressions, fitness_values, number):
+        result = []
+        keys = set()
+        values = set()
+        for i in np.argsort(fitness_values, kind='stable').tolist():
+            if len(result) == number:
+                break
+            key = expressions[i].structural_key()
+            if key in keys or fitness_values[i] in values:
+                continue
+            keys.add(key)
+            values.add(fitness_values[i])
+            result.append(i)
+        return np.array(result, dtype=np.int64)
+
+
+class ReplaceWorstPolicy:
+    """
+    Received lymphocytes replace the worst ones.
+    """
+
+    def select(self, fitness_values, number):
+        """
+        Returns indices of the lymphocytes to be replaced.
+        fitness_values - NumPy array of the lymphocytes fitness values.
+        """
+        number = min(number, len(fitness_values))
+        if number <= 0:
+            return np.arange(0)
+        return np.argpartition(fitness_values, len(fitness_values) - number)[len(fitness_values) - number:]
+
+
+class ReplaceRandomPolicy:
+    """
+    Received lymphocytes replace random ones, but the best lymphocyte
+    is never replaced.
+    """
+
+    def select(self, fitness_values, number):
+        best = int(np.argmin(fitness_values)) if len(fitness_values) else -1
+        candidates = [i for i in range(len(fitness_values)) if i != best]
+        return np.array(random.sample(candidates, min(number, len(candidates))), dtype=np.int64)
+
+
+class MigrationInbox:
+    """
+    Bounded storage of the received lymphocytes. Every message is tagged
+    with its source (number of the node or island) and the generation of
+    the source when the lymphocytes were sent. When the inbox is full,
+    the oldest message is dropped. Methods are thread-safe, so the inbox
+    may be filled by the background thread of the exchanger.
+    dropped - number of dropped (overflowed, replaced or stale) messages.
+    """
+
+    def __init__(self, max_size=16):
+        self.messages = deque(maxlen=max_size)
+        self.lock = Lock()
+        self.dropped = 0
+
+    def put(self, source, generation, lymphocytes):
+        """
+        Stores received lymphocytes.
+        """
+        with self.lock:
+            if len(self.messages) == self.messages.maxlen:
+                self.dropped += 1
+            self.messages.append((source, generation, lymphocytes))
+
+    def drain(self, generation, max_staleness):
+        """
+        Removes all messages from the inbox and returns their lymphocytes.
+        Only the newest message of every source is used and only if it is
+        sent not more than max_staleness generations before the given
+        (current) generation.
+        """
+        newest = {}
+        result = []
+        with self.lock:
+            for (source, sent, lymphocytes) in self.messages:
+                if source in newest:
+                    self.dropped += 1
+                    if newest[source][0] > sent:
+                        continue
+                newest[source] = (sent, lymphocytes)
+            self.messages.clear()
+            for (sent, lymphocytes) in sorted(newest.values(), key=lambda message: -message[0]):
+                if generation - sent > max_staleness:
+                    self.dropped += 1
+                else:
+                    result += lymphocytes
+        return result
+
+    def __len__(self):
+        return len(self.messages)
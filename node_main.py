@@ -1,32 +1,51 @@
 __author__ = 'Stanislav Ushakov'
 
+import os
 import sys
+import json
 
 from immune import ExpressionsImmuneSystem, DataFileStorageHelper, ExpressionsImmuneSystemConfig
-from exchanger import PeerToPeerExchanger, LocalhostNodesManager
+from exchanger import AsyncPeerToPeerExchanger, LocalhostNodesManager
+from migration import create_topology
+from checkpoint import Checkpoint
 
 
-#start as "python node_main.py node_num number_of_nodes"
+#start as "python node_main.py node_num number_of_nodes [resume]"
+#resume - continue from the last checkpoint of this node (if it exists)
 if __name__ == '__main__':
     number = int(sys.argv[1])
     number_of_nodes = int(sys.argv[2])
-
-    nodes_manager = LocalhostNodesManager(number, number_of_nodes)
+    resume = len(sys.argv) > 3 and sys.argv[3] == 'resume'
 
     config = ExpressionsImmuneSystemConfig()
     config.number_of_lymphocytes = 200
     config.number_of_iterations = 200
     config.number_of_iterations_to_exchange = 30
     config.maximal_height = 5
+    config.number_of_migrants = 10
+    config.asynchronous_migration = True
+    config.checkpoint_interval = 10
+    config.checkpoint_filename = 'checkpoint_{0}.bin'.format(number)
+
+    nodes_manager = LocalhostNodesManager(number, number_of_nodes, create_topology(config.topology))
 
     variables, values = DataFileStorageHelper.load_from_file('test_x_y.txt')
 
-    exchanger = PeerToPeerExchanger(nodes_manager)
+    exchanger = AsyncPeerToPeerExchanger(nodes_manager, config.nodes_per_exchange)
+
+    checkpoint = None
+    if resume and os.path.exists(config.checkpoint_filename):
+        checkpoint = Checkpoint.load(config.checkpoint_filename)
 
-    results = []
     immuneSystem = ExpressionsImmuneSystem(exact_values=values,
                                            variables=variables,
                                            exchanger=exchanger,
-                                           config=config)
+                                           config=config,
+                                           checkpoint=checkpoint)
     best = immuneSystem.solve()
-    print(best)
\ No newline at end of file
+    fitness = immuneSystem.fitness_function(best)
+    immuneSystem.close()
+    exchanger.close()
+    print(best)
+    #the last line is the result for local_server.py
+    print(json.dumps({'best': str(best), 'fitness': fitness}))
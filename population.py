@@ -0,0 +1,249 @@
+__author__ = 'Stanislav Ushakov'
+
+import random
+
+import numpy as np
+
+from expression import Expression, Operations, CompiledExpression
+
+
+class Population:
+    """
+    This class is used for storing all expression trees of a generation
+    in a few contiguous arrays instead of graphs of Node objects.
+    Trees are stored one after another in postfix order (the same as
+    in CompiledExpression):
+    codes - operation codes of all nodes,
+    values - value for the number, index in variables for the variable and
+    0 for all other operations,
+    left - index of the left child inside its tree (-1 for leaves), the right
+    child of a binary operation is always the previous node,
+    offsets - tree i is stored in [offsets[i], offsets[i + 1]).
+    """
+
+    _number_code = Operations.NUMBER.code
+    _variable_code = Operations.IDENTITY.code
+    _unary_codes = [o.code for o in Operations.get_unary_operations()]
+    _binary_codes = [o.code for o in Operations.get_binary_operations()]
+
+    def __init__(self, codes, values, left, offsets, variables):
+        """
+        Initializes population with already filled arrays.
+        Use from_expressions to create population from expression trees.
+        """
+        self.codes = codes
+        self.values = values
+        self.left = left
+        self.offsets = offsets
+        self.variables = variables
+
+    @classmethod
+    def from_expressions(cls, expressions, variables):
+        """
+        Creates population from the list of expressions.
+        variables - list of variable names, indices of variables are
+        stored according to it.
+        """
+        variables = list(variables)
+        codes = []
+        values = []
+        for e in expressions:
+            (tree_codes, tree_values) = Population._encode(e.compile(), variables)
+            codes.append(tree_codes)
+            values.append(tree_values)
+        return Population._from_trees(codes, values, variables)
+
+    @classmethod
+    def _encode(cls, compiled, variables):
+        """
+        Returns codes and values of the compiled expression with indices of
+        variables according to the given variables list (it is extended
+        if needed).
+        """
+        codes = np.array(compiled.codes, dtype=np.int8)
+        values = np.array(compiled.args, dtype=np.float64)
+        if compiled.variables != variables:
+            for i in np.flatnonzero(codes == Population._variable_code):
+                name = compiled.variables[int(values[i])]
+                if name not in variables:
+                    variables.append(name)
+                values[i] = variables.index(name)
+        return codes, values
+
+    @classmethod
+    def _from_trees(cls, codes, values, variables, left=None):
+        """
+        Creates population from lists of codes and values arrays, one pair
+        for every tree. Left children are calculated if not given.
+        """
+        lengths = [len(c) for c in codes]
+        offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if not codes:
+            return Population(np.zeros(0, dtype=np.int8), np.zeros(0, dtype=np.float64),
+                              np.zeros(0, dtype=np.int32), offsets, variables)
+        if left is None:
+            left = [Population._left_children(c) for c in codes]
+        return Population(np.concatenate(codes), np.concatenate(values),
+                          np.concatenate(left), offsets, variables)
+
+    @classmethod
+    def _left_children(cls, codes):
+        """
+        Returns array of left children indices for the tree given by its
+        codes in postfix order.
+        """
+        left = np.full(len(codes), -1, dtype=np.int32)
+        stack = []
+        for (i, code) in enumerate(codes.tolist()):
+            if code in Population._binary_codes:
+                stack.pop()
+                left[i] = stack[-1]
+                stack[-1] = i
+            elif code in Population._unary_codes:
+                left[i] = stack[-1]
+                stack[-1] = i
+            else:
+                stack.append(i)
+        return left
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def tree(self, i):
+        """
+        Returns i-th tree as CompiledExpression. Its arrays are views of
+        the population arrays - no data is copied.
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return CompiledExpression(self.codes[start:end], self.values[start:end], self.variables)
+
+    def trees(self):
+        """
+        Returns list of all trees, see tree.
+        """
+        return [self.tree(i) for i in range(0, len(self))]
+
+    def expression(self, i):
+        """
+        Returns i-th tree as Expression.
+        """
+        compiled = self.tree(i)
+        compiled = CompiledExpression(compiled.codes.copy(), compiled.args.copy(), list(self.variables))
+        return Expression.from_compiled(compiled, list(self.variables))
+
+    def to_expressions(self):
+        """
+        Returns list of all trees as expressions.
+        """
+        return [self.expression(i) for i in range(0, len(self))]
+
+    def select(self, indices):
+        """
+        Returns new population that contains only trees with given indices
+        (in the given order).
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = (self.offsets[1:] - self.offsets[:-1])[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = (np.repeat(self.offsets[:-1][indices] - offsets[:-1], lengths) +
+                     np.arange(offsets[-1], dtype=np.int64))
+        return Population(self.codes[positions], self.values[positions], self.left[positions],
+                          offsets, self.variables)
+
+    def concatenate(self, other):
+        """
+        Returns new population that contains trees of this population and
+        then trees of the other one.
+        """
+        if other.variables != self.variables:
+            #variables of the re-encoded population start with self.variables
+            other = Population.from_expressions(other.to_expressions(), self.variables)
+        offsets = np.concatenate([self.offsets, other.offsets[1:] + self.offsets[-1]])
+        return Population(np.concatenate([self.codes, other.codes]),
+                          np.concatenate([self.values, other.values]),
+                          np.concatenate([self.left, other.left]),
+                          offsets, other.variables)
+
+    def mutated(self):
+        """
+        Returns new population that contains one mutated child for every tree.
+        Mutations are the same as in ExpressionMutator and of equal possibilities.
+        """
+        mutations = [self._number_mutation,
+                     self._variable_mutation,
+                     self._unary_mutation,
+                     self._binary_mutation,
+                     self._subtree_mutation]
+        codes = []
+        values = []
+        left = []
+        for i in range(0, len(self)):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            (tree_codes, tree_values, tree_left) = random.choice(mutations)(
+                self.codes[start:end].copy(), self.values[start:end].copy(), self.left[start:end])
+            codes.append(tree_codes)
+            values.append(tree_values)
+            left.append(tree_left)
+        return Population._from_trees(codes, values, self.variables, left)
+
+    def _number_mutation(self, codes, values, left):
+        numbers = np.flatnonzero(codes == Population._number_code)
+        if len(numbers):
+            i = random.choice(numbers)
+            if random.random() < 0.45:
+                values[i] += random.random()
+            elif random.random() < 0.9:
+                values[i] -= random.random()
+            else:
+                values[i] = round(values[i])
+        return codes, values, left
+
+    def _variable_mutation(self, codes, values, left):
+        variables = np.flatnonzero(codes == Population._variable_code)
+        if len(variables):
+            values[random.choice(variables)] = random.randrange(len(self.variables))
+        return codes, values, left
+
+    def _unary_mutation(self, codes, values, left):
+        unary_operations = np.flatnonzero(np.isin(codes, Population._unary_codes))
+        if len(unary_operations):
+            codes[random.choice(unary_operations)] = random.choice(Population._unary_codes)
+        return codes, values, left
+
+    def _binary_mutation(self, codes, values, left):
+        binary_operations = np.flatnonzero(np.isin(codes, Population._binary_codes))
+        if len(binary_operations):
+            codes[random.choice(binary_operations)] = random.choice(Population._binary_codes)
+        return codes, values, left
+
+    def _subtree_mutation(self, codes, values, left):
+        """
+        Changes one randomly selected node (not root and not leaf) to
+        the randomly generated subtree. The height of the tree isn't changed.
+        """
+        operations = np.flatnonzero(left >= 0)
+        nodes = operations[:-1]
+        if not len(nodes):
+            return codes, values, left
+
+        heights = np.ones(len(codes), dtype=np.int32)
+        for i in operations.tolist():
+            heights[i] = max(heights[left[i]], heights[i - 1]) + 1
+        #depth of the root is 0, children are always before their parent
+        depths = np.zeros(len(codes), dtype=np.int32)
+        for i in reversed(operations.tolist()):
+            depths[left[i]] = depths[i] + 1
+            depths[i - 1] = depths[i] + 1
+
+        selected = random.choice(nodes)
+        start = selected
+        while left[start] >= 0:
+            start = left[start]
+        max_height = int(heights[-1] - depths[selected])
+        new_subtree = Expression.generate_random(max_height, self.variables)
+        (subtree_codes, subtree_values) = Population._encode(new_subtree.compile(), self.variables)
+        codes = np.concatenate([codes[:start], subtree_codes, codes[selected + 1:]])
+        values = np.concatenate([values[:start], subtree_values, values[selected + 1:]])
+        return codes, values, Population._left_children(codes)
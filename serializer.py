@@ -0,0 +1,122 @@
+__author__ = 'Stanislav Ushakov'
+
+import struct
+
+import numpy as np
+
+from expression import Operations
+from population import Population
+
+
+class ExpressionSerializer:
+    """
+    This class is used for converting expressions to the compact binary
+    form and back, e.g. for sending lymphocytes to the other nodes.
+    Expressions are stored in the flat postfix form (see CompiledExpression)
+    as one batch:
+    header - magic, number of variables and number of expressions,
+    variable names - 2 bytes length and UTF-8 bytes for every name,
+    lengths - number of nodes of every expression (uint32),
+    codes - operation codes of all nodes (int8),
+    variable indices - index in the variable names for every variable
+    node (uint16),
+    numbers - value of every number node (float64).
+    All numbers are little-endian.
+    """
+
+    _magic = b'AISE'
+    _header = struct.Struct('<4sHI')
+    _name_length = struct.Struct('<H')
+
+    _number_code = Operations.NUMBER.code
+    _variable_code = Operations.IDENTITY.code
+
+    @classmethod
+    def encode(cls, expression):
+        """
+        Returns bytes of the given expression.
+        """
+        return cls.encode_batch([expression])
+
+    @classmethod
+    def decode(cls, data):
+        """
+        Returns expression restored from the bytes returned by encode.
+        """
+        return cls.decode_batch(data)[0]
+
+    @classmethod
+    def encode_batch(cls, expressions):
+        """
+        Returns bytes of the given list of expressions.
+        """
+        variables = []
+        for e in expressions:
+            for var in e.compile().variables:
+                if var not in variables:
+                    variables.append(var)
+        return cls.encode_population(Population.from_expressions(expressions, variables))
+
+    @classmethod
+    def decode_batch(cls, data):
+        """
+        Returns list of expressions restored from the bytes returned by
+        encode_batch.
+        """
+        return cls.decode_population(data).to_expressions()
+
+    @classmethod
+    def encode_population(cls, population):
+        """
+        Returns bytes of all trees of the population (see Population).
+        """
+        header = cls._header.pack(cls._magic, len(population.variables), len(population))
+        for var in population.variables:
+            name = var.encode('utf-8')
+            header += cls._name_length.pack(len(name)) + name
+        codes = population.codes
+        lengths = population.offsets[1:] - population.offsets[:-1]
+        return b''.join([header,
+                         lengths.astype('<u4').tobytes(),
+                         codes.astype(np.int8).tobytes(),
+                         population.values[codes == cls._variable_code].astype('<u2').tobytes(),
+                         population.values[codes == cls._number_code].astype('<f8').tobytes()])
+
+    @classmethod
+    def decode_population(cls, data):
+        """
+        Returns population restored from the bytes returned by
+        encode_population or encode_batch.
+        Raises ValueError if the data is not the encoded expressions.
+        """
+        if len(data) < cls._header.size or not data.startswith(cls._magic):
+            raise ValueError('data is not encoded expressions')
+        magic, variables_number, number = cls._header.unpack_from(data)
+        position = cls._header.size
+        variables = []
+        for i in range(0, variables_number):
+            (length,) = cls._name_length.unpack_from(data, position)
+            position += cls._name_length.size
+            variables.append(bytes(data[position:position + length]).decode('utf-8'))
+            position += length
+
+        lengths = np.frombuffer(data, dtype='<u4', count=number, offset=position)
+        position += lengths.nbytes
+        offsets = np.zeros(number + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        codes = np.frombuffer(data, dtype=np.int8, count=int(offsets[-1]), offset=position).copy()
+        position += codes.nbytes
+
+        values = np.zeros(len(codes), dtype=np.float64)
+        variable_nodes = codes == cls._variable_code
+        indices = np.frombuffer(data, dtype='<u2', count=int(np.count_nonzero(variable_nodes)),
+                                offset=position)
+        position += indices.nbytes
+        values[variable_nodes] = indices
+        number_nodes = codes == cls._number_code
+        values[number_nodes] = np.frombuffer(data, dtype='<f8', count=int(np.count_nonzero(number_nodes)),
+                                             offset=position)
+
+        return Population._from_trees([codes[offsets[i]:offsets[i + 1]] for i in range(0, number)],
+                                      [values[offsets[i]:offsets[i + 1]] for i in range(0, number)],
+                                      variables)
@@ -2,10 +2,35 @@ __author__ = 'Stanislav Ushakov'
 
 import unittest
 import pickle
+import random
+import json
+import os
+import sys
+import socket
+import struct
+import threading
+import multiprocessing
+import tempfile
+import time
 
-from expression import Expression, NotSupportedOperationError, Operations, Node
-from immune import FitnessFunction, ExpressionMutator, ExpressionsImmuneSystem, ExpressionsImmuneSystemConfig
-from exchanger import SimpleRandomExchanger, LocalhostNodesManager
+import numpy as np
+
+from expression import Expression, NotSupportedOperationError, Operations, Node, CompiledExpression
+from immune import FitnessFunction, VectorizedFitnessFunction, StreamingFitnessFunction, ProgressiveFitnessFunction, \
+    FitnessCache, ParallelFitnessEvaluator, TruncationSelection, TournamentSelection, ExpressionMutator, \
+    ExpressionsImmuneSystem, ExpressionsImmuneSystemConfig, DataFileStorageHelper, ConstantOptimizer, Deduplicator
+from exchanger import SimpleRandomExchanger, LocalhostNodesManager, AsyncPeerToPeerExchanger, ConnectionPool, \
+    ThreadingTCPServer, GetterThread, TCPHandler, send_message, receive_message
+from population import Population
+from serializer import ExpressionSerializer
+from islands import QueueExchanger, IslandsRunner
+from local_server import NodesSupervisor
+import benchmark
+from checkpoint import Checkpoint, CheckpointWriter
+from instrumentation import Instrumentation, NullInstrumentation, JsonLinesObserver
+from migration import RingTopology, TorusTopology, RandomRegularTopology, FullyConnectedTopology, \
+    StarTopology, create_topology, TopEmigrantsSelection, RandomEmigrantsSelection, DiversityEmigrantsSelection, \
+    ReplaceWorstPolicy, ReplaceRandomPolicy, MigrationInbox
 
 
 class OperationTest(unittest.TestCase):
@@ -99,6 +124,19 @@ class ExpressionNodeTest(unittest.TestCase):
         self.assertEqual(node.operation, Operations.IDENTITY)
         self.assertEqual(node.value, 'x')
 
+    def test_cached_height_and_size(self):
+        node = Node(Operations.PLUS,
+                    Node(Operations.SIN, left=Node(Operations.IDENTITY, value='x')),
+                    Node(Operations.NUMBER, value=2))
+        self.assertEqual(node.height(), 3)
+        self.assertEqual(node.size(), 4)
+        node.left.simplify()
+        self.assertEqual(node.left.height(), 2)
+        node.right = Node(Operations.SIN, left=Node(Operations.NUMBER, value=0))
+        node.simplify()
+        self.assertEqual(node.height(), 3)
+        self.assertEqual(node.size(), 4)
+
     def test_pickle_node(self):
         node = Node(Operations.PLUS,
                     Node(Operations.MULTIPLICATION,
@@ -192,6 +230,56 @@ class ExpressionMutatorTest(unittest.TestCase):
         mutated_value = mutator.expression.value_in_point(point)
         self.assertNotEqual(original_value, mutated_value)
 
+    def test_mutation_shares_untouched_subtrees(self):
+        original_key = self.f.structural_key()
+        left, right = self.f.root.left, self.f.root.right
+        mutator = ExpressionMutator(expression=self.f)
+        mutator.variable_mutation()
+        self.assertEqual(self.f.structural_key(), original_key)
+        self.assertIsNot(mutator.expression.root, self.f.root)
+        self.assertTrue(mutator.expression.root.left is left or mutator.expression.root.right is right)
+
+    def test_paths_by_kind_are_updated(self):
+        expression = Expression.generate_random(max_height=5, variables=['x', 'y'])
+        for i in range(0, 50):
+            expression = ExpressionMutator(expression).mutation()
+            paths = expression.get_paths_by_kind()
+            rebuilt = Expression(root=expression.root, variables=['x', 'y']).get_paths_by_kind()
+            for kind in rebuilt:
+                #the order is kept too, subtree mutation relies on it
+                self.assertEqual(paths[kind], rebuilt[kind])
+            self.assertEqual(expression.root.height(), expression.root.copy().height())
+            self.assertEqual(expression.root.size(), len(expression.compile()))
+
+    def test_subtree_mutation_keeps_height(self):
+        #the deep multiplication is lower than its depth
+        x = Node(Operations.IDENTITY, value='x')
+        deep = Node(Operations.PLUS,
+                    left=Node(Operations.PLUS, left=Node(Operations.MULTIPLICATION, left=x, right=x), right=x),
+                    right=x)
+        sines = Node(Operations.SIN, left=Node(Operations.SIN, left=Node(Operations.SIN, left=x)))
+        expression = Expression(root=Node(Operations.PLUS, left=sines, right=deep), variables=['x'])
+        height = expression.root.height()
+        for i in range(0, 100):
+            mutator = ExpressionMutator(expression)
+            mutator.subtree_mutation()
+            self.assertLessEqual(mutator.expression.root.height(), height)
+
+    def test_simplify_does_not_change_shared_subtrees(self):
+        shared = Node(Operations.MULTIPLICATION,
+                      left=Node(Operations.IDENTITY, value='x'),
+                      right=Node(Operations.NUMBER, value=1))
+        first = Expression(root=Node(Operations.PLUS, left=shared,
+                                     right=Node(Operations.IDENTITY, value='y')),
+                           variables=['x', 'y'])
+        second = Expression(root=Node(Operations.MINUS, left=shared,
+                                      right=Node(Operations.IDENTITY, value='y')),
+                            variables=['x', 'y'])
+        original_key = first.structural_key()
+        second.simplify()
+        self.assertEqual(str(second), '(x - y)')
+        self.assertEqual(first.structural_key(), original_key)
+
 
 class LocalhostNodesManagerTest(unittest.TestCase):
     def test_self_address(self):
@@ -226,4 +314,1180 @@ class ExpressionsImmuneSystemTest(unittest.TestCase):
                                                exchanger=exchanger,
                                                config=config)
         best = immuneSystem.solve()
-        self.assertGreaterEqual(f(best), 0)
\ No newline at end of file
+        self.assertGreaterEqual(f(best), 0)
+
+    def _create(self, values, exchanger=None, **settings):
+        """
+        Returns immune system for the values of x with the default config
+        changed by settings, e.g. number_of_lymphocytes=10.
+        """
+        if exchanger is None:
+            exchanger = SimpleRandomExchanger(lambda: [])
+        config = ExpressionsImmuneSystemConfig()
+        for (name, value) in settings.items():
+            setattr(config, name, value)
+        return ExpressionsImmuneSystem(exact_values=values,
+                                       variables=['x'],
+                                       exchanger=exchanger,
+                                       config=config)
+
+    def _random_exchanger(self):
+        return SimpleRandomExchanger(
+            lambda: [Expression.generate_random(max_height=2, variables=['x'])
+                     for i in range(0, 5)])
+
+    def test_compact_population_solve_is_not_crashing(self):
+        values = [({'x': x}, x * x) for x in range(0, 5)]
+        f = FitnessFunction(values)
+        immuneSystem = self._create(values, self._random_exchanger(), number_of_lymphocytes=10,
+                                    number_of_iterations=5, number_of_iterations_to_exchange=2,
+                                    compact_population=True)
+        best = immuneSystem.solve()
+        self.assertGreaterEqual(f(best), 0)
+        self.assertEqual(len(immuneSystem.population), 10)
+
+    def test_progressive_evaluation_keeps_exact_best_fitness(self):
+        values = [({'x': x}, x * x) for x in range(0, 50)]
+        f = FitnessFunction(values)
+        immuneSystem = self._create(values, self._random_exchanger(), number_of_lymphocytes=10,
+                                    number_of_iterations=5, number_of_iterations_to_exchange=2,
+                                    progressive_evaluation=True, first_subset_size=5)
+        for i in range(0, 5):
+            immuneSystem.step()
+        value = f(immuneSystem.best())
+        self.assertAlmostEqual(value, immuneSystem.best_fitness(), delta=1e-6 * max(1.0, value))
+
+    def test_progressive_evaluation_with_tournament_is_exact(self):
+        values = [({'x': x}, x * x) for x in range(0, 50)]
+        f = FitnessFunction(values)
+        immuneSystem = self._create(values, number_of_lymphocytes=10, progressive_evaluation=True,
+                                    first_subset_size=5, selection='tournament')
+        for i in range(0, 3):
+            immuneSystem.step()
+            self.assertIsNone(immuneSystem._get_rejection_threshold())
+        for (e, value) in zip(immuneSystem.lymphocytes, immuneSystem._get_fitness_values()):
+            self.assertAlmostEqual(f(e), value, delta=1e-6 * max(1.0, value))
+
+    def test_constant_optimization_improves_best(self):
+        values = [({'x': x}, 3 * x + 2) for x in range(0, 10)]
+        f = FitnessFunction(values)
+        for compact_population in [False, True]:
+            immuneSystem = self._create(values, number_of_lymphocytes=10, compact_population=compact_population,
+                                        constant_optimization=2)
+            #the same structure everywhere, so it is always among the best
+            immuneSystem.set_lymphocytes([Expression(
+                root=Node(Operations.PLUS,
+                          left=Node(Operations.MULTIPLICATION,
+                                    left=Node(Operations.NUMBER, value=1),
+                                    right=Node(Operations.IDENTITY, value='x')),
+                          right=Node(Operations.NUMBER, value=i)),
+                variables=['x']) for i in range(0, 10)])
+            immuneSystem.step()
+            self.assertLess(immuneSystem.best_fitness(), 1e-6)
+            self.assertAlmostEqual(f(immuneSystem.best()), immuneSystem.best_fitness(), delta=1e-6)
+
+    def test_constant_optimization_keys_are_bounded(self):
+        values = [({'x': x}, 3 * x + 2) for x in range(0, 10)]
+        immuneSystem = self._create(values, number_of_lymphocytes=10, constant_optimization=4,
+                                    fitness_cache_size=2)
+        for i in range(0, 3):
+            immuneSystem.step()
+            self.assertLessEqual(len(immuneSystem._optimized_keys), 2)
+
+    def test_set_lymphocytes_resets_fitness_values(self):
+        values = [({'x': x}, x * x) for x in range(0, 10)]
+        f = FitnessFunction(values)
+        for compact_population in [False, True]:
+            immuneSystem = self._create(values, number_of_lymphocytes=4, compact_population=compact_population)
+            immuneSystem.step()
+            #the same number of lymphocytes
+            expressions = [Expression.generate_random(max_height=3, variables=['x']) for i in range(0, 4)]
+            immuneSystem.set_lymphocytes(expressions)
+            self.assertEqual([str(e) for e in immuneSystem._get_expressions()], [str(e) for e in expressions])
+            for (e, value) in zip(expressions, immuneSystem._get_fitness_values()):
+                self.assertAlmostEqual(f(e), value, delta=1e-6 * max(1.0, value))
+
+    def test_deduplication(self):
+        values = [({'x': x}, x * x) for x in range(0, 20)]
+        x = Node(Operations.IDENTITY, value='x')
+        square = Expression(Node(Operations.MULTIPLICATION, left=x, right=x), ['x'])
+        doubled = Expression(Node(Operations.PLUS, left=x, right=x), ['x'])
+        product = Expression(Node(Operations.MULTIPLICATION, left=Node(Operations.NUMBER, value=2), right=x),
+                             ['x'])
+        for compact_population in [False, True]:
+            immuneSystem = self._create(values, number_of_lymphocytes=4, compact_population=compact_population,
+                                        deduplication=True)
+            immuneSystem.set_lymphocytes([square, doubled, square, product])
+            fitness_values = immuneSystem._get_fitness_values()
+            self.assertEqual(fitness_values[0], 0)
+            self.assertLess(fitness_values[1], float('inf'))
+            self.assertEqual(fitness_values[2:].tolist(), [float('inf')] * 2)
+
+    def test_deduplication_with_progressive_evaluation(self):
+        values = [({'x': x}, x * x) for x in range(0, 50)]
+        x = Node(Operations.IDENTITY, value='x')
+        square = Expression(Node(Operations.MULTIPLICATION, left=x, right=x), ['x'])
+        doubled = Expression(Node(Operations.PLUS, left=x, right=x), ['x'])
+        immuneSystem = self._create(values, number_of_lymphocytes=4, progressive_evaluation=True,
+                                    first_subset_size=5, deduplication=True)
+        immuneSystem.set_lymphocytes([square, doubled, square, doubled])
+        fitness_values = immuneSystem._get_fitness_values()
+        self.assertEqual(fitness_values[2:].tolist(), [float('inf')] * 2)
+        #duplicates don't switch off the early rejection
+        self.assertEqual(immuneSystem._get_rejection_threshold(), fitness_values[1])
+
+        thresholds = []
+        get_rejection_threshold = immuneSystem._get_rejection_threshold
+
+        def record_threshold():
+            thresholds.append(get_rejection_threshold())
+            return thresholds[-1]
+        immuneSystem._get_rejection_threshold = record_threshold
+        for i in range(0, 5):
+            immuneSystem.step()
+        self.assertTrue(all(t is not None and t < float('inf') for t in thresholds))
+
+    def test_migrants_replace_worst(self):
+        values = [({'x': x}, x * x) for x in range(0, 5)]
+        migrants = [Expression(Node(Operations.MULTIPLICATION,
+                                    left=Node(Operations.IDENTITY, value='x'),
+                                    right=Node(Operations.IDENTITY, value='x')), ['x'])] * 5
+        exchanger = SimpleRandomExchanger(lambda: migrants)
+        immuneSystem = self._create(values, exchanger, number_of_lymphocytes=10, number_of_migrants=3,
+                                    emigrants_selection='diversity')
+        self.assertEqual(len(exchanger.to_exchange), 3)
+        immuneSystem.exchanging_step()
+        self.assertEqual(len(immuneSystem.lymphocytes), 10)
+        self.assertEqual(immuneSystem.best_fitness(), 0)
+
+    def test_asynchronous_migration(self):
+        values = [({'x': x}, x * x) for x in range(0, 5)]
+        square = Expression(Node(Operations.MULTIPLICATION,
+                                 left=Node(Operations.IDENTITY, value='x'),
+                                 right=Node(Operations.IDENTITY, value='x')), ['x'])
+
+        class Exchanger:
+            def __init__(self):
+                self.generations = []
+                self.inbox = MigrationInbox()
+
+            def set_lymphocytes_to_exchange(self, lymphocytes, generation=None):
+                self.generations.append(generation)
+
+            def get_lymphocytes(self):
+                raise AssertionError('must not be called')
+
+            def get_migrants(self, generation, max_staleness):
+                return self.inbox.drain(generation, max_staleness)
+
+        exchanger = Exchanger()
+        immuneSystem = self._create(values, exchanger, number_of_lymphocytes=10, number_of_iterations=4,
+                                    number_of_iterations_to_exchange=2, asynchronous_migration=True,
+                                    max_staleness=1)
+        exchanger.inbox.put(1, -5, [square])
+        immuneSystem.solve(accuracy=-1)
+        self.assertEqual(exchanger.generations, [None, 2])
+        #the stale lymphocyte is ignored
+        self.assertEqual(exchanger.inbox.dropped, 1)
+        exchanger.inbox.put(1, 3, [square])
+        immuneSystem.receive_migrants()
+        self.assertEqual(len(immuneSystem.lymphocytes), 10)
+        self.assertEqual(immuneSystem.best_fitness(), 0)
+
+    def test_tournament_selection_solve_is_not_crashing(self):
+        values = [({'x': x}, x * x) for x in range(0, 5)]
+        immuneSystem = self._create(values, self._random_exchanger(), number_of_lymphocytes=10,
+                                    number_of_iterations=5, number_of_iterations_to_exchange=2,
+                                    selection='tournament')
+        best = immuneSystem.solve()
+        self.assertEqual(len(immuneSystem.lymphocytes), 10)
+        self.assertEqual(len(immuneSystem.fitness_values), 10)
+        self.assertGreaterEqual(immuneSystem.fitness_cache(best), 0)
+
+
+class GenerateRandomTest(unittest.TestCase):
+    def _leaves_heights(self, node, height=1):
+        if node.left is None:
+            return [height]
+        result = self._leaves_heights(node.left, height + 1)
+        if node.right is not None:
+            result += self._leaves_heights(node.right, height + 1)
+        return result
+
+    def test_full(self):
+        for i in range(0, 10):
+            e = Expression.generate_random(max_height=4, variables=['x'], method=Expression.FULL)
+            self.assertTrue(e.root.is_binary())
+            self.assertEqual(set(self._leaves_heights(e.root)), {4})
+
+    def test_grow(self):
+        for i in range(0, 10):
+            e = Expression.generate_random(max_height=4, variables=['x'], method=Expression.GROW)
+            self.assertLessEqual(max(self._leaves_heights(e.root)), 4)
+
+    def test_ramped_half_and_half(self):
+        expressions = Expression.generate_random_batch(12, max_height=4, variables=['x', 'y'])
+        self.assertEqual(len(expressions), 12)
+        heights = [max(self._leaves_heights(e.root)) for e in expressions]
+        self.assertLessEqual(max(heights), 4)
+        self.assertIn(2, heights)
+
+
+class CompiledExpressionTest(unittest.TestCase):
+    def setUp(self):
+        root = Node(Operations.DIVISION,
+                    Node(Operations.COS, left=Node(Operations.IDENTITY, value='x')),
+                    Node(Operations.MINUS,
+                         left=Node(Operations.IDENTITY, value='y'),
+                         right=Node(Operations.NUMBER, value=3)))
+        self.e = Expression(root=root, variables=['x', 'y'])
+
+    def test_postfix_order(self):
+        compiled = self.e.compile()
+        self.assertEqual(list(compiled.codes),
+                         [Operations.IDENTITY.code, Operations.COS.code, Operations.IDENTITY.code,
+                          Operations.NUMBER.code, Operations.MINUS.code, Operations.DIVISION.code])
+
+    def test_same_values_as_tree(self):
+        compiled = self.e.compile()
+        for point in [{'x': 1, 'y': 2}, {'x': -2.5, 'y': 3}]:
+            self.assertAlmostEqual(compiled.value_in_point(point), self.e.root.value_in_point(point))
+
+    def test_restore_tree(self):
+        restored = Expression.from_compiled(self.e.compile(), self.e.variables)
+        self.assertEqual(restored.structural_key(), self.e.structural_key())
+
+    def test_invalidate(self):
+        self.e.compile()
+        self.e.root.right.right.value = 4
+        self.e.invalidate()
+        self.assertAlmostEqual(self.e.value_in_point({'x': 0, 'y': 2}), -0.5)
+
+    def test_pickle_compiled_expression(self):
+        self.e.value_in_point({'x': 1, 'y': 2})
+        returned_expression = pickle.loads(pickle.dumps(self.e))
+        self.assertIsInstance(returned_expression.compile(), CompiledExpression)
+        self.assertEqual(returned_expression.value_in_point({'x': 1, 'y': 2}),
+                         self.e.value_in_point({'x': 1, 'y': 2}))
+
+    def test_jacobian_same_as_finite_differences(self):
+        root = Node(Operations.PLUS,
+                    Node(Operations.SIN,
+                         left=Node(Operations.MULTIPLICATION,
+                                   left=Node(Operations.NUMBER, value=1.5),
+                                   right=Node(Operations.IDENTITY, value='x'))),
+                    Node(Operations.DIVISION,
+                         left=Node(Operations.IDENTITY, value='y'),
+                         right=Node(Operations.MINUS,
+                                    left=Node(Operations.IDENTITY, value='x'),
+                                    right=Node(Operations.NUMBER, value=0.5))))
+        compiled = Expression(root=root, variables=['x', 'y']).compile()
+        columns = {'x': np.linspace(-2, 2, 8), 'y': np.linspace(1, 3, 8)}
+        numbers = np.array(compiled.args, dtype=np.float64)[compiled.numbers()]
+        values, jacobian = compiled.jacobian_in_columns(columns)
+        self.assertEqual(jacobian.shape, (8, 2))
+        np.testing.assert_allclose(values, compiled.value_in_columns(columns))
+        for i in range(0, 2):
+            step = np.zeros(2)
+            step[i] = 1e-6
+            difference = (compiled.with_numbers(numbers + step).value_in_columns(columns) -
+                          compiled.with_numbers(numbers - step).value_in_columns(columns)) / 2e-6
+            np.testing.assert_allclose(jacobian[:, i], difference, rtol=1e-5, atol=1e-5)
+
+    def test_gradient_same_as_jacobian(self):
+        root = Node(Operations.MULTIPLICATION,
+                    Node(Operations.COS,
+                         left=Node(Operations.PLUS,
+                                   left=Node(Operations.NUMBER, value=0.3),
+                                   right=Node(Operations.IDENTITY, value='x'))),
+                    Node(Operations.DIVISION,
+                         left=Node(Operations.NUMBER, value=2),
+                         right=Node(Operations.MINUS,
+                                    left=Node(Operations.IDENTITY, value='y'),
+                                    right=Node(Operations.NUMBER, value=2))))
+        compiled = Expression(root=root, variables=['x', 'y']).compile()
+        columns = {'x': np.linspace(-2, 2, 9), 'y': np.linspace(1, 3, 9)}
+        values, jacobian = compiled.jacobian_in_columns(columns)
+        weights = np.linspace(-1, 1, 9)
+        gradient_values, gradient = compiled.gradient_in_columns(columns, lambda v: weights)
+        np.testing.assert_allclose(gradient_values, values)
+        np.testing.assert_allclose(gradient, weights.dot(jacobian))
+        np.testing.assert_allclose(compiled.gradient_in_columns(columns)[1], jacobian.sum(axis=0))
+
+    def test_gradient_of_number(self):
+        e = Expression(root=Node(Operations.NUMBER, value=2), variables=['x'])
+        values, gradient = e.gradient_in_columns({'x': np.arange(5.0)})
+        np.testing.assert_allclose(values, [2] * 5)
+        np.testing.assert_allclose(gradient, [5])
+
+
+class VectorizedFitnessFunctionTest(unittest.TestCase):
+    def setUp(self):
+        self.values = [({'x': i, 'y': j}, 4 * i + 2 * j)
+                       for i in range(0, 10)
+                       for j in range(0, 10)]
+        columns, exact = DataFileStorageHelper.values_to_columns(['x', 'y'], self.values)
+        self.f = VectorizedFitnessFunction(columns, exact)
+
+    def test_same_as_fitness_function(self):
+        root = Node(Operations.DIVISION,
+                    Node(Operations.SIN, left=Node(Operations.IDENTITY, value='x')),
+                    Node(Operations.MINUS,
+                         left=Node(Operations.IDENTITY, value='y'),
+                         right=Node(Operations.NUMBER, value=3)))
+        e = Expression(root=root, variables=['x', 'y'])
+        self.assertAlmostEqual(self.f(e), FitnessFunction(self.values)(e))
+
+    def test_number_only_expression(self):
+        e = Expression(root=Node(Operations.NUMBER, value=2), variables=['x', 'y'])
+        self.assertAlmostEqual(self.f(e), FitnessFunction(self.values)(e))
+
+
+class StreamingFitnessFunctionTest(unittest.TestCase):
+    def setUp(self):
+        (handle, self.filename) = tempfile.mkstemp()
+        os.close(handle)
+        self.values = [({'x': i, 'y': j}, 4 * i + 2 * j)
+                       for i in range(0, 10)
+                       for j in range(0, 10)]
+        self.expressions = [Expression.generate_random(max_height=3, variables=['x', 'y'])
+                            for i in range(0, 5)]
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def _check_same_as_fitness_function(self):
+        f = FitnessFunction(self.values)
+        streaming = StreamingFitnessFunction(self.filename, chunk_size=7)
+        for (e, value) in zip(self.expressions, streaming.values(self.expressions)):
+            self.assertAlmostEqual(value, f(e), delta=1e-9 * max(1.0, value))
+
+    def test_binary_file(self):
+        columns, exact = DataFileStorageHelper.values_to_columns(['x', 'y'], self.values)
+        DataFileStorageHelper.save_columns_to_binary_file(self.filename, ['x', 'y'], columns, exact)
+        self._check_same_as_fitness_function()
+
+    def test_text_file(self):
+        output = open(self.filename, 'w')
+        output.write('x y\n')
+        for (arg, f) in self.values:
+            output.write('{0} {1} {2}\n'.format(arg['x'], arg['y'], f))
+        output.close()
+        self._check_same_as_fitness_function()
+
+
+class ProgressiveFitnessFunctionTest(unittest.TestCase):
+    def setUp(self):
+        self.values = [({'x': i, 'y': j}, 4 * i + 2 * j)
+                       for i in range(0, 30)
+                       for j in range(0, 30)]
+        self.columns, self.exact = DataFileStorageHelper.values_to_columns(['x', 'y'], self.values)
+        self.expressions = [Expression.generate_random(max_height=3, variables=['x', 'y'])
+                            for i in range(0, 10)]
+
+    def test_same_as_vectorized_without_threshold(self):
+        f = VectorizedFitnessFunction(self.columns, self.exact)
+        progressive = ProgressiveFitnessFunction(self.columns, self.exact, first_subset_size=10)
+        for (e, value) in zip(self.expressions, progressive.values(self.expressions)):
+            self.assertAlmostEqual(value, f(e), delta=1e-9 * max(1.0, value))
+
+    def test_rejects_only_worse_than_threshold(self):
+        #worse expressions may be scored on the whole dataset before rejection
+        f = VectorizedFitnessFunction(self.columns, self.exact)
+        exact_values = [f(e) for e in self.expressions]
+        threshold = sorted(exact_values)[len(exact_values) // 2]
+        progressive = ProgressiveFitnessFunction(self.columns, self.exact, first_subset_size=10)
+        for (value, exact_value) in zip(progressive.values(self.expressions, threshold), exact_values):
+            if exact_value <= threshold or value != float('inf'):
+                self.assertAlmostEqual(value, exact_value, delta=1e-9 * max(1.0, value))
+
+    def test_racing_promotes_only_part_of_expressions(self):
+        progressive = ProgressiveFitnessFunction(self.columns, self.exact, first_subset_size=10,
+                                                 racing_fraction=0.3)
+        values = progressive.values(self.expressions, float('inf'))
+        self.assertLessEqual(len([v for v in values if v != float('inf')]), 3)
+
+
+class FitnessCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        def fitness(expression):
+            self.calls.append(expression)
+            return len(self.calls)
+
+        self.cache = FitnessCache(fitness, max_size=2)
+
+    def _number(self, value):
+        return Expression(root=Node(Operations.NUMBER, value=value), variables=['x'])
+
+    def test_equal_trees_calculated_once(self):
+        first = self.cache(self._number(1))
+        second = self.cache(self._number(1))
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache(self._number(1))
+        self.cache(self._number(2))
+        self.cache(self._number(1))
+        self.cache(self._number(3))
+        self.assertEqual(len(self.cache), 2)
+        self.cache(self._number(1))
+        self.assertEqual(len(self.calls), 3)
+        self.cache(self._number(2))
+        self.assertEqual(len(self.calls), 4)
+
+    def test_values_calculates_equal_trees_once(self):
+        values = self.cache.values([self._number(1), self._number(2), self._number(1)])
+        self.assertEqual(values[0], values[2])
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.cache.misses, 2)
+        self.assertEqual(self.cache.hits, 1)
+
+
+class ParallelFitnessEvaluatorTest(unittest.TestCase):
+    def test_same_as_vectorized(self):
+        values = [({'x': i, 'y': j}, 4 * i + 2 * j)
+                  for i in range(0, 10)
+                  for j in range(0, 10)]
+        columns, exact = DataFileStorageHelper.values_to_columns(['x', 'y'], values)
+        f = VectorizedFitnessFunction(columns, exact)
+        expressions = [Expression.generate_random(max_height=3, variables=['x', 'y'])
+                       for i in range(0, 10)]
+
+        evaluator = ParallelFitnessEvaluator(columns, exact, ['x', 'y'], number_of_workers=2)
+        try:
+            parallel_values = evaluator(expressions)
+        finally:
+            evaluator.close()
+        self.assertEqual(parallel_values, [f(e) for e in expressions])
+
+
+class SelectionTest(unittest.TestCase):
+    def setUp(self):
+        self.fitness_values = np.array([5.0, 1.0, 4.0, 0.5, 3.0, 2.0])
+
+    def test_truncation(self):
+        selected = TruncationSelection().select(self.fitness_values, 3)
+        self.assertEqual(sorted(selected), [1, 3, 5])
+
+    def test_truncation_of_all(self):
+        selected = TruncationSelection().select(self.fitness_values, 10)
+        self.assertEqual(sorted(selected), list(range(0, 6)))
+
+    def test_tournament_keeps_best(self):
+        selected = TournamentSelection(tournament_size=2).select(self.fitness_values, 4)
+        self.assertEqual(len(selected), 4)
+        self.assertEqual(selected[0], 3)
+
+
+class ConstantOptimizerTest(unittest.TestCase):
+    def setUp(self):
+        values = [({'x': x}, 3 * x + 2) for x in range(0, 20)]
+        columns, exact = DataFileStorageHelper.values_to_columns(['x'], values)
+        self.optimizer = ConstantOptimizer(columns, exact)
+        self.f = VectorizedFitnessFunction(columns, exact)
+
+    def test_fits_numbers(self):
+        e = Expression(root=Node(Operations.PLUS,
+                                 left=Node(Operations.MULTIPLICATION,
+                                           left=Node(Operations.NUMBER, value=1),
+                                           right=Node(Operations.IDENTITY, value='x')),
+                                 right=Node(Operations.NUMBER, value=1)),
+                       variables=['x'])
+        (compiled, fitness) = self.optimizer.optimize(e)
+        self.assertLess(fitness, 1e-6)
+        self.assertAlmostEqual(self.f(compiled), fitness)
+        np.testing.assert_allclose(np.array(compiled.args)[compiled.numbers()], [3, 2], atol=1e-6)
+
+    def test_gradient_same_as_finite_differences(self):
+        e = Expression(root=Node(Operations.SIN,
+                                 left=Node(Operations.MULTIPLICATION,
+                                           left=Node(Operations.NUMBER, value=0.5),
+                                           right=Node(Operations.IDENTITY, value='x'))),
+                       variables=['x'])
+        (fitness, gradient) = self.optimizer.gradient(e)
+        self.assertAlmostEqual(fitness, self.f(e))
+        compiled = e.compile()
+        difference = (self.f(compiled.with_numbers([0.5 + 1e-6])) -
+                      self.f(compiled.with_numbers([0.5 - 1e-6]))) / 2e-6
+        self.assertAlmostEqual(gradient[0], difference, delta=1e-4 * max(1.0, abs(difference)))
+
+    def test_expression_without_numbers(self):
+        e = Expression(root=Node(Operations.IDENTITY, value='x'), variables=['x'])
+        (compiled, fitness) = self.optimizer.optimize(e)
+        self.assertEqual(compiled.structural_key(), e.structural_key())
+        self.assertAlmostEqual(fitness, self.f(e))
+
+
+class DeduplicatorTest(unittest.TestCase):
+    def setUp(self):
+        columns = {'x': np.arange(0, 100, dtype=np.float64)}
+        self.deduplicator = Deduplicator(Deduplicator.probe(columns, 16))
+        x = Node(Operations.IDENTITY, value='x')
+        self.sum = Expression(Node(Operations.PLUS, left=x, right=x), ['x'])
+        self.product = Expression(Node(Operations.MULTIPLICATION, left=Node(Operations.NUMBER, value=2), right=x),
+                                  ['x'])
+        self.square = Expression(Node(Operations.MULTIPLICATION, left=x, right=x), ['x'])
+
+    def test_probe(self):
+        probe = Deduplicator.probe({'x': np.arange(0, 100), 'y': np.arange(100, 200)}, 16)
+        self.assertEqual(len(probe['x']), 16)
+        self.assertEqual(probe['x'][0], 0)
+        self.assertEqual(probe['x'][-1], 99)
+        np.testing.assert_array_equal(probe['y'] - probe['x'], [100] * 16)
+
+    def test_structural_and_semantic_duplicates(self):
+        copy = Expression(self.square.root.copy(), ['x'])
+        expressions = [self.square, self.sum, copy, self.product]
+        self.assertEqual(self.deduplicator.duplicates(expressions, [2, 3]).tolist(), [2, 3])
+        self.assertEqual(self.deduplicator.duplicates(expressions, [0, 1, 2, 3]).tolist(), [2, 3])
+        self.assertEqual(self.deduplicator.duplicates([self.square, self.sum], [0, 1]).tolist(), [])
+
+    def test_not_finite_values_are_not_compared(self):
+        x = Node(Operations.IDENTITY, value='x')
+        huge = Node(Operations.NUMBER, value=1e308)
+        first = Expression(Node(Operations.MULTIPLICATION, left=huge, right=x), ['x'])
+        second = Expression(Node(Operations.MULTIPLICATION, left=x, right=huge), ['x'])
+        self.assertIsNone(self.deduplicator.fingerprint(first))
+        self.assertEqual(self.deduplicator.duplicates([first, second], [0, 1]).tolist(), [])
+
+
+class DataFileStorageHelperTest(unittest.TestCase):
+    def setUp(self):
+        (handle, self.filename) = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_binary_file(self):
+        values = [({'x': i, 'y': -i}, i * 0.5) for i in range(0, 10)]
+        columns, exact = DataFileStorageHelper.values_to_columns(['x', 'y'], values)
+        DataFileStorageHelper.save_columns_to_binary_file(self.filename, ['x', 'y'], columns, exact)
+
+        variables, loaded_columns, loaded_exact = DataFileStorageHelper.load_columns_from_binary_file(self.filename)
+        self.assertEqual(variables, ['x', 'y'])
+        self.assertEqual(list(loaded_columns['x']), list(columns['x']))
+        self.assertEqual(list(loaded_columns['y']), list(columns['y']))
+        self.assertEqual(list(loaded_exact), list(exact))
+        del loaded_columns, loaded_exact
+
+    def test_binary_file_uses_random_module(self):
+        random.seed(3)
+        DataFileStorageHelper.save_to_binary_file(self.filename, ['x', 'y'], lambda x, y: x - y, 5)
+        random.seed(3)
+        points = [[random.random() * 10.0 - 5.0 for var in ['x', 'y']] for i in range(0, 5)]
+
+        variables, columns, exact = DataFileStorageHelper.load_columns_from_binary_file(self.filename)
+        np.testing.assert_allclose(columns['x'], [p[0] for p in points])
+        np.testing.assert_allclose(columns['y'], [p[1] for p in points])
+        np.testing.assert_allclose(exact, [p[0] - p[1] for p in points])
+        del columns, exact
+
+    def test_not_binary_file(self):
+        output = open(self.filename, 'w')
+        output.write('x y\n1 2 3\n')
+        output.close()
+        self.assertRaises(ValueError, DataFileStorageHelper.load_columns_from_binary_file, self.filename)
+
+
+class PopulationTest(unittest.TestCase):
+    def setUp(self):
+        self.expressions = [Expression.generate_random(max_height=4, variables=['x', 'y'])
+                            for i in range(0, 20)]
+        self.population = Population.from_expressions(self.expressions, ['x', 'y'])
+
+    def test_trees_are_the_same(self):
+        self.assertEqual(len(self.population), len(self.expressions))
+        for (i, e) in enumerate(self.expressions):
+            self.assertEqual(self.population.tree(i).structural_key(), e.structural_key())
+            self.assertEqual(self.population.expression(i).structural_key(), e.structural_key())
+
+    def test_select(self):
+        selected = self.population.select([3, 0, 3])
+        self.assertEqual(len(selected), 3)
+        self.assertEqual(selected.tree(0).structural_key(), self.expressions[3].structural_key())
+        self.assertEqual(selected.tree(1).structural_key(), self.expressions[0].structural_key())
+        self.assertEqual(selected.tree(2).structural_key(), self.expressions[3].structural_key())
+
+    def test_mutated_trees_are_valid(self):
+        mutated = self.population.mutated()
+        self.assertEqual(len(mutated), len(self.population))
+        for i in range(0, len(mutated)):
+            restored = Population.from_expressions([mutated.expression(i)], ['x', 'y'])
+            self.assertEqual(list(restored.left),
+                             list(mutated.left[mutated.offsets[i]:mutated.offsets[i + 1]]))
+            mutated.tree(i).value_in_point({'x': 1, 'y': 2})
+
+    def test_subtree_mutation_keeps_height(self):
+        x = Node(Operations.IDENTITY, value='x')
+        deep = Node(Operations.PLUS,
+                    left=Node(Operations.PLUS, left=Node(Operations.MULTIPLICATION, left=x, right=x), right=x),
+                    right=x)
+        sines = Node(Operations.SIN, left=Node(Operations.SIN, left=Node(Operations.SIN, left=x)))
+        expression = Expression(root=Node(Operations.PLUS, left=sines, right=deep), variables=['x'])
+        population = Population.from_expressions([expression], ['x'])
+        for i in range(0, 100):
+            (codes, values, left) = population._subtree_mutation(population.codes.copy(),
+                                                                 population.values.copy(),
+                                                                 population.left)
+            mutated = Population._from_trees([codes], [values], population.variables, [left])
+            self.assertLessEqual(mutated.expression(0).root.height(), expression.root.height())
+
+
+class ExpressionSerializerTest(unittest.TestCase):
+    def test_encode_decode(self):
+        e = Expression.generate_random(max_height=4, variables=['x', 'y'])
+        restored = ExpressionSerializer.decode(ExpressionSerializer.encode(e))
+        self.assertEqual(restored.structural_key(), e.structural_key())
+        self.assertEqual(restored.value_in_point({'x': 1.5, 'y': -2}), e.value_in_point({'x': 1.5, 'y': -2}))
+
+    def test_batch_with_different_variables(self):
+        expressions = [Expression(Node(Operations.IDENTITY, value='x'), ['x']),
+                       Expression(Node(Operations.PLUS,
+                                       left=Node(Operations.IDENTITY, value='y'),
+                                       right=Node(Operations.NUMBER, value=2.5)), ['y'])]
+        expressions += [Expression.generate_random(max_height=3, variables=['x', 'z'])
+                        for i in range(0, 10)]
+        restored = ExpressionSerializer.decode_batch(ExpressionSerializer.encode_batch(expressions))
+        self.assertEqual(len(restored), len(expressions))
+        for (e, r) in zip(expressions, restored):
+            self.assertEqual(str(r), str(e))
+
+    def test_smaller_than_pickle(self):
+        expressions = [Expression.generate_random(max_height=5, variables=['x', 'y'])
+                       for i in range(0, 20)]
+        self.assertLess(len(ExpressionSerializer.encode_batch(expressions)) * 5,
+                        len(pickle.dumps(expressions)))
+
+    def test_wrong_data(self):
+        self.assertRaises(ValueError, ExpressionSerializer.decode_batch, b'not expressions')
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.lymphocytes = [Expression.generate_random(max_height=2, variables=['x'])
+                            for i in range(0, 5)]
+        self.server = ThreadingTCPServer(('localhost', 0), TCPHandler)
+        self.server.lymphocytes_getter = lambda: self.lymphocytes
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.pool = ConnectionPool(timeout=5)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_messages_framing(self):
+        (first, second) = socket.socketpair()
+        payload = bytes(range(0, 256)) * 1000
+
+        def send():
+            send_message(first, payload)
+            send_message(first, b'')
+            first.close()
+        sender = threading.Thread(target=send)
+        sender.start()
+        self.assertEqual(receive_message(second), payload)
+        self.assertEqual(receive_message(second), b'')
+        sender.join()
+        self.assertIsNone(receive_message(second))
+        second.close()
+
+    def test_connection_is_reused(self):
+        address = self.server.server_address
+        for i in range(0, 3):
+            received = ExpressionSerializer.decode_batch(self.pool.request(address))
+            self.assertEqual([str(e) for e in received], [str(e) for e in self.lymphocytes])
+        self.assertEqual(len(self.pool.connections), 1)
+
+    def test_too_large_message_closes_connection(self):
+        (first, second) = socket.socketpair()
+        first.sendall(struct.pack('!Q', 1 << 62))
+        self.assertRaises(ValueError, receive_message, second)
+        first.close()
+        second.close()
+
+        sock = socket.create_connection(self.server.server_address, 5)
+        sock.sendall(struct.pack('!Q', 1 << 62))
+        self.assertEqual(sock.recv(1), b'')
+        sock.close()
+
+    def test_broken_connection_is_reopened(self):
+        address = self.server.server_address
+        self.pool.request(address)
+        self.pool.connections[address].close()
+        self.pool.connections[address] = socket.create_connection(address)
+        self.pool.connections[address].close()
+        self.assertEqual(len(ExpressionSerializer.decode_batch(self.pool.request(address))), 5)
+
+    def test_broken_response_is_dropped(self):
+        received = []
+        getter = GetterThread(self.server.server_address, received.append, self.pool)
+        getter.run()
+        self.assertEqual(len(received), 1)
+
+        class BrokenPool:
+            def request(self, address):
+                return b'\xff' * 3
+        #the error is caught, so it is not raised by run
+        GetterThread(self.server.server_address, received.append, BrokenPool()).run()
+        self.assertEqual(len(received), 1)
+
+
+class AsyncPeerToPeerExchangerTest(unittest.TestCase):
+    class NodesManager:
+        def __init__(self, other_nodes):
+            self.other_nodes = other_nodes
+            self.other_nodes_len = len(other_nodes)
+            self.current_node = 0
+
+        def get_self_address(self):
+            return 'localhost', 0
+
+        def get_next_node_address(self):
+            result = self.other_nodes[self.current_node]
+            self.current_node = (self.current_node + 1) % self.other_nodes_len
+            return result
+
+    def setUp(self):
+        #nobody listens this port after the socket is closed
+        sock = socket.socket()
+        sock.bind(('localhost', 0))
+        self.dead_address = sock.getsockname()
+        sock.close()
+        self.exchangers = []
+
+    def tearDown(self):
+        for exchanger in self.exchangers:
+            exchanger.close()
+
+    def _create(self, other_nodes, nodes_per_exchange=1):
+        exchanger = AsyncPeerToPeerExchanger(self.NodesManager(other_nodes), nodes_per_exchange, timeout=2)
+        self.exchangers.append(exchanger)
+        return exchanger
+
+    def test_lymphocytes_are_received(self):
+        first = self._create([self.dead_address])
+        lymphocytes = [Expression.generate_random(max_height=2, variables=['x']) for i in range(0, 5)]
+        first.set_lymphocytes_to_exchange(lymphocytes)
+        second = self._create([first.address])
+        second.fetching.result(5)
+        received = second.get_lymphocytes()
+        self.assertEqual([str(e) for e in received], [str(e) for e in lymphocytes])
+        #the same connection is used for the next exchange
+        second.fetching.result(5)
+        self.assertEqual(len(second.get_lymphocytes()), 5)
+        self.assertEqual(len(second.connections), 1)
+
+    def test_dead_node_is_skipped(self):
+        first = self._create([self.dead_address])
+        first.set_lymphocytes_to_exchange([Expression.generate_random(max_height=2, variables=['x'])])
+        second = self._create([self.dead_address, first.address], nodes_per_exchange=2)
+        second.fetching.result(5)
+        self.assertEqual(len(second.get_lymphocytes()), 1)
+        self.assertEqual(len(self._create([self.dead_address]).get_lymphocytes()), 0)
+
+    def _start_broken_node(self, response):
+        """
+        Starts node that answers every request with the given raw bytes.
+        """
+        class Handler(TCPHandler):
+            def handle(self):
+                while receive_message(self.request) is not None:
+                    self.request.sendall(response)
+
+        server = ThreadingTCPServer(('localhost', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_address
+
+    def test_broken_answer_is_skipped(self):
+        first = self._create([self.dead_address])
+        first.set_lymphocytes_to_exchange([Expression.generate_random(max_height=2, variables=['x'])])
+        truncated = self._start_broken_node(struct.pack('!Q', 3) + b'abc')
+        too_large = self._start_broken_node(struct.pack('!Q', 1 << 62))
+        second = self._create([truncated, too_large, first.address], nodes_per_exchange=3)
+        second.fetching.result(5)
+        #get_lymphocytes starts the next fetch that opens connections again
+        self.assertEqual(list(second.connections), [first.address])
+        self.assertEqual(len(second.get_lymphocytes()), 1)
+
+    def test_close_with_running_fetch(self):
+        #the node accepts connections, but never answers
+        silent = socket.socket()
+        silent.bind(('localhost', 0))
+        silent.listen(1)
+        self.addCleanup(silent.close)
+        exchanger = AsyncPeerToPeerExchanger(self.NodesManager([silent.getsockname()]), timeout=30)
+        exchanger.close()
+        self.assertTrue(exchanger.fetching.done())
+
+
+class MigrationTest(unittest.TestCase):
+    def test_topologies(self):
+        self.assertEqual(RingTopology().neighbours(3, 3), [1])
+        self.assertEqual(FullyConnectedTopology().neighbours(2, 4), [1, 3, 4])
+        self.assertEqual(StarTopology().neighbours(1, 3), [2, 3])
+        self.assertEqual(StarTopology().neighbours(3, 3), [1])
+        #3 x 3 grid
+        self.assertEqual(TorusTopology().neighbours(5, 9), [2, 4, 6, 8])
+        self.assertEqual(TorusTopology().neighbours(1, 9), [2, 3, 4, 7])
+        self.assertRaises(ValueError, create_topology, 'unknown')
+
+    def test_torus_with_short_last_row_is_symmetric(self):
+        #rows of 3, 3 and 2 nodes
+        topology = TorusTopology(width=3)
+        for node in range(1, 9):
+            for neighbour in topology.neighbours(node, 8):
+                self.assertIn(node, topology.neighbours(neighbour, 8))
+        self.assertEqual(topology.neighbours(3, 8), [1, 2, 6])
+
+    def test_random_regular_topology(self):
+        topology = RandomRegularTopology(degree=3, seed=1)
+        incoming = dict((n, 0) for n in range(1, 11))
+        for node in range(1, 11):
+            neighbours = topology.neighbours(node, 10)
+            self.assertNotIn(node, neighbours)
+            self.assertLessEqual(len(neighbours), 3)
+            self.assertEqual(neighbours, RandomRegularTopology(degree=3, seed=1).neighbours(node, 10))
+            for n in neighbours:
+                incoming[n] += 1
+        self.assertLessEqual(max(incoming.values()), 3)
+
+    def test_nodes_manager_with_topology(self):
+        manager = LocalhostNodesManager(2, 3, RingTopology())
+        self.assertEqual(manager.get_next_node_address(), ('localhost', 5003))
+        self.assertEqual(manager.get_next_node_address(), ('localhost', 5003))
+
+    def test_emigrants_selection(self):
+        expressions = [Expression(Node(Operations.NUMBER, value=v), []) for v in [1, 1, 2, 3]]
+        fitness_values = np.array([0.5, 0.5, 0.25, 3.0])
+        self.assertEqual(list(TopEmigrantsSelection().select(expressions, fitness_values, 2)), [2, 0])
+        self.assertEqual(list(DiversityEmigrantsSelection().select(expressions, fitness_values, 3)), [2, 0, 3])
+        self.assertEqual(len(set(RandomEmigrantsSelection().select(expressions, fitness_values, 3))), 3)
+
+    def test_migration_inbox(self):
+        inbox = MigrationInbox(max_size=3)
+        inbox.put(1, 5, ['a'])
+        inbox.put(1, 7, ['b'])
+        inbox.put(2, 1, ['c'])
+        inbox.put(3, 9, ['d'])
+        #the first message is dropped as the oldest one
+        self.assertEqual(len(inbox), 3)
+        self.assertEqual(inbox.drain(generation=10, max_staleness=5), ['d', 'b'])
+        self.assertEqual(len(inbox), 0)
+        self.assertEqual(inbox.dropped, 2)
+        self.assertEqual(inbox.drain(generation=10, max_staleness=5), [])
+
+    def test_replacement_policies(self):
+        fitness_values = np.array([0.5, 4.0, 0.25, 3.0])
+        self.assertEqual(sorted(ReplaceWorstPolicy().select(fitness_values, 2)), [1, 3])
+        for i in range(0, 10):
+            replaced = ReplaceRandomPolicy().select(fitness_values, 3)
+            self.assertEqual(len(replaced), 3)
+            self.assertNotIn(2, replaced)
+
+
+class IslandsTest(unittest.TestCase):
+    def test_queue_exchanger(self):
+        inboxes = [multiprocessing.Queue(1), multiprocessing.Queue(1)]
+        first = QueueExchanger(inboxes[0], [inboxes[1]])
+        second = QueueExchanger(inboxes[1], [inboxes[0]])
+        lymphocytes = [Expression.generate_random(max_height=2, variables=['x']) for i in range(0, 3)]
+        first.set_lymphocytes_to_exchange(lymphocytes)
+        #the inbox is full - nothing is sent and nothing waits
+        first.set_lymphocytes_to_exchange(lymphocytes[:1])
+        received = []
+        for i in range(0, 100):
+            received += second.get_lymphocytes()
+            if received:
+                break
+            time.sleep(0.01)
+        self.assertEqual([str(e) for e in received], [str(e) for e in lymphocytes])
+        self.assertEqual(second.get_lymphocytes(), [])
+        self.assertEqual(first.get_lymphocytes(), [])
+
+    def test_queue_exchanger_migrants(self):
+        inbox = multiprocessing.Queue()
+        exchanger = QueueExchanger(inbox, [])
+        sources = [QueueExchanger(multiprocessing.Queue(), [inbox], source) for source in range(0, 2)]
+        sources[0].set_lymphocytes_to_exchange([Expression.generate_random(max_height=2, variables=['x'])], 1)
+        sources[0].set_lymphocytes_to_exchange([Expression.generate_random(max_height=2, variables=['x'])] * 2, 8)
+        sources[1].set_lymphocytes_to_exchange([Expression.generate_random(max_height=2, variables=['x'])] * 3, 2)
+        time.sleep(0.2)
+        #only the newest message of the first source is not stale
+        self.assertEqual(len(exchanger.get_migrants(generation=10, max_staleness=5)), 2)
+
+    def test_run_islands(self):
+        values = [({'x': x}, x * x) for x in range(0, 10)]
+        columns, exact = DataFileStorageHelper.values_to_columns(['x'], values)
+        config = ExpressionsImmuneSystemConfig()
+        config.number_of_lymphocytes = 10
+        config.number_of_iterations = 6
+        config.number_of_iterations_to_exchange = 2
+        config.number_of_migrants = 2
+        config.topology = 'ring'
+        config.asynchronous_migration = True
+        results = IslandsRunner(columns, exact, ['x'], config, number_of_islands=3).run(seed=1)
+        self.assertEqual(len(results), 3)
+        f = FitnessFunction(values)
+        for (best, fitness) in results:
+            self.assertAlmostEqual(f(best), fitness, delta=1e-6 * max(1.0, fitness))
+        self.assertEqual(IslandsRunner.best(results)[1], min(fitness for (best, fitness) in results))
+
+    def test_islands_write_own_checkpoints(self):
+        values = [({'x': x}, x * x) for x in range(0, 10)]
+        columns, exact = DataFileStorageHelper.values_to_columns(['x'], values)
+        config = ExpressionsImmuneSystemConfig()
+        config.number_of_lymphocytes = 10
+        config.number_of_iterations = 2
+        config.number_of_iterations_to_exchange = 2
+        config.checkpoint_interval = 2
+        with tempfile.TemporaryDirectory() as directory:
+            config.checkpoint_filename = os.path.join(directory, 'checkpoint.bin')
+            IslandsRunner(columns, exact, ['x'], config, number_of_islands=2).run(seed=1)
+            self.assertEqual(sorted(os.listdir(directory)), ['checkpoint_1.bin', 'checkpoint_2.bin'])
+        self.assertTrue(config.checkpoint_filename.endswith('checkpoint.bin'))
+
+
+class NodesSupervisorTest(unittest.TestCase):
+    def test_results_are_collected(self):
+        def command(number):
+            return [sys.executable, '-c',
+                    'import json; print("log"); print(json.dumps({{"best": "x", "fitness": {0}}}))'.format(number)]
+        results = NodesSupervisor(3, command).run()
+        self.assertEqual([r.number for r in results], [1, 2, 3])
+        self.assertEqual([r.fitness for r in results], [1.0, 2.0, 3.0])
+        self.assertEqual(NodesSupervisor.best(results).number, 1)
+
+    def test_failed_node_is_restarted_and_dropped(self):
+        def command(number):
+            if number == 2:
+                return [sys.executable, '-c', 'import sys; sys.exit(1)']
+            return [sys.executable, '-c', 'print(\'{"best": "x", "fitness": 0.5}\')']
+        results = NodesSupervisor(2, command, max_restarts=2).run()
+        self.assertEqual(results[0].fitness, 0.5)
+        self.assertIsNone(results[1].fitness)
+        self.assertEqual(results[1].restarts, 2)
+
+    def test_failed_node_is_restarted_with_restart_command(self):
+        def command(number):
+            return [sys.executable, '-c', 'import sys; sys.exit(1)']
+
+        def restart_command(number):
+            return [sys.executable, '-c', 'print(\'{"best": "x", "fitness": 0.5}\')']
+        results = NodesSupervisor(1, command, restart_command=restart_command).run()
+        self.assertEqual(results[0].fitness, 0.5)
+        self.assertEqual(results[0].restarts, 1)
+
+    def test_node_main_is_resumed_from_checkpoint(self):
+        supervisor = NodesSupervisor(2)
+        self.assertEqual(supervisor.command(2)[2:], ['2', '2'])
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                self.assertEqual(supervisor.restart_command(2)[2:], ['2', '2'])
+                open('checkpoint_2.bin', 'wb').close()
+                self.assertEqual(supervisor.restart_command(2)[2:], ['2', '2', 'resume'])
+            finally:
+                os.chdir(cwd)
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        (handle, self.filename) = tempfile.mkstemp()
+        os.close(handle)
+        self.values = [({'x': x}, x * x) for x in range(0, 5)]
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_save_load(self):
+        expressions = [Expression.generate_random(max_height=3, variables=['x', 'y']) for i in range(0, 5)]
+        population = Population.from_expressions(expressions, ['x', 'y'])
+        fitness_values = np.array([1.0, np.nan, np.inf, 0.5, 2.0])
+        Checkpoint(7, population, fitness_values, random.getstate()).save(self.filename)
+        restored = Checkpoint.load(self.filename)
+        self.assertEqual(restored.generation, 7)
+        self.assertEqual(restored.random_state, random.getstate())
+        np.testing.assert_array_equal(restored.fitness_values, fitness_values)
+        self.assertEqual([str(e) for e in restored.population.to_expressions()], [str(e) for e in expressions])
+        self.assertRaises(ValueError, Checkpoint.from_bytes, b'not a checkpoint')
+
+    def test_writer(self):
+        population = Population.from_expressions([], ['x'])
+        writer = CheckpointWriter(self.filename)
+        for generation in range(0, 5):
+            writer.write(Checkpoint(generation, population, np.zeros(0), random.getstate()))
+        writer.close()
+        self.assertEqual(Checkpoint.load(self.filename).generation, 4)
+        self.assertFalse(os.path.exists(self.filename + '.tmp'))
+
+    def test_writer_error(self):
+        population = Population.from_expressions([], ['x'])
+        checkpoint = Checkpoint(0, population, np.zeros(0), random.getstate())
+        missing = os.path.join(self.filename + '.missing', 'checkpoint.bin')
+        writer = CheckpointWriter(missing)
+        writer.write(checkpoint)
+        self.assertRaises(OSError, writer.flush)
+        #the writer is still working
+        writer.filename = self.filename
+        writer.write(checkpoint)
+        writer.flush()
+        writer.filename = missing
+        writer.write(checkpoint)
+        self.assertRaises(OSError, writer.close)
+        self.assertFalse(writer._thread.is_alive())
+
+    def _create(self, checkpoint=None, compact=False):
+        config = ExpressionsImmuneSystemConfig()
+        config.number_of_lymphocytes = 10
+        config.number_of_iterations = 6
+        config.checkpoint_interval = 3
+        config.checkpoint_filename = self.filename
+        config.compact_population = compact
+        return ExpressionsImmuneSystem(exact_values=self.values,
+                                       variables=['x'],
+                                       exchanger=SimpleRandomExchanger(lambda: []),
+                                       config=config,
+                                       checkpoint=checkpoint)
+
+    def _check_resume(self, compact):
+        immuneSystem = self._create(compact=compact)
+        immuneSystem.config.number_of_iterations = 3
+        immuneSystem.solve(accuracy=-1)
+        immuneSystem.close()
+        expected = immuneSystem._get_fitness_values()
+
+        checkpoint = Checkpoint.load(self.filename)
+        self.assertEqual(checkpoint.generation, 2)
+        resumed = self._create(checkpoint, compact)
+        self.assertEqual(resumed.first_generation, 3)
+        np.testing.assert_array_equal(resumed.fitness_values, expected)
+        #fitness values are not calculated again
+        self.assertEqual(resumed.fitness_cache.misses, 0)
+        resumed.solve(accuracy=-1)
+        resumed.close()
+        self.assertEqual(Checkpoint.load(self.filename).generation, 5)
+
+    def test_resume(self):
+        self._check_resume(compact=False)
+
+    def test_resume_compact_population(self):
+        self._check_resume(compact=True)
+
+    def test_checkpoint_is_snapshot(self):
+        immuneSystem = self._create(compact=True)
+        checkpoint = immuneSystem.get_checkpoint()
+        expected = checkpoint.to_bytes()
+        immuneSystem.population.values[:] = 42.0
+        immuneSystem.step()
+        immuneSystem.close()
+        self.assertEqual(checkpoint.to_bytes(), expected)
+
+
+class InstrumentationTest(unittest.TestCase):
+    def test_timers_and_counters(self):
+        instrumentation = Instrumentation()
+        with instrumentation.timer('phase'):
+            pass
+        with instrumentation.timer('phase'):
+            pass
+        instrumentation.count('evaluations', 5)
+        instrumentation.count('evaluations')
+        snapshot = instrumentation.snapshot()
+        self.assertEqual(snapshot['timers']['phase']['calls'], 2)
+        self.assertGreaterEqual(snapshot['timers']['phase']['seconds'], 0)
+        self.assertEqual(snapshot['counters'], {'evaluations': 6})
+
+    def test_null_instrumentation(self):
+        instrumentation = NullInstrumentation()
+        with instrumentation.timer('phase'):
+            instrumentation.count('evaluations')
+        self.assertFalse(instrumentation.enabled)
+
+    def test_generation_records(self):
+        (handle, filename) = tempfile.mkstemp()
+        os.close(handle)
+        records = []
+        observer = JsonLinesObserver(filename)
+        instrumentation = Instrumentation([records.append, observer])
+
+        values = [({'x': x}, x * x) for x in range(0, 5)]
+        config = ExpressionsImmuneSystemConfig()
+        config.number_of_lymphocytes = 10
+        config.number_of_iterations = 3
+        immuneSystem = ExpressionsImmuneSystem(exact_values=values,
+                                               variables=['x'],
+                                               exchanger=SimpleRandomExchanger(lambda: []),
+                                               config=config,
+                                               instrumentation=instrumentation)
+        immuneSystem.solve(accuracy=-1)
+        observer.close()
+
+        self.assertEqual([r['generation'] for r in records], [0, 1, 2])
+        for record in records:
+            self.assertLessEqual(record['best'], record['median'])
+            self.assertGreater(record['evaluations'], 0)
+        self.assertIn('mutation', records[-1]['timers'])
+        self.assertIn('simplify', instrumentation.snapshot()['timers'])
+        input = open(filename)
+        lines = input.readlines()
+        input.close()
+        os.remove(filename)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0])['generation'], 0)
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_run(self):
+        grid = {'population_sizes': [4], 'heights': [2], 'dataset_sizes': [10]}
+        results = benchmark.run(grid, seed=1, repeat=1)
+        names = set(name[:name.index('[')] for name in results)
+        self.assertEqual(names, set(['generate_random', 'mutation', 'simplify', 'serialization',
+                                     'node_value_in_point', 'compiled_value_in_point', 'value_in_columns',
+                                     'step']))
+        for result in results.values():
+            self.assertGreaterEqual(result['seconds'], 0)
+
+    def test_step_is_seeded(self):
+        values = benchmark._dataset(20, seed=1)
+        lymphocytes = []
+        for i in range(0, 2):
+            immune_system = benchmark._immune_system(values, 10, 3, seed=1)
+            immune_system.step()
+            lymphocytes.append([str(e) for e in immune_system._get_expressions()])
+            immune_system.close()
+        self.assertEqual(lymphocytes[0], lymphocytes[1])
+
+    def test_config_file_is_not_read(self):
+        directory = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            config = ExpressionsImmuneSystemConfig()
+            config.number_of_lymphocytes = 7
+            config.save()
+            self.assertEqual(ExpressionsImmuneSystemConfig().number_of_lymphocytes, 7)
+            self.assertEqual(ExpressionsImmuneSystemConfig(filename=None).number_of_lymphocytes,
+                             ExpressionsImmuneSystemConfig._number_of_lymphocytes_default)
+            os.remove('config.json')
+        finally:
+            os.chdir(cwd)
+            os.rmdir(directory)
+
+    def test_compare(self):
+        baseline = {'a': {'seconds': 1.0}, 'b': {'seconds': 1.0}}
+        results = {'a': {'seconds': 1.1}, 'b': {'seconds': 1.5}, 'c': {'seconds': 9.0}}
+        self.assertEqual(benchmark.compare(results, baseline, tolerance=0.2), [('b', 1.0, 1.5)])